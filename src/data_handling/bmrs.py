@@ -1,7 +1,7 @@
 import concurrent.futures
+import functools
 import glob
 import matplotlib.pyplot as plt
-import requests
 import pandas as pd
 assert pd.__version__ >= '1.5'
 import os, sys
@@ -12,95 +12,108 @@ import datetime as dt
 
 
 import utils.helpers as helpers
+import utils.http_client as http_client
+import data_handling.ingest as ingest
+import data_handling.gen_store as gen_store
+import data_handling.parsers as parsers
+import data_handling.volume_store as volume_store
+import data_handling.ledger as ledger
+import data_handling.planner as planner
+import data_handling.delta_store as delta_store
+import data_handling.response_cache as response_cache
+import data_handling.settlement as settlement
+import data_handling.volume_cube as volume_cube
+import pyarrow as pa
+import pyarrow.parquet as pq
 global api_key
 api_key = helpers.get_credentials()
+bmrs_config = helpers.get_bmrs_config()
+base_url = bmrs_config.get('base_url', 'https://api.bmreports.com/BMRS').rstrip('/')
+use_response_cache = bmrs_config.getboolean('response_cache', fallback=False)
 
 global project_root_path
 project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+B1610_SOURCE = 'B1610'
+DERBMDATA_SOURCE = 'DERBMDATA'
+GEN_DATA_RETRY_AFTER_DAYS = 50
+# the daily files of the non-zero bid-offer pair volumes, <date>_pairs.parquet
+PAIRS_ID = 'pairs'
+
 class NoDataError(Exception):
     pass
 
 class APIError(Exception):
     pass
 
+
+def get_b1610_url(date_string, bmu_id='*'):
+    return f"{base_url}/B1610/v2?APIKey={api_key}&SettlementDate={date_string}&Period=*&NGCBMUnitID={bmu_id}&ServiceType=csv"
+
+
+def get_derbmdata_url(date_string):
+    return f"{base_url}/DERBMDATA/v1?APIKey={api_key}&SettlementDate={date_string}&SettlementPeriod=*&BMUnitId=*&BMUnitType=*&LeadPartyName=*&NGCBMUnitName=*&ServiceType=csv"
+
+
+def get_ingest_engine(**kwargs):
+    """
+    Returns an IngestEngine, with the response cache if it is enabled in config.ini.
+    """
+    if use_response_cache:
+        kwargs.setdefault('cache', response_cache.get_response_cache())
+    return ingest.IngestEngine(**kwargs)
+
+
+def read_b1610_csv(raw_path):
+    """
+    Reads a raw B1610 csv response into a DataFrame with typed 'Settlement Date', 'SP', 'Quantity (MW)'
+    and BMU id columns. Returns an empty DataFrame if there is no data.
+    """
+    return parsers.parse_b1610(raw_path).to_pandas()
+
 class BMRS:
     def __init__(self):
         self.folder_path = os.path.join(project_root_path, 'data', 'bm_data')
         self.preprocessed_folder_path = os.path.join(project_root_path, 'data', 'preprocessed_data')
         self.bav_data = None
         self.oav_data = None
-        self._init_metadata_dict()
-        self._load_metadata_dict()
-
-    def _init_metadata_dict(self):
-        # glob
+        self.bav_store = None
+        self.oav_store = None
+        self.volume_cube = None
+        self.ledger = ledger.get_ledger()
+        self.cache = response_cache.get_response_cache() if use_response_cache else None
+        if not self.ledger.has_rows(DERBMDATA_SOURCE):
+            self._import_metadata()
+
+    def _import_metadata(self):
+        # one off, load the dates recorded before the ledger existed
         metadata_file = os.path.join(self.folder_path, 'metadata.json')
         files = glob.glob(os.path.join(self.folder_path, '*.parquet'))
-        dates = [os.path.basename(file).split('_')[0] for file in files]
-        dates = list(set(dates))
-        dates.sort()
-        metadata_dict = {}
-        metadata_dict['processed'] = {}
-        metadata_dict['attempted'] = {}
-        for date in dates:
-            metadata_dict['processed'][date] = True
-            metadata_dict['attempted'][date] = True
-
-        with open(metadata_file, 'w') as f:
-            json.dump(metadata_dict, f)
-        self.metadata_dict = metadata_dict
-
-    
-    def _load_metadata_dict(self):
-        metadata_file = os.path.join(self.folder_path, 'metadata.json')
+        processed_dates = {os.path.basename(file).split('_')[0] for file in files}
+        attempted_dates = set()
         if os.path.exists(metadata_file):
             with open(metadata_file, 'r') as f:
                 metadata_dict = json.load(f)
-            self.metadata_dict = metadata_dict
-        else:
-            self._init_metadata_dict()
-            self.update_bm_data = True
+            processed_dates.update(date for date, processed in metadata_dict['processed'].items() if processed)
+            attempted_dates.update(metadata_dict['attempted'])
+        self.ledger.import_dates(DERBMDATA_SOURCE, ledger.ALL_BMUS, processed_dates, attempted_dates)
 
-    def _update_metadata_dict(self):
-        metadata_file = os.path.join(self.folder_path, 'metadata.json')
-        with open(metadata_file, 'w') as f:
-            json.dump(self.metadata_dict, f)
+    def _get_processed_dates(self):
+        return self.ledger.dates(DERBMDATA_SOURCE, status=ledger.PROCESSED)
 
-    
     def _update_bm_data(self):
         try:
-            start_date = pd.to_datetime('2017-01-01')
-            end_date = pd.to_datetime('today').floor('D') - pd.Timedelta(days=1)
-            date_list = pd.date_range(start_date, end_date, freq='1D').to_list()
-            # get a list of dates that have not been processed True
-            for date in date_list:
-                #get the boolean value for the date
-                date_string = date.strftime('%Y-%m-%d')
-                processed = self.metadata_dict['processed'].get(date_string)
-                if processed:
-                    # if the date has been processed, remove it from the list
-                    date_list.remove(date)
-
-            # only keep more recent dates
-            new_dates = [date for date in date_list if date > pd.to_datetime('today').floor('D') - pd.Timedelta(days=14)]
+            # only look at the last two weeks
+            start_date = pd.to_datetime('today').floor('D') - pd.Timedelta(days=13)
+            plan = planner.plan_updates(DERBMDATA_SOURCE, [ledger.ALL_BMUS], start_date, ledger_=self.ledger)
+            new_dates = [date_string for _, date_string in planner.iter_dates(plan)]
             if new_dates:
-                self.session = requests.Session()
                 # do chunks of 250 dates at a time
                 chunks = [new_dates[i:i + 250] for i in range(0, len(new_dates), 250)]
                 for chunk in chunks:
-                # Use ThreadPoolExecutor to call API concurrently
+                # Use ThreadPoolExecutor to call API concurrently, each date is recorded in the ledger as it finishes
                     with concurrent.futures.ThreadPoolExecutor() as executor:
-                        futures = {executor.submit(self._download_accepted_volumes, date.strftime('%Y-%m-%d')): date for date in chunk}
-                        for future in concurrent.futures.as_completed(futures):
-                            date = futures[future]
-                            self.metadata_dict['attempted'][date.strftime('%Y-%m-%d')] = True
-                            if future.result():
-                                self.metadata_dict['processed'][date.strftime('%Y-%m-%d')] = True
-                            else:
-                                self.metadata_dict['processed'][date.strftime('%Y-%m-%d')] = False
-                    # every 250 dates, update the metadata file, to ensure that we don't re-run the same dates if the script crashes
-                    self._update_metadata_dict()
+                        list(executor.map(self._download_accepted_volumes, chunk))
             else:
                 print("BMRS data is up to date")
         except Exception as e:
@@ -108,12 +121,10 @@ class BMRS:
 
     def _download_accepted_volumes(self, date_str):
         """
-        Downloads and processes BAV and OAV data for a specific date.
+        Downloads and processes BAV and OAV data for a specific date, and records the attempt in the ledger.
 
         Args:
-        date (datetime): The date for which to download the data.
-        redo (bool): If True, re-download the data even if it already exists.
-        verbose (bool): If True, print detailed log messages.
+        date_str (str): The date for which to download the data.
 
         Returns:
         True or False
@@ -124,37 +135,48 @@ class BMRS:
 
         oav_filename = os.path.join(folder_path, f'{date_str}_OAV.parquet')
         bav_filename = os.path.join(folder_path, f'{date_str}_BAV.parquet')
+        pairs_filename = os.path.join(folder_path, f'{date_str}_{PAIRS_ID}.parquet')
 
         try:
-            endpoint = f"https://api.bmreports.com/BMRS/DERBMDATA/v1?APIKey={api_key}&SettlementDate={date_str}&SettlementPeriod=*&BMUnitId=*&BMUnitType=*&LeadPartyName=*&NGCBMUnitName=*&ServiceType=csv"
-            response = requests.get(endpoint)
-
-            df = pd.DataFrame(response.text.splitlines())
-            df = df[0].str.split(',', expand=True)
-            df.drop(0, inplace=True)
-
-            bav_df = df[df[0] == 'BAV'].copy()
-            if len(bav_df) > 0:
-                bav_df.rename(columns={0: 'HDR', 1: 'BMU_id', 2: 'Settlement Period', 18: 'Total'}, inplace=True)
-                bav_df['date'] = pd.to_datetime(date_str)
-                bav_df.drop(columns=list(range(3, 18)), inplace=True)
-                bav_df.to_parquet(bav_filename, index=False)
-            
-            oav_df = df[df[0] == 'OAV'].copy()
-            if len(oav_df) > 0:
-                oav_df.rename(columns={0: 'HDR', 1: 'BMU_id', 2: 'Settlement Period', 18: 'Total'}, inplace=True)
-                oav_df['date'] = pd.to_datetime(date_str)
-                oav_df.drop(columns=list(range(3, 18)), inplace=True)
-                oav_df.to_parquet(oav_filename, index=False)
+            endpoint = get_derbmdata_url(date_str)
+            if self.cache is not None:
+                cached = self.cache.fetch(endpoint)
+                table = parsers.parse_derbmdata(cached.path, columns=parsers.DERBMDATA_COLUMN_NAMES)
+                n_bytes = os.path.getsize(cached.path)
+            else:
+                with http_client.get_client().get(endpoint, stream=True) as response:
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    # parse the BAV and OAV records straight from the response stream
+                    table = parsers.parse_derbmdata(response.raw, columns=parsers.DERBMDATA_COLUMN_NAMES)
+                    n_bytes = response.raw.tell()
+
+            for record_type, filename in [('BAV', bav_filename), ('OAV', oav_filename)]:
+                df = parsers.filter_record_type(table, record_type).drop(parsers.DERBMDATA_PAIR_COLUMNS).to_pandas()
+                if len(df) > 0:
+                    df['date'] = pd.to_datetime(date_str)
+                    df = volume_store.compact_accepted_volumes(df)
+                    df.to_parquet(filename, index=False)
+            # written even if empty, to tell the dates without pair volumes from the ones downloaded before they were kept
+            day = volume_store.to_day_number([date_str])[0]
+            pair_df = volume_store.to_pair_volumes(table.to_pandas(), parsers.DERBMDATA_PAIR_COLUMNS, day)
+            pair_df.to_parquet(pairs_filename, index=False)
+            self.ledger.record(DERBMDATA_SOURCE, ledger.ALL_BMUS, date_str, True, n_bytes)
             return True
+        except http_client.CircuitOpenError as e:
+            # not attempted, so not recorded
+            print(f"Skipping BMRS data for {date_str}: {e}")
+            return False
         except Exception as e:
             print(f"Error processing BMRS data for {date_str}: {e}")
+            self.ledger.record(DERBMDATA_SOURCE, ledger.ALL_BMUS, date_str, False)
             return False
         
-    def _get_new_processed_dates(self, last_date):
+    def _get_new_processed_dates(self, stored_dates):
+        stored_dates = set(stored_dates)
         return [
-            date for date in self.metadata_dict['processed']
-            if self.metadata_dict['processed'][date] and pd.to_datetime(date) > last_date
+            date for date in self._get_processed_dates()
+            if date not in stored_dates
         ]
     
     def _read_and_concatenate_dataframes(self, dates, id):
@@ -164,47 +186,165 @@ class BMRS:
             file_paths = [file_path for file_path in file_paths if os.path.exists(file_path)]
             with concurrent.futures.ThreadPoolExecutor() as executor:
                 dataframes = list(executor.map(pd.read_parquet, file_paths))
-            return pd.concat(dataframes, ignore_index=True)
+            # also converts files written before the compact schema
+            return volume_store.concat_accepted_volumes(dataframes)
         except Exception as e:
             raise Exception(f"_read_and_concatenate_dataframes() failed for {id}: {e}")
 
     
+    def _set_accepted_volumes_data(self, id, all_data):
+        # sort and index by BMU once, so per BMU lookups are a slice
+        store = volume_store.VolumeStore(all_data)
+        if id.lower() == 'bav':
+            self.bav_store = store
+            self.bav_data = store.df
+        elif id.lower() == 'oav':
+            self.oav_store = store
+            self.oav_data = store.df
+        return store.df
+
+    def _get_accepted_volumes_store(self, id):
+        file_path = os.path.join(self.preprocessed_folder_path, f'{id}_data.parquet')
+        return delta_store.DeltaStore(file_path, concat=volume_store.concat_accepted_volumes)
+
+    def _adopt_accepted_volumes_file(self, id, store):
+        # a file written before the manifest, it has every processed date up to its last day
+        all_data = pd.read_parquet(store.path)
+        converted = 'date' in all_data.columns
+        if converted:
+            print(f"{id} data before conversion: {volume_store.memory_report(all_data)}")
+            all_data = volume_store.compact_accepted_volumes(all_data)
+            print(f"{id} data after conversion: {volume_store.memory_report(all_data)}")
+        last_date = volume_store.from_day_number(all_data['day'].max()).strftime('%Y-%m-%d')
+        dates = [date for date in self._get_processed_dates() if date <= last_date]
+        if converted:
+            store.write(all_data, dates)
+        else:
+            store.adopt(dates)
+
     def get_all_accepted_volumes_data(self, id, update=False):
         if update:
             self._update_bm_data()
 
-        file_path = os.path.join(self.preprocessed_folder_path, f'{id}_data.parquet')
-        if os.path.exists(file_path):
-            all_data = pd.read_parquet(file_path)
-            last_processed_date = all_data['date'].max()
+        store = self._get_accepted_volumes_store(id)
+        if not store.has_manifest() and os.path.exists(store.path):
+            self._adopt_accepted_volumes_file(id, store)
 
-            new_dates = self._get_new_processed_dates(last_processed_date)
+        if store.exists():
+            # only the new dates are written, as a delta
+            new_dates = self._get_new_processed_dates(store.dates())
             if new_dates:
-                new_data = self._read_and_concatenate_dataframes(new_dates, id)
-                all_data = pd.concat([all_data, new_data], ignore_index=True)
-                all_data.to_parquet(file_path)
-            if id.lower() == 'bav':
-                self.bav_data = all_data
-            elif id.lower() == 'oav':
-                self.oav_data = all_data
-            return all_data
+                store.append(self._read_and_concatenate_dataframes(new_dates, id), new_dates)
+            return self._set_accepted_volumes_data(id, store.read())
 
-        metadata_file = os.path.join(self.folder_path, 'metadata.json')
-        with open(metadata_file, 'r') as file:
-            metadata_dict = json.load(file)
-
-        processed_dates = [date for date in metadata_dict['processed'] if metadata_dict['processed'][date]]
+        processed_dates = self._get_processed_dates()
         all_data = self._read_and_concatenate_dataframes(processed_dates, id)
-        all_data['date'] = pd.to_datetime(all_data['date'])
-        
-        all_data.to_parquet(file_path)
-        if id.lower() == 'bav':
-            self.bav_data = all_data
-        elif id.lower() == 'oav':
-            self.oav_data = all_data
+        print(f"{id} data: {volume_store.memory_report(all_data)}")
+
+        # the file is written sorted by BMU
+        all_data = self._set_accepted_volumes_data(id, all_data)
+        store.write(all_data, processed_dates)
         return all_data
-    
-        
+
+    def compact_accepted_volumes_data(self, id):
+        """
+        Folds the delta files of the BAV or OAV data into its parquet file, sorted by BMU.
+        """
+        store = self._get_accepted_volumes_store(id)
+        if store.exists():
+            store.write(self._set_accepted_volumes_data(id, store.read()), store.dates())
+
+    def get_volume_cube(self, update=False):
+        """
+        Loads the daily BAV and OAV files of the processed dates not in the volume cube yet, in one pass.
+
+        Returns:
+        VolumeCube: The accepted bids and offers of every BMU on the half hour UTC grid.
+        """
+        if update:
+            self._update_bm_data()
+        cube = volume_cube.VolumeCube()
+        new_dates = cube.update(self.folder_path, self._get_processed_dates())
+        if new_dates:
+            print(f"Added {len(new_dates)} dates to the volume cube")
+        self.volume_cube = cube
+        return cube
+
+    def get_accepted_volumes_for_bmu(self, bmu_id):
+        """
+        Returns the accepted bid ('BAV') and offer ('OAV') volumes of a BMU, in MWh per half hour UTC,
+        zero where there were none, NaN on the dates whose volumes were not loaded.
+        """
+        try:
+            if self.volume_cube is None:
+                self.get_volume_cube()
+            return self.volume_cube.get(bmu_id).astype(float)
+        except Exception as e:
+            raise Exception(f"get_accepted_volumes_for_bmu() failed for {bmu_id}: {e}")
+
+    def _get_pair_volumes_dates(self):
+        # the processed dates downloaded since the pair volumes were kept
+        return [
+            date for date in self._get_processed_dates()
+            if os.path.exists(os.path.join(self.folder_path, f"{date}_{PAIRS_ID}.parquet"))
+        ]
+
+    def get_pair_volumes_data(self, update=False, columns=None):
+        """
+        Returns the non-zero bid-offer pair volumes of every BMU (see volume_store.PAIR_DTYPES), sorted by BMU.
+        Dates downloaded before the pair volumes were kept are missing, see backfill_pair_volumes().
+
+        Args:
+        update (bool): Download the new DERBMDATA first.
+        columns (list): Optional, only read these columns.
+        """
+        if update:
+            self._update_bm_data()
+
+        file_path = os.path.join(self.preprocessed_folder_path, f'{PAIRS_ID}_data.parquet')
+        store = delta_store.DeltaStore(file_path, concat=volume_store.concat_pair_volumes)
+        stored_dates = store.dates() if store.exists() else set()
+        new_dates = [date for date in self._get_pair_volumes_dates() if date not in stored_dates]
+        if new_dates:
+            file_paths = [os.path.join(self.folder_path, f"{date}_{PAIRS_ID}.parquet") for date in new_dates]
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                new_data = volume_store.concat_pair_volumes(list(executor.map(pd.read_parquet, file_paths)))
+            new_data = volume_store.sort_pair_volumes(new_data)
+            if store.exists():
+                store.append(new_data, new_dates)
+            else:
+                store.write(new_data, new_dates)
+        if not store.exists():
+            return None
+        return store.read(columns=columns)
+
+    def backfill_pair_volumes(self, start_date=None):
+        """
+        Downloads again the processed dates (from `start_date`) which have no pair volumes file.
+        With the response cache on, the settled dates are read from the cache.
+        """
+        dates = set(self._get_pair_volumes_dates())
+        dates = [date for date in self._get_processed_dates() if date not in dates and (start_date is None or date >= start_date)]
+        print(f"Downloading pair volumes for {len(dates)} dates")
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            return sum(executor.map(self._download_accepted_volumes, dates))
+
+    def _get_curtailment_file_path(self, bmu_id):
+        folder_path = os.path.join(project_root_path, 'data', 'preprocessed_data', bmu_id)
+        os.makedirs(folder_path, exist_ok=True)
+        return os.path.join(folder_path, f'{bmu_id}_curtailment_data.parquet')
+
+    def _preprocess_bav_data(self, df):
+        df = df.copy()
+        df['BMU_id'] = df['BMU_id'].astype(object)
+        df['Settlement Period'] = df['Settlement Period'].astype(int)
+        df.index = settlement.to_utc(df.pop('day').to_numpy(), df['Settlement Period'].to_numpy())
+        df.index.name = 'utc_time'
+        # settlement periods which do not exist on their date
+        df = df[df.index.notna()]
+        df = df.resample('30T').last()
+        df['Total'] = df['Total'].astype(float)
+        return df
 
     def get_bav_data_for_bmu(self, bmu_id):
         """
@@ -212,38 +352,55 @@ class BMRS:
         Loads the data from a file if it already exists.
 
         Args:
-        curtailment_df (DataFrame): The DataFrame containing curtailment data.
         bmu_id (str): The BMU ID to filter the data.
 
         Returns:
         DataFrame: A DataFrame containing the filtered and processed curtailment data.
         """
         try:
-            folder_path = os.path.join(project_root_path, 'data', 'preprocessed_data', bmu_id)
-            os.makedirs(folder_path, exist_ok=True)
-            filename = os.path.join(folder_path, f'{bmu_id}_curtailment_data.parquet')
+            filename = self._get_curtailment_file_path(bmu_id)
 
-            if os.path.exists(filename):
+            if _is_current_file(filename):
                 print('Loading from file')
                 return pd.read_parquet(filename)
             
-            if self.bav_data is None:
+            if self.bav_store is None:
                 self.get_all_accepted_volumes_data('BAV')
-                
-
-            filt = self.bav_data['BMU_id'].str.contains(bmu_id)
-            df = self.bav_data[filt].copy()
-            df['Settlement Period'] = df['Settlement Period'].astype(int)
-            df.index = pd.to_datetime(df.pop('date'))
-            df['utc_time'] = df.index + pd.to_timedelta((df['Settlement Period'] - 1) * 30, unit='minute')
-            df.set_index('utc_time', inplace=True)
-            df = df.resample('30T').last()
-            df['Total'] = df['Total'].astype(float)
-            df.to_parquet(filename)
+
+            df = self._preprocess_bav_data(self.bav_store.get(bmu_id))
+            _write_current_file(df, filename)
             return df
         except Exception as e:
             raise Exception(f"get_bav_data_for_bmu() failed for {bmu_id}: {e}")
 
+    def split_all_bmus(self, bmu_ids=None):
+        """
+        Writes the curtailment file of every BMU (or only `bmu_ids`) in one pass over the BAV data,
+        overwriting any existing files. Files are named by NGC BMU id, as in get_bav_data_for_bmu().
+
+        Args:
+        bmu_ids (list): Optional, only write the files for these NGC BMU ids.
+
+        Returns:
+        list: The BMU IDs that were written.
+        """
+        if self.bav_store is None:
+            self.get_all_accepted_volumes_data('BAV')
+        if bmu_ids is not None:
+            bmu_ids = set(bmu_ids)
+
+        written = []
+        for elexon_bmu_id, df in self.bav_store.items():
+            bmu_id = volume_store.get_ngc_bmu_id(elexon_bmu_id)
+            if bmu_ids is not None and bmu_id not in bmu_ids:
+                continue
+            try:
+                _write_current_file(self._preprocess_bav_data(df), self._get_curtailment_file_path(bmu_id))
+                written.append(bmu_id)
+            except Exception as e:
+                print(f"split_all_bmus() failed for {bmu_id}: {e}")
+        return written
+
 
 
 
@@ -251,185 +408,120 @@ class BMRS:
 class BMU:
     def __init__(self, bmu_id,update=False):
         self.bmu_id = bmu_id
-        self.session = None
         self.update = update
         self.raw_folder_path = os.path.join(project_root_path, 'data', 'raw_gen_data', self.bmu_id)
         self.preprocessed_folder_path = os.path.join(project_root_path, 'data', 'preprocessed_data', self.bmu_id)
         self.plot_folder_path = os.path.join(project_root_path, 'plots', 'generation_data')
         os.makedirs(self.raw_folder_path, exist_ok=True)
         os.makedirs(self.preprocessed_folder_path, exist_ok=True)
-        self._load_metadata_dict()
-
-    def _init_metadata_dict(self):
-        # glob
-        metadata_file = os.path.join(self.raw_folder_path, f'{self.bmu_id}_metadata.json')
-        files = glob.glob(os.path.join(self.raw_folder_path, '*.parquet'))
-        dates = [os.path.basename(file).split('.')[0] for file in files]
-        dates = list(set(dates))
-        dates.sort()
-        metadata_dict = {}
-        metadata_dict['processed'] = []
-        metadata_dict['attempted'] = []
-        for date in dates:
-            metadata_dict['processed'].append(date)
-            metadata_dict['attempted'].append(date)
-
-        with open(metadata_file, 'w') as f:
-            json.dump(metadata_dict, f)
-        self.metadata_dict = metadata_dict
-        self.update = True
-
-
-    def _load_metadata_dict(self):
+        # move any files from before the generation dataset into it
+        if glob.glob(os.path.join(self.raw_folder_path, '*.parquet')):
+            gen_store.migrate_raw_files(self.bmu_id, self.raw_folder_path)
+        self.ledger = ledger.get_ledger()
+        if not self.ledger.has_rows(B1610_SOURCE, self.bmu_id):
+            self._import_metadata()
+
+    def _import_metadata(self):
+        # one off, load the dates recorded before the ledger existed
         metadata_file = os.path.join(self.raw_folder_path, f'{self.bmu_id}_metadata.json')
+        processed_dates = set(gen_store.stored_dates(self.bmu_id))
+        attempted_dates = set()
         if os.path.exists(metadata_file):
             with open(metadata_file, 'r') as f:
                 metadata_dict = json.load(f)
-            for key in metadata_dict.keys():
-                values = metadata_dict[key]
-                # remove duplicates
-                values = list(set(values))
-                # sort
-                values.sort()
-                metadata_dict[key] = values
-
-            self.metadata_dict = metadata_dict
-                # unique and sort
+            processed_dates.update(metadata_dict['processed'])
+            attempted_dates.update(metadata_dict['attempted'])
+            os.replace(metadata_file, metadata_file + '.imported')
         else:
-            self._init_metadata_dict()
+            # a new BMU, download its history
+            self.update = True
+        self.ledger.import_dates(B1610_SOURCE, self.bmu_id, processed_dates, attempted_dates)
 
-    def _update_metadata_dict(self):
-        metadata_file = os.path.join(self.raw_folder_path, f'{self.bmu_id}_metadata.json')
-        with open(metadata_file, 'w') as f:
-            json.dump(self.metadata_dict, f)
+    def _get_processed_dates(self):
+        return self.ledger.dates(B1610_SOURCE, self.bmu_id, status=ledger.PROCESSED)
 
+    def _get_attempted_dates(self):
+        return self.ledger.dates(B1610_SOURCE, self.bmu_id)
 
     def _update_gen_data(self, start_date=None, end_date=None, redo=False):
-
         try:
-            if start_date is None:
-                start_date = pd.to_datetime('2017-01-01')
-            if end_date is None:
-                end_date = pd.to_datetime('today').floor('D') - pd.Timedelta(days=1)
-
-            date_list = pd.date_range(start_date, end_date, freq='1D').to_list()
-            
-            if not redo:
-                try:
-                    attempted_dates = self.metadata_dict['attempted']
-                    # remove from the attempted dates which are recent (1 week), becuase we want to re-attempt them in case they failed due to availability of data
-                    attempted_dates = [date for date in attempted_dates if pd.to_datetime(date) < pd.to_datetime('today').floor('D') - pd.Timedelta(days=50)]
-                    # remove dates that have already been attempted from the date_list
-                    new_dates = [date for date in date_list if date.strftime('%Y-%m-%d') not in attempted_dates]
-                # Filter dates that are not processed or are within the last 14 days
-                except Exception as e:
-                    print(f"{self.bmu_id}: {e}")
-                    new_dates = date_list
-            else:
-                new_dates = date_list
-            if new_dates:
-                self.session = requests.Session()
-                # do chunks of 250 dates at a time
-                chunks = [new_dates[i:i + 250] for i in range(0, len(new_dates), 250)]
-                for chunk in chunks:
-                # Use ThreadPoolExecutor to call API concurrently
-                    with concurrent.futures.ThreadPoolExecutor() as executor:
-                        futures = {executor.submit(self._call_api, date.strftime('%Y-%m-%d')): date for date in chunk}
-                        for future in concurrent.futures.as_completed(futures):
-                            date = futures[future]
-                            if date.strftime('%Y-%m-%d') not in self.metadata_dict['attempted']:
-                                self.metadata_dict['attempted'].append(date.strftime('%Y-%m-%d'))
-                            if future.result():
-                                if date.strftime('%Y-%m-%d') not in self.metadata_dict['processed']:
-                                    self.metadata_dict['processed'].append(date.strftime('%Y-%m-%d'))                                      
-                    # every 250 dates, update the metadata file, to ensure that we don't re-run the same dates if the script crashes
-                    self._update_metadata_dict()
-            else:
-                print(f"{self.bmu_id} is up to date")
+            update_gen_data([self], start_date, end_date, redo)
         except Exception as e:
             # line number
             print(f"_update_gen_data() failed for {self.bmu_id}: {e}, {sys.exc_info()[-1].tb_lineno}")
 
-    def _call_api(self, date_string):
-        if self.session is None:
-            self.session = requests.Session()
-        endpoint = f"https://api.bmreports.com/BMRS/B1610/v2?APIKey={api_key}&SettlementDate={date_string}&Period=*&NGCBMUnitID={self.bmu_id}&ServiceType=csv"
+    def _record_attempt(self, date_string, processed, n_bytes=None):
+        self.ledger.record(B1610_SOURCE, self.bmu_id, date_string, processed, n_bytes)
+
+    def _gen_data_job(self, date_string):
+        endpoint = get_b1610_url(date_string, self.bmu_id)
+        raw_path = os.path.join(self.raw_folder_path, f'{date_string}.csv')
+        process = functools.partial(self._process_gen_data_response, date_string)
+        return ingest.IngestJob((self.bmu_id, date_string), endpoint, raw_path, process)
+
+    def _process_gen_data_response(self, date_string, raw_path):
         try:
-            print(f"{self.bmu_id}: {date_string}, downloading data")
-            response = self.session.get(endpoint)
-            try:
-                response.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                raise APIError(f"{self.bmu_id}: {date_string}, API error: {e}")
-            df = pd.DataFrame(response.text.splitlines())
-            try:
-                assert len(df) > 1
-            except AssertionError:
+            df = read_b1610_csv(raw_path)
+            if len(df) == 0:
                 raise NoDataError(f"{self.bmu_id}: {date_string}, no data")
-            df = df[0].str.split(',', expand=True)
-            df.columns = df.iloc[1]
-            df.drop([0, 1], inplace=True)
-
-            df = df.astype({'SP': 'int', 'Quantity (MW)': 'float'})
-            df['Settlement Date'] = pd.to_datetime(df['Settlement Date'])
-            df[['Settlement Date', 'SP', 'Quantity (MW)']].to_parquet(f"{self.raw_folder_path}/{date_string}.parquet")
+            self._write_gen_data(date_string, df)
             return True
         except Exception as e:
-            print(f"{self.bmu_id}: {date_string}, failed to download data: {e}")
+            print(f"{self.bmu_id}: {date_string}, failed to process data: {e}")
             return False
+        finally:
+            os.remove(raw_path)
+
+    def _write_gen_data(self, date_string, df):
+        gen_store.write_day(self.bmu_id, date_string, df)
 
     def _get_new_processed_dates(self, last_processed_dates):
-        # compare the processed dates in the metadata file with the last_processed_dates
+        # compare the processed dates in the ledger with the last_processed_dates
+        last_processed_dates = set(last_processed_dates)
         return [
-            date for date in self.metadata_dict['processed']
+            date for date in self._get_processed_dates()
             if date not in last_processed_dates
         ]
 
 
-    def _read_and_concatenate_dataframes(self, dates):
-        file_paths = [os.path.join(self.raw_folder_path, f'{date}.parquet') for date in dates]
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            dataframes = list(executor.map(self.__preprocess_gen_data, file_paths))
-        return pd.concat(dataframes)
+    def _read_and_concatenate_dataframes(self, dates=None):
+        # a single scan of the generation dataset, rather than one read per date
+        df = gen_store.read_bmu(self.bmu_id, dates)
+        return self.__preprocess_gen_data(df)
 
-    def __preprocess_gen_data(self,file_path):
-        df = pd.read_parquet(file_path)
-        df['utc_time'] = df['Settlement Date'] + pd.to_timedelta((df['SP'] - 1) * 30, unit='minute')
+    def __preprocess_gen_data(self, df):
+        df['utc_time'] = settlement.to_utc(df['Settlement Date'].to_numpy(), df['SP'].to_numpy())
         df.set_index('utc_time', inplace=True)
         df.drop(columns=['Settlement Date', 'SP'], inplace=True)
-        df = df.resample('30T').last()
-        # interpolate missing values (don't do more than 2 consecutive missing values), then fill any remaining missing values with 0
+        # one value per settlement period, which exists on its date
+        df = df[df.index.notna() & ~df.index.duplicated(keep='last')]
         return df
 
+    def _get_gen_data_store(self):
+        os.makedirs(self.preprocessed_folder_path, exist_ok=True)
+        gen_data_file = os.path.join(self.preprocessed_folder_path, f'{self.bmu_id}_generation_data.parquet')
+        return delta_store.DeltaStore(gen_data_file, concat=_merge_gen_data, version=settlement.UTC_TIME_VERSION)
+
     def get_all_gen_data(self,redo=False, start_date=None, end_date=None):
         try:
             if self.update:
                 self._update_gen_data(start_date, end_date, redo)
 
-            gen_data_file = os.path.join(self.preprocessed_folder_path, f'{self.bmu_id}_generation_data.parquet') 
-            os.makedirs(self.preprocessed_folder_path, exist_ok=True)
-            if os.path.exists(gen_data_file):
-                all_data = pd.read_parquet(gen_data_file)
-                last_processed_dates = all_data.index.strftime('%Y-%m-%d').unique()
-                new_dates = self._get_new_processed_dates(last_processed_dates)
+            # a file from another version (or from before the manifest) is rebuilt from the generation dataset
+            store = self._get_gen_data_store()
+            if store.exists():
+                new_dates = self._get_new_processed_dates(store.dates())
                 print(f"Processing {len(new_dates)} new dates")
                 if new_dates:
-                    new_data = self._read_and_concatenate_dataframes(new_dates)
-                    all_data = pd.concat([all_data, new_data])
-                    all_data.to_parquet(gen_data_file)
-
-                return all_data
+                    store.append(self._read_and_concatenate_dataframes(new_dates), new_dates)
+                return store.read()
 
-            metadata_file = os.path.join(self.raw_folder_path, f'{self.bmu_id}_metadata.json')
-            with open(metadata_file, 'r') as file:
-                metadata_dict = json.load(file)
-
-            processed_dates = metadata_dict['processed']
+            processed_dates = self._get_processed_dates()
             if not processed_dates:
                 NoDataError(f"No data for {self.bmu_id}")
                 return None
-            all_data = self._read_and_concatenate_dataframes(processed_dates)
-            all_data.to_parquet(gen_data_file)
+            all_data = self._read_and_concatenate_dataframes()
+            store.write(all_data, processed_dates)
 
             return all_data
         except Exception as e:
@@ -442,9 +534,9 @@ class BMU:
         coverage_df['processed'] = False
         coverage_df['attempted'] = False
 
-        for date in self.metadata_dict['processed']:
+        for date in self._get_processed_dates():
             coverage_df.loc[date, 'processed'] = True
-        for date in self.metadata_dict['attempted']:
+        for date in self._get_attempted_dates():
             coverage_df.loc[date, 'attempted'] = True
 
         coverage_df['processed'] = coverage_df['processed'].astype(int)
@@ -478,15 +570,142 @@ class BMU:
 
 
 
+def _is_current_file(filename):
+    # files written before settlement.UTC_TIME_VERSION have no version and are rebuilt
+    if not os.path.exists(filename):
+        return False
+    metadata = pq.read_schema(filename).metadata or {}
+    return metadata.get(b'utc_time_version') == str(settlement.UTC_TIME_VERSION).encode()
+
+
+def _write_current_file(df, filename):
+    table = pa.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'utc_time_version'] = str(settlement.UTC_TIME_VERSION).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), filename)
+
+
+def _merge_gen_data(dfs):
+    # later rows win, as in gen_store, so a redone date replaces the old one
+    df = pd.concat(dfs)
+    df = df[~df.index.duplicated(keep='last')]
+    return df.sort_index()
+
+
+def plan_gen_data(bmu_ids, start_date=None, end_date=None, redo=False):
+    """
+    Returns the ranges of B1610 data still to download for all the BMUs, see planner.plan_updates().
+    Failed dates from the last 50 days are retried, in case the data was not available yet.
+    """
+    plan = planner.plan_updates(B1610_SOURCE, bmu_ids, start_date, end_date, retry_after_days=GEN_DATA_RETRY_AFTER_DAYS, redo=redo)
+    print(f"Generation data to download: {planner.summary(plan)}")
+    return plan
+
+
+def update_gen_data(bmu_objs, start_date=None, end_date=None, redo=False, engine=None):
+    """
+    Downloads the missing B1610 generation data for several BMUs through one IngestEngine,
+    so every BMU shares the same connection pool and request budget, then compacts the BMUs which got new data.
+
+    Args:
+    bmu_objs (list): BMU objects to update.
+    start_date, end_date: Optional date range, defaults to 2017-01-01 until yesterday.
+    redo (bool): If True, re-download dates which have already been attempted.
+    engine (IngestEngine): Optional, an engine to reuse.
+
+    Returns:
+    dict: {(bmu_id, date_string): True or False} for every attempted download.
+    """
+    if engine is None:
+        engine = get_ingest_engine()
+    bmus = {bmu_obj.bmu_id: bmu_obj for bmu_obj in bmu_objs}
+    plan = plan_gen_data(list(bmus), start_date, end_date, redo)
+    jobs = (bmus[bmu_id]._gen_data_job(date_string) for bmu_id, date_string in planner.iter_dates(plan))
+
+    def record(job, processed):
+        bmu_id, date_string = job.key
+        bmus[bmu_id]._record_attempt(date_string, bool(processed), job.bytes)
+
+    engine.on_result = record
+    results = engine.run(jobs)
+    # merge the new delta files into the monthly part files, so the BMUs are read back from a file per month
+    gen_store.compact(sorted({bmu_id for (bmu_id, _), processed in results.items() if processed}))
+    return results
+
+
+def _process_date_response(bmus, date_string, raw_path):
+    # split a wildcard response into one file per BMU, in a single pass over the rows
+    try:
+        df = read_b1610_csv(raw_path)
+        written = []
+        for bmu_id, bmu_df in df.groupby(parsers.B1610_BMU_COLUMN, sort=False):
+            if bmu_id in bmus:
+                bmus[bmu_id]._write_gen_data(date_string, bmu_df)
+                written.append(bmu_id)
+        return written
+    except Exception as e:
+        print(f"{date_string}, failed to process data: {e}")
+        return False
+    finally:
+        os.remove(raw_path)
+
+
+def update_gen_data_by_date(bmu_objs, start_date=None, end_date=None, redo=False, engine=None):
+    """
+    Date-major version of update_gen_data(): every settlement date which any of the BMUs is missing
+    is downloaded once, for all BMUs (NGCBMUnitID=*), and the response is split locally into the per BMU files,
+    which are compacted once every date is in.
+
+    Args:
+    bmu_objs (list): BMU objects to update.
+    start_date, end_date: Optional date range, defaults to 2017-01-01 until yesterday.
+    redo (bool): If True, re-download dates which have already been attempted.
+    engine (IngestEngine): Optional, an engine to reuse.
+
+    Returns:
+    dict: {date_string: list of the BMU ids which had data, or False} for every attempted date.
+    """
+    if engine is None:
+        engine = get_ingest_engine()
+    bmus = {bmu_obj.bmu_id: bmu_obj for bmu_obj in bmu_objs}
+    bmus_by_date = {}
+    for bmu_id, date_string in planner.iter_dates(plan_gen_data(list(bmus), start_date, end_date, redo)):
+        bmus_by_date.setdefault(date_string, []).append(bmu_id)
+
+    raw_folder_path = os.path.join(project_root_path, 'data', 'raw_gen_data', '_by_date')
+    jobs = []
+    # most recent dates first
+    for date_string in sorted(bmus_by_date, reverse=True):
+        endpoint = get_b1610_url(date_string)
+        raw_path = os.path.join(raw_folder_path, f'{date_string}.csv')
+        process = functools.partial(_process_date_response, bmus, date_string)
+        jobs.append(ingest.IngestJob(date_string, endpoint, raw_path, process))
+
+    ledger_ = ledger.get_ledger()
+
+    def record(job, written):
+        # the response is for every BMU, its size is recorded once for the date, as for DERBMDATA
+        ledger_.record(B1610_SOURCE, ledger.ALL_BMUS, job.key, written is not False, job.bytes)
+        written = set(written or [])
+        for bmu_id in bmus_by_date[job.key]:
+            bmus[bmu_id]._record_attempt(job.key, bmu_id in written)
+
+    engine.on_result = record
+    results = engine.run(jobs)
+    gen_store.compact(sorted({bmu_id for written in results.values() if written for bmu_id in written}))
+    return results
+
+
 if __name__ == "__main__":
 
     # bmus = helpers.get_list_of_bmu_ids_from_custom_windfarm_csv()
-    # for bmu in bmus:
+    # bmu_objs = [BMU(bmu) for bmu in bmus]
+    # update_gen_data_by_date(bmu_objs)
+    # for bmu_obj in bmu_objs:
     #     try:
-    #         bmu_obj = BMU(bmu, update=True)
     #         bmu_obj.get_all_gen_data()
     #     except Exception as e:
-    #         print(f"Error processing {bmu}: {e}")
+    #         print(f"Error processing {bmu_obj.bmu_id}: {e}")
     #     finally:
     #         bmu_obj.plot_data_coverage()
 
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+
+import pandas as pd
+
+import utils.atomic_files as atomic_files
+
+# A preprocessed parquet file which is updated by appending, rather than rewritten on every run:
+#
+#     <name>.parquet                     the compacted base, readable on its own
+#     <name>.deltas/delta-<n>.parquet    the rows appended since the last compaction
+#     <name>.manifest.json               the base, the deltas in order and the settlement dates they cover
+#
+# A daily update writes one small delta and the manifest. Readers load the base and the deltas listed
+# in the manifest and merge them. compact() folds the deltas back into the base, it runs on its own
+# once there are MAX_DELTAS of them.
+
+MAX_DELTAS = 30
+
+
+class DeltaStore:
+    """
+    A parquet file with append only delta files and a manifest, see above.
+
+    Args:
+    path (str): The base parquet file.
+    concat (function): Merges a list of DataFrames (the base first, then the deltas in order), defaults to pd.concat.
+    max_deltas (int): The number of deltas at which append() compacts.
+    version: Optional, saved in the manifest by write(). A store written with another version does not exist(),
+        so it is rebuilt when the way the data is derived changes.
+    """
+    def __init__(self, path, concat=None, max_deltas=MAX_DELTAS, version=None):
+        self.path = path
+        self.version = version
+        self.concat = concat if concat is not None else pd.concat
+        self.max_deltas = max_deltas
+        root, _ = os.path.splitext(path)
+        self.deltas_folder_path = root + '.deltas'
+        self.manifest_path = root + '.manifest.json'
+        self._lock = threading.RLock()
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r') as f:
+                    self._manifest = json.load(f)
+            else:
+                self._manifest = {'base': None, 'deltas': [], 'dates': [], 'next_delta': 0}
+        return self._manifest
+
+    def has_manifest(self):
+        return os.path.exists(self.manifest_path)
+
+    def exists(self):
+        manifest = self.manifest
+        if manifest.get('version') != self.version:
+            return False
+        return manifest['base'] is not None or bool(manifest['deltas'])
+
+    def dates(self):
+        """
+        Returns the set of settlement dates ('%Y-%m-%d') in the base and the deltas.
+        """
+        return set(self.manifest['dates'])
+
+    def _files(self):
+        manifest = self.manifest
+        files = [self.path] if manifest['base'] is not None else []
+        files.extend(os.path.join(self.deltas_folder_path, delta) for delta in manifest['deltas'])
+        return files
+
+    def read(self, columns=None):
+        """
+        Loads the base and the deltas, merged with `concat`. None if nothing has been written.
+        """
+        files = self._files()
+        if not files:
+            return None
+        try:
+            dfs = [pd.read_parquet(file, columns=columns) for file in files]
+        except FileNotFoundError:
+            # the deltas were compacted while we were reading, the new manifest lists the base only
+            self._manifest = None
+            return self.read(columns)
+        if len(dfs) == 1:
+            return dfs[0]
+        return self.concat(dfs)
+
+    def write(self, df, dates):
+        """
+        Replaces the base with `df`, covering `dates`, and drops the deltas.
+        """
+        with self._lock:
+            old_deltas = list(self.manifest['deltas'])
+            atomic_files.write_parquet_atomic(df, self.path)
+            manifest = dict(self.manifest, base=os.path.basename(self.path), deltas=[], dates=sorted(set(dates)), version=self.version)
+            atomic_files.write_json_atomic(manifest, self.manifest_path)
+            self._manifest = manifest
+            # the manifest no longer lists them, so readers will not look for them
+            for delta in old_deltas:
+                os.remove(os.path.join(self.deltas_folder_path, delta))
+
+    def append(self, df, dates):
+        """
+        Writes `df` as a new delta covering `dates`, compacting if there are max_deltas deltas.
+        """
+        with self._lock:
+            os.makedirs(self.deltas_folder_path, exist_ok=True)
+            manifest = self.manifest
+            delta = f"delta-{manifest['next_delta']:05d}.parquet"
+            # the delta is only read once the manifest lists it
+            atomic_files.write_parquet_atomic(df, os.path.join(self.deltas_folder_path, delta))
+            manifest = dict(manifest, deltas=manifest['deltas'] + [delta],
+                            dates=sorted(set(manifest['dates']) | set(dates)), next_delta=manifest['next_delta'] + 1)
+            atomic_files.write_json_atomic(manifest, self.manifest_path)
+            self._manifest = manifest
+        if len(manifest['deltas']) >= self.max_deltas:
+            self.compact()
+
+    def adopt(self, dates):
+        """
+        Writes a manifest for a base file written before there were manifests, covering `dates`.
+        """
+        with self._lock:
+            manifest = {'base': os.path.basename(self.path), 'deltas': [], 'dates': sorted(set(dates)), 'next_delta': 0, 'version': self.version}
+            atomic_files.write_json_atomic(manifest, self.manifest_path)
+            self._manifest = manifest
+
+    def compact(self):
+        """
+        Folds the deltas into the base.
+        """
+        with self._lock:
+            if not self.manifest['deltas']:
+                return
+            self.write(self.read(), self.manifest['dates'])
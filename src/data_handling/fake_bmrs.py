@@ -0,0 +1,216 @@
+import asyncio
+import collections
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_handling.ingest as ingest
+import data_handling.parsers as parsers
+import data_handling.response_cache as response_cache
+import data_handling.settlement as settlement
+import utils.fake_server as fake_server
+
+# A local stand-in for api.bmreports.com/BMRS, serving synthetic B1610 and DERBMDATA csv in the same
+# layout as the real API, with configurable latency, server errors and 429s. The data for a date and
+# BMU is always the same for the same seed, so runs can be compared. To point the code at it, set
+#
+#     [bmrs]
+#     base_url = http://127.0.0.1:<port>/BMRS
+#
+# in config.ini, or run this file for an ingest benchmark against it.
+
+B1610_HEADER = ('*Document Type,Business Type,Process Type,Time Series ID,Quantity (MW),Curve Type,Resolution,'
+                'Settlement Date,SP,Power System Resource Type,Registered Resource EIC Code,Market Generation Unit EIC Code,'
+                'Market Generation BMU ID,Market Generation NGC BM Unit ID,BM Unit ID,NGC BM Unit ID,Active Flag,Document ID,Document RevNum')
+
+
+def get_synthetic_bmu_ids(n_bmus):
+    return [f'SYN{i:03d}-1' for i in range(n_bmus)]
+
+
+def _rng(seed, *keys):
+    return np.random.default_rng([seed, zlib.crc32('|'.join(keys).encode())])
+
+
+def generate_b1610(date_string, bmu_ids, seed=0):
+    """
+    Returns a B1610 csv response for `date_string`, with one row per BMU and settlement period.
+    """
+    n_periods = settlement.get_settlement_periods(date_string)
+    periods = range(1, n_periods + 1)
+    lines = ['HDR,ACTUAL GENERATION OUTPUT PER GENERATION UNIT', B1610_HEADER]
+    for bmu_id in bmu_ids:
+        capacity = _rng(seed, bmu_id).uniform(20, 500)
+        rng = _rng(seed, bmu_id, date_string)
+        # a load factor which wanders through the day
+        load_factor = np.clip(rng.uniform(0, 1) + np.cumsum(rng.normal(0, 0.08, n_periods)), 0, 1)
+        eic = f'48W00000{bmu_id}'
+        template = (f'Actual generation,Production,Realised,NGET-EMFIP-AGPT-TS-%08d,%.3f,Sequential fixed size block,PT30M,'
+                    f'{date_string},%d,Generation,{eic},{eic},T_{bmu_id},{bmu_id},T_{bmu_id},{bmu_id},Y,NGET-EMFIP-AGPT-{seed:08d},1')
+        lines.extend(template % (sp, quantity, sp) for sp, quantity in zip(periods, (load_factor * capacity).tolist()))
+    lines.append(f'FTR,{len(lines) - 2}')
+    return '\n'.join(lines) + '\n'
+
+
+def generate_derbmdata(date_string, bmu_ids, seed=0, bid_rate=0.05, offer_rate=0.01):
+    """
+    Returns a DERBMDATA csv response for `date_string`. A fraction of the BMU settlement periods have
+    accepted bids (BAV, negative volumes, i.e. curtailment) or offers (OAV), and every BMU has an indicative
+    period volume (IPBV) record, which the parser skips.
+    """
+    n_periods = settlement.get_settlement_periods(date_string)
+    rng = _rng(seed, 'DERBMDATA', date_string)
+    bids = rng.random((len(bmu_ids), n_periods)) < bid_rate
+    offers = rng.random((len(bmu_ids), n_periods)) < offer_rate
+    volumes = rng.uniform(1, 100, (len(bmu_ids), n_periods))
+    # the accepted volume of a period is all in one of the 15 bid-offer pairs
+    pairs = rng.integers(0, 15, (len(bmu_ids), n_periods))
+    empty_pairs = ','.join(['0.000'] * 15)
+
+    def pair_volumes(volume, pair):
+        return ','.join(f'{volume:.3f}' if i == pair else '0.000' for i in range(15))
+
+    lines = ['HDR,DERIVED BM UNIT DATA']
+    for i, bmu_id in enumerate(bmu_ids):
+        for sp in range(1, n_periods + 1):
+            volume = volumes[i, sp - 1]
+            pair = pairs[i, sp - 1]
+            lines.append(f'IPBV,T_{bmu_id},{sp},{empty_pairs},{volume:.3f}')
+            if bids[i, sp - 1]:
+                lines.append(f'BAV,T_{bmu_id},{sp},{pair_volumes(-volume, pair)},{-volume:.3f}')
+            if offers[i, sp - 1]:
+                lines.append(f'OAV,T_{bmu_id},{sp},{pair_volumes(volume, pair)},{volume:.3f}')
+    lines.append(f'FTR,{len(lines) - 1}')
+    return '\n'.join(lines) + '\n'
+
+
+class FakeBMRSServer(fake_server.BackgroundServer):
+    """
+    Serves /BMRS/B1610/v2 and /BMRS/DERBMDATA/v1 from the generators above, in a background thread.
+    Responses have an ETag and a matching If-None-Match gets a 304.
+
+    Args:
+    host (str): The interface to listen on.
+    port (int): 0 picks a free port, see `url`.
+    latency (float): The mean of the (exponential) delay before each response, in seconds.
+    error_rate (float): The fraction of requests answered with a 503.
+    throttle_rate (float): The fraction of requests answered with a 429 and a Retry-After header.
+    max_rate (float): Optional, requests beyond this many in any second are answered with a 429, as a real API would.
+    n_bmus (int): The number of synthetic BMUs.
+    seed (int): The seed of the synthetic data, and of the latency and errors.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, error_rate=0.0, throttle_rate=0.0, max_rate=None, n_bmus=400, seed=0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rate = max_rate
+        self.bmu_ids = get_synthetic_bmu_ids(n_bmus)
+        self.seed = seed
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0, 'not_modified': 0}
+        self._rng = np.random.default_rng(seed)
+        self._recent = collections.deque()
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/BMRS'
+
+    def _b1610(self, date_string, query):
+        bmu_id = query.get('NGCBMUnitID', '*')
+        bmu_ids = self.bmu_ids if bmu_id == '*' else [b for b in self.bmu_ids if b == bmu_id]
+        return generate_b1610(date_string, bmu_ids, self.seed)
+
+    def _derbmdata(self, date_string, query):
+        return generate_derbmdata(date_string, self.bmu_ids, self.seed)
+
+    def _over_max_rate(self):
+        if self.max_rate is None:
+            return False
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= 1:
+            self._recent.popleft()
+        if len(self._recent) >= self.max_rate:
+            return True
+        self._recent.append(now)
+        return False
+
+    async def _respond(self, request, generate):
+        self.stats['requests'] += 1
+        if self._over_max_rate():
+            self.stats['throttled'] += 1
+            return web.Response(status=429, text='Too Many Requests', headers={'Retry-After': '1'})
+        if self.latency:
+            await asyncio.sleep(self._rng.exponential(self.latency))
+        draw = self._rng.random()
+        if draw < self.throttle_rate:
+            self.stats['throttled'] += 1
+            return web.Response(status=429, text='Too Many Requests', headers={'Retry-After': '1'})
+        if draw < self.throttle_rate + self.error_rate:
+            self.stats['errors'] += 1
+            return web.Response(status=503, text='Service Unavailable')
+        if 'APIKey' not in request.query:
+            return web.Response(status=403, text='APIKey is required')
+        try:
+            date_string = pd.Timestamp(request.query['SettlementDate']).strftime('%Y-%m-%d')
+        except (KeyError, ValueError):
+            return web.Response(status=400, text='SettlementDate is required')
+
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(None, generate, date_string, request.query)
+        etag = '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            self.stats['not_modified'] += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=body, content_type='text/csv', headers={'ETag': etag})
+
+    async def _handle_b1610(self, request):
+        return await self._respond(request, self._b1610)
+
+    async def _handle_derbmdata(self, request):
+        return await self._respond(request, self._derbmdata)
+
+    def _add_routes(self, router):
+        router.add_get('/BMRS/B1610/v2', self._handle_b1610)
+        router.add_get('/BMRS/DERBMDATA/v1', self._handle_derbmdata)
+
+
+def _count_b1610_rows(raw_path):
+    try:
+        return parsers.parse_b1610(raw_path).num_rows
+    finally:
+        os.remove(raw_path)
+
+
+def benchmark(n_dates=200, max_concurrency=32, **server_kwargs):
+    """
+    Downloads and parses `n_dates` wildcard B1610 responses from a FakeBMRSServer twice, through a fresh
+    response cache, and prints the throughput of each run. The dates are settled, so the second run
+    should be served from the cache.
+    """
+    end_date = pd.to_datetime('today').floor('D') - pd.Timedelta(days=response_cache.SETTLED_AFTER_DAYS + 1)
+    dates = pd.date_range(end=end_date, periods=n_dates, freq='1D').strftime('%Y-%m-%d')
+    with FakeBMRSServer(**server_kwargs) as server, tempfile.TemporaryDirectory() as tmp_folder:
+        cache = response_cache.ResponseCache(os.path.join(tmp_folder, 'response_cache'))
+        for run in ['cold', 'cached']:
+            jobs = [
+                ingest.IngestJob(date_string,
+                                 f"{server.url}/B1610/v2?APIKey=fake&SettlementDate={date_string}&Period=*&NGCBMUnitID=*&ServiceType=csv",
+                                 os.path.join(tmp_folder, 'raw', f'{date_string}.csv'), _count_b1610_rows)
+                for date_string in dates
+            ]
+            engine = ingest.IngestEngine(max_concurrency=max_concurrency, report_every=0, cache=cache)
+            results = engine.run(jobs)
+            n_rows = sum(result for result in results.values() if result)
+            print(f"{run}: {n_rows} rows parsed, server: {server.stats}")
+
+
+if __name__ == "__main__":
+    benchmark(latency=0.05, error_rate=0.01, max_rate=50)
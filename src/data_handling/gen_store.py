@@ -0,0 +1,173 @@
+import glob
+import os
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Global variable for project root path
+project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# B1610 generation data, stored as a hive partitioned parquet dataset:
+#
+#     data/gen_dataset/bmu=<bmu_id>/year=<yyyy>/month=<m>/part-0.parquet
+#     data/gen_dataset/bmu=<bmu_id>/year=<yyyy>/month=<m>/delta-<yyyy-mm-dd>.parquet
+#
+# The ingester writes one small delta file per BMU and settlement date. compact() merges the deltas
+# of each month into the part file, so a BMU's full history is roughly one file per month and
+# is loaded with a single dataset scan. bmrs.update_gen_data() and update_gen_data_by_date() compact
+# the BMUs they wrote to once their downloads are done.
+
+KEY_COLUMNS = ['Settlement Date', 'SP']
+ROW_GROUP_SIZE = 1024 * 1024
+
+
+def get_dataset_path():
+    return os.path.join(project_root_path, 'data', 'gen_dataset')
+
+
+def _bmu_path(bmu_id):
+    return os.path.join(get_dataset_path(), f'bmu={bmu_id}')
+
+
+def _partition_path(bmu_id, date):
+    return os.path.join(_bmu_path(bmu_id), f'year={date.year}', f'month={date.month}')
+
+
+def write_day(bmu_id, date_string, df):
+    """
+    Writes one settlement date of generation data for a BMU as a delta file.
+
+    Args:
+    bmu_id (str): The BMU ID.
+    date_string (str): The settlement date, '%Y-%m-%d'.
+    df (DataFrame): 'Settlement Date', 'SP' and 'Quantity (MW)' columns.
+    """
+    folder_path = _partition_path(bmu_id, pd.to_datetime(date_string))
+    os.makedirs(folder_path, exist_ok=True)
+    filename = os.path.join(folder_path, f'delta-{date_string}.parquet')
+    table = pa.Table.from_pandas(df[KEY_COLUMNS + ['Quantity (MW)']], preserve_index=False)
+    _write_table(table, filename)
+
+
+def _write_table(table, filename, **kwargs):
+    # write to a hidden file first, files starting with '_' are ignored by dataset discovery
+    tmp_filename = os.path.join(os.path.dirname(filename), '_' + os.path.basename(filename))
+    pq.write_table(table, tmp_filename, **kwargs)
+    os.replace(tmp_filename, filename)
+
+
+def _dedupe(df):
+    # later rows win, compacted data is read before the deltas
+    df = df.drop_duplicates(subset=KEY_COLUMNS, keep='last')
+    return df.sort_values(KEY_COLUMNS).reset_index(drop=True)
+
+
+def read_bmu(bmu_id, dates=None):
+    """
+    Loads the generation data for a BMU with one dataset scan.
+
+    Args:
+    bmu_id (str): The BMU ID.
+    dates (list): Optional, only load these settlement dates ('%Y-%m-%d'), only the
+        matching year/month partitions are read.
+
+    Returns:
+    DataFrame: 'Settlement Date', 'SP' and 'Quantity (MW)' columns, sorted. Empty if there is no data.
+    """
+    bmu_path = _bmu_path(bmu_id)
+    if not os.path.exists(bmu_path):
+        return pd.DataFrame(columns=KEY_COLUMNS + ['Quantity (MW)'])
+    dataset = ds.dataset(bmu_path, format='parquet', partitioning='hive')
+    filter_ = None
+    if dates is not None:
+        dates = pd.to_datetime(pd.Series(list(dates))).drop_duplicates()
+        months = (dates.dt.year * 100 + dates.dt.month).unique().tolist()
+        filter_ = (ds.field('year') * 100 + ds.field('month')).isin(months)
+    # compacted part files first, then the deltas in date order, so _dedupe() keeps the deltas
+    fragments = sorted(dataset.get_fragments(filter=filter_), key=lambda fragment: os.path.basename(fragment.path).replace('part', '0'))
+    if not fragments:
+        return pd.DataFrame(columns=KEY_COLUMNS + ['Quantity (MW)'])
+    files = [fragment.path for fragment in fragments]
+    try:
+        df = ds.dataset(files, format='parquet').to_table(columns=KEY_COLUMNS + ['Quantity (MW)']).to_pandas()
+    except FileNotFoundError:
+        # a delta was compacted while we were reading, the part file has its data now
+        return read_bmu(bmu_id, dates)
+    if dates is not None:
+        df = df[df['Settlement Date'].isin(dates)]
+    return _dedupe(df)
+
+
+def stored_dates(bmu_id):
+    """
+    Returns a sorted list of the settlement dates ('%Y-%m-%d') stored for a BMU.
+    """
+    bmu_path = _bmu_path(bmu_id)
+    if not os.path.exists(bmu_path):
+        return []
+    dataset = ds.dataset(bmu_path, format='parquet', partitioning='hive')
+    dates = dataset.to_table(columns=['Settlement Date']).column('Settlement Date').unique().to_pandas()
+    return sorted(pd.DatetimeIndex(dates).strftime('%Y-%m-%d'))
+
+
+def _compact_partition(folder_path):
+    part_file = os.path.join(folder_path, 'part-0.parquet')
+    delta_files = sorted(glob.glob(os.path.join(folder_path, 'delta-*.parquet')))
+    if not delta_files:
+        return
+    files = [part_file] if os.path.exists(part_file) else []
+    files.extend(delta_files)
+    df = pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+    table = pa.Table.from_pandas(_dedupe(df), preserve_index=False)
+    _write_table(table, part_file, row_group_size=ROW_GROUP_SIZE)
+    # readers may briefly see a delta and the part file together, read_bmu() drops the duplicates
+    for file in delta_files:
+        os.remove(file)
+
+
+def compact(bmu_ids=None):
+    """
+    Merges the delta files of every year/month partition into its part file.
+
+    Args:
+    bmu_ids (list): Optional, only compact these BMUs.
+    """
+    if bmu_ids is None:
+        bmu_paths = glob.glob(os.path.join(get_dataset_path(), 'bmu=*'))
+    else:
+        bmu_paths = [_bmu_path(bmu_id) for bmu_id in bmu_ids]
+    for bmu_path in bmu_paths:
+        for folder_path in glob.glob(os.path.join(bmu_path, 'year=*', 'month=*')):
+            try:
+                _compact_partition(folder_path)
+            except Exception as e:
+                print(f"compact() failed for {folder_path}: {e}")
+
+
+def compact_in_background(bmu_ids=None):
+    """
+    Runs compact() in a daemon thread and returns the thread.
+    """
+    thread = threading.Thread(target=compact, args=(bmu_ids,), daemon=True)
+    thread.start()
+    return thread
+
+
+def migrate_raw_files(bmu_id, raw_folder_path):
+    """
+    Moves the old one parquet per day files (data/raw_gen_data/<bmu>/<date>.parquet) into the dataset.
+    """
+    files = sorted(glob.glob(os.path.join(raw_folder_path, '*.parquet')))
+    for file in files:
+        date_string = os.path.basename(file).split('.')[0]
+        write_day(bmu_id, date_string, pd.read_parquet(file))
+    compact([bmu_id])
+    for file in files:
+        os.remove(file)
+
+
+if __name__ == "__main__":
+    compact()
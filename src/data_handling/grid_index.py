@@ -0,0 +1,82 @@
+import os
+import pickle
+import threading
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+import data_handling.weather_store as weather_store
+
+# Nearest ERA5 node lookups: a haversine BallTree over the nodes of the weather store, built once and
+# pickled next to the node index (weather_store/grid_index.pkl). Nodes are only ever appended to the
+# index, so the tree is rebuilt when the number of nodes has changed.
+
+EARTH_RADIUS_KM = 6371
+
+
+def _to_radians(lats, lons):
+    # the haversine distance is the same for 0 to 360 and -180 to 180 longitudes
+    return np.radians(np.column_stack([np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)]))
+
+
+class GridIndex:
+    """
+    Args:
+    nodes (DataFrame): The node index of the weather store, 'node', 'lat' and 'lon'.
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes.reset_index(drop=True)
+        self.tree = BallTree(_to_radians(self.nodes['lat'], self.nodes['lon']), metric='haversine')
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def query(self, lats, lons):
+        """
+        Finds the nearest node to every location, in one call.
+
+        Returns:
+        DataFrame: 'node', 'lat', 'lon' of the nearest node and 'distance_km', a row per location.
+        """
+        distances, rows = self.tree.query(_to_radians(lats, lons), k=1)
+        nearest = self.nodes.iloc[rows[:, 0]].reset_index(drop=True)
+        nearest['distance_km'] = distances[:, 0] * EARTH_RADIUS_KM
+        return nearest
+
+    def get_nearest_lat_lon(self, lat, lon):
+        nearest = self.query([lat], [lon])
+        return nearest.loc[0, 'lat'], nearest.loc[0, 'lon']
+
+
+def _load(path, nodes):
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            grid_index = pickle.load(f)
+        if len(grid_index) == len(nodes):
+            return grid_index
+    grid_index = GridIndex(nodes)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(grid_index, f)
+    os.replace(tmp_path, path)
+    return grid_index
+
+
+_grid_indexes = {}
+_grid_indexes_lock = threading.Lock()
+
+
+def get_grid_index(store=None):
+    """
+    Returns the GridIndex of a WeatherStore (the default one if None), loaded once per process.
+    """
+    if store is None:
+        store = weather_store.WeatherStore()
+    if len(store.nodes) == 0:
+        raise ValueError(f"The weather store has no nodes: {store.path}")
+    with _grid_indexes_lock:
+        grid_index = _grid_indexes.get(store.path)
+        if grid_index is None or len(grid_index) != len(store.nodes):
+            grid_index = _load(os.path.join(store.path, 'grid_index.pkl'), store.nodes)
+            _grid_indexes[store.path] = grid_index
+        return grid_index
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+
+import utils.http_client as http_client
+
+
+class IngestJob:
+    """
+    A single download: the response body of `url` is streamed to `path`, then
+    `process(path)` is called (in a worker thread) to turn it into something useful.
+
+    Args:
+    key: Any hashable used to report the result of the job, e.g. (bmu_id, date_string).
+    url (str): The endpoint to request.
+    path (str): Where the raw response body is written.
+    process (callable): Optional, takes the raw file path and returns the result of the job,
+        anything falsy counts as a failure.
+
+    Once the job has run, `bytes` is the size of the response body.
+    """
+    def __init__(self, key, url, path, process=None):
+        self.key = key
+        self.url = url
+        self.path = path
+        self.process = process
+        self.bytes = 0
+
+
+class IngestStats:
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.cached = 0
+        self.bytes = 0
+        self.start_time = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return max(time.monotonic() - self.start_time, 1e-9)
+
+    @property
+    def requests_per_second(self):
+        return self.requests / self.elapsed
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed
+
+    def report(self):
+        return (f"{self.requests} requests ({self.failures} failed), {self.cached} from cache, {self.bytes / 1e6:.1f} MB in {self.elapsed:.1f}s: "
+                f"{self.requests_per_second:.1f} req/s, {self.bytes_per_second / 1e6:.2f} MB/s")
+
+
+class IngestEngine:
+    """
+    Downloads many IngestJobs over one shared, keep-alive connection pool.
+
+    A fixed number of workers pull jobs from the same iterator, so at most `max_concurrency`
+    requests are in flight no matter how many BMUs or dates are queued, and jobs can be
+    a generator. `request_budget` caps the number of requests the engine will ever issue,
+    jobs left over once it is spent are not attempted and are missing from the results.
+
+    Args:
+    max_concurrency (int): Number of concurrent requests (and pooled connections).
+    request_budget (int): Optional, the maximum number of requests to issue.
+    chunk_size (int): Size of the chunks streamed from the response to disk.
+    timeout (int): Total timeout for a single request, in seconds.
+    report_every (int): Print progress every `report_every` requests, 0 to disable.
+    on_result (callable): Optional, called with (job, result) as soon as each job finishes,
+        e.g. to record it in the ledger.
+    cache (ResponseCache): Optional, settled responses are served from the cache without a request, others
+        are revalidated with If-None-Match, and every downloaded body is added to it.
+    client (HttpClient): Optional, rate limits and retries the requests, defaults to http_client.get_client().
+        If a host's circuit breaker opens, the engine stops like when the budget is spent.
+    """
+    def __init__(self, max_concurrency=32, request_budget=None, chunk_size=64 * 1024, timeout=120, report_every=1000, on_result=None, cache=None, client=None):
+        self.max_concurrency = max_concurrency
+        self.request_budget = request_budget
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.report_every = report_every
+        self.on_result = on_result
+        self.cache = cache
+        self._stop_reason = None
+        self.client = client if client is not None else http_client.get_client()
+        self.stats = IngestStats()
+
+    def run(self, jobs):
+        """
+        Runs the jobs and returns a dict of {job.key: result}, the result is True or False,
+        or whatever job.process returned.
+        """
+        self.stats = IngestStats()
+        self._stop_reason = None
+        results = asyncio.run(self._run(iter(jobs)))
+        if self._stop_reason is not None:
+            print(f"Ingest stopped: {self._stop_reason}")
+        print(f"Ingest finished: {self.stats.report()}")
+        print(f"HTTP: {self.client.report()}")
+        return results
+
+    def _budget_spent(self):
+        return self.request_budget is not None and self.stats.requests >= self.request_budget
+
+    def _stopped(self):
+        return self._stop_reason is not None or self._budget_spent()
+
+    async def _run(self, jobs):
+        results = {}
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [self._worker(session, jobs, results) for _ in range(self.max_concurrency)]
+            await asyncio.gather(*workers)
+        return results
+
+    async def _worker(self, session, jobs, results):
+        # the iterator is shared between the workers, asyncio runs them on one thread so this is safe
+        for job in jobs:
+            if self._stopped():
+                return
+            try:
+                results[job.key] = await self._fetch(session, job)
+            except http_client.CircuitOpenError as e:
+                # not a failure of the job, leave it (and the rest) for the next run
+                self._stop_reason = e
+                return
+            if self.on_result is not None:
+                self.on_result(job, results[job.key])
+
+    async def _fetch(self, session, job):
+        loop = asyncio.get_running_loop()
+        cached = self.cache.lookup(job.url) if self.cache is not None else None
+        tmp_path = job.path + '.part'
+        try:
+            os.makedirs(os.path.dirname(job.path), exist_ok=True)
+            if cached is not None and cached.settled:
+                await loop.run_in_executor(None, self.cache.copy_to, cached, job.path)
+                self.stats.cached += 1
+            else:
+                await self._download(session, job, cached, tmp_path)
+            if job.process is None:
+                return True
+            ok = await loop.run_in_executor(None, job.process, job.path)
+            if not ok:
+                self.stats.failures += 1
+            return ok
+        except http_client.CircuitOpenError:
+            raise
+        except Exception as e:
+            self.stats.failures += 1
+            print(f"{job.key}: failed to download data: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    async def _download(self, session, job, cached, tmp_path):
+        self.stats.requests += 1
+        if self.report_every and self.stats.requests % self.report_every == 0:
+            print(f"Ingest progress: {self.stats.report()}")
+        loop = asyncio.get_running_loop()
+        headers = self.cache.validators(cached) if self.cache is not None else None
+        async with self.client.get_async(session, job.url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                self.cache.touch(job.url, cached.digest)
+                await loop.run_in_executor(None, self.cache.copy_to, cached, job.path)
+                self.stats.cached += 1
+                return
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    f.write(chunk)
+                    job.bytes += len(chunk)
+                    self.stats.bytes += len(chunk)
+            etag = response.headers.get('ETag')
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache.store, job.url, tmp_path, etag)
+        os.replace(tmp_path, job.path)
@@ -0,0 +1,162 @@
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+import data_handling.grid_index as grid_index
+import data_handling.weather_store as weather_store
+
+# The weather at a wind farm blended from the four ERA5 nodes around it, rather than taken from the
+# nearest one. The weights of every farm are a sparse (farm x node) matrix W, and the series of a batch
+# of farms are one product with the (time x node) array of the nodes they use:
+#
+#     farm values = (A_filled @ W.T) / (~isnull(A) @ W.T)
+#
+# so at each time the weights of the nodes with data are renormalised, e.g. for the months extracted
+# before the surrounding nodes were (see weather.extract_nodes()), which only have the nearest node.
+# The wind direction is not blended, as an angle, but derived from the blended U and V of the whole batch.
+
+METHODS = ('bilinear', 'idw')
+IDW_POWER = 2
+# the ERA5 single levels grid, in degrees
+GRID_STEP = 0.25
+
+
+def _lon_key(lon):
+    return np.round(np.asarray(lon, dtype=float) % 360, 6)
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * grid_index.EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def get_weights(store, lats, lons, method='bilinear'):
+    """
+    Returns the interpolation weights of the locations from the nodes of a WeatherStore.
+    Corners missing from the store are left out and the other weights renormalised, a location
+    with no corner in the store takes its nearest node, and one with a NaN lat or lon has no weights.
+
+    Args:
+    store (WeatherStore): The weather store.
+    lats, lons: The locations, in degrees, either longitude convention.
+    method (str): 'bilinear', or 'idw' (inverse distance squared to the four corners).
+
+    Returns:
+    tuple: (scipy.sparse.csr_matrix (location x column), the node of each column)
+    """
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}, not {method}")
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    nodes = store.nodes
+    lat_step = lon_step = GRID_STEP
+    points = list(zip(np.round(nodes['lat'].to_numpy(), 6), _lon_key(nodes['lon'])))
+    node_index = dict(zip(points, nodes['node']))
+    if len(node_index) < len(points):
+        raise ValueError(f"The weather store has several nodes at the same grid point, update() merges them: {store.path}")
+
+    # the corners of the grid cell of each location, (location x 4)
+    lat0 = np.floor(lats / lat_step) * lat_step
+    lon0 = np.floor(_lon_key(lons) / lon_step) * lon_step
+    x = (_lon_key(lons) - lon0) / lon_step
+    y = (lats - lat0) / lat_step
+    corner_lats = np.column_stack([lat0, lat0, lat0 + lat_step, lat0 + lat_step])
+    corner_lons = np.column_stack([lon0, lon0 + lon_step, lon0, lon0 + lon_step])
+    if method == 'bilinear':
+        weights = np.column_stack([(1 - x) * (1 - y), x * (1 - y), (1 - x) * y, x * y])
+    else:
+        distances = _haversine_km(lats[:, np.newaxis], lons[:, np.newaxis], corner_lats, corner_lons)
+        with np.errstate(divide='ignore'):
+            weights = 1 / distances ** IDW_POWER
+        # a location on a node takes it alone
+        on_node = np.isinf(weights)
+        weights = np.where(on_node.any(axis=1, keepdims=True), on_node.astype(float), weights)
+
+    corner_nodes = np.array([
+        node_index.get(point, -1)
+        for point in zip(np.round(corner_lats, 6).ravel(), _lon_key(corner_lons).ravel())
+    ]).reshape(corner_lats.shape)
+    weights = np.where(corner_nodes >= 0, weights, 0.)
+    totals = weights.sum(axis=1)
+
+    rows, columns, values = [], [], []
+    inside = totals > 0
+    location_rows, corners = np.nonzero(weights * inside[:, np.newaxis])
+    rows.append(location_rows)
+    columns.append(corner_nodes[location_rows, corners])
+    values.append(weights[location_rows, corners] / totals[location_rows])
+    # a location without coordinates gets no weights, so its series are all NaN
+    located = np.isfinite(lats) & np.isfinite(lons)
+    if not inside[located].all():
+        outside = np.flatnonzero(~inside & located)
+        nearest = grid_index.get_grid_index(store).query(lats[outside], lons[outside])
+        rows.append(outside)
+        columns.append(nearest['node'].to_numpy())
+        values.append(np.ones(len(outside)))
+    rows, columns, values = np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+    column_nodes, columns = np.unique(columns, return_inverse=True)
+    matrix = sparse.csr_matrix((values, (rows, columns)), shape=(len(lats), len(column_nodes)))
+    return matrix, column_nodes
+
+
+def _read_node_arrays(store, nodes, variables):
+    # the (time x node) array of each variable, on the union of the nodes' times, reading each node file once
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        node_dfs = list(executor.map(lambda node: store.get_node_data(node, columns=variables), nodes))
+    # a node of the index without a file (e.g. a merged node no month had data for) keeps NaN columns
+    node_times = [df.index.values for df in node_dfs if df is not None]
+    times = pd.DatetimeIndex(np.unique(np.concatenate([np.array([], dtype='datetime64[ns]')] + node_times)), name='utc_time')
+    arrays = {variable: np.full((len(times), len(nodes)), np.nan, dtype=np.float32) for variable in variables}
+    for i, df in enumerate(node_dfs):
+        if df is None:
+            continue
+        rows = times.get_indexer(df.index)
+        for variable in variables:
+            arrays[variable][rows, i] = df[variable].to_numpy()
+    return times, arrays
+
+
+def interpolate(store, weights, column_nodes, variables):
+    """
+    Applies interpolation weights (see get_weights()) to the node series of the store.
+
+    Returns:
+    dict: {variable: DataFrame (utc_time x location)}, NaN where none of a location's nodes has data.
+    """
+    direction_variable = weather_store.WIND_VARIABLES[1]
+    read_variables = [variable for variable in variables if variable != direction_variable]
+    if direction_variable in variables:
+        read_variables += [variable for variable in weather_store.WIND_COMPONENTS if variable not in read_variables]
+    times, arrays = _read_node_arrays(store, column_nodes, read_variables)
+    interpolated = {}
+    for variable, array in arrays.items():
+        has_data = ~np.isnan(array)
+        values = weights @ np.where(has_data, array, 0).T
+        coverage = weights @ has_data.T.astype(np.float32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(coverage > 0, values / coverage, np.nan)
+        interpolated[variable] = pd.DataFrame(values.T.astype(np.float32), index=times)
+    if direction_variable in variables:
+        u, v = (interpolated[variable].to_numpy() for variable in weather_store.WIND_COMPONENTS)
+        _, direction = weather_store.get_wind_speed_and_direction(u, v)
+        interpolated[direction_variable] = pd.DataFrame(direction, index=times)
+    return {variable: interpolated[variable] for variable in variables}
+
+
+def iter_interpolated(store, lats, lons, variables, method='bilinear', batch_size=100):
+    """
+    Yields the interpolated weather of each location in turn, as a DataFrame with a column per variable,
+    `batch_size` locations at a time so only the nodes of one batch are in memory.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    for start in range(0, len(lats), batch_size):
+        batch = slice(start, start + batch_size)
+        weights, column_nodes = get_weights(store, lats[batch], lons[batch], method)
+        interpolated = interpolate(store, weights, column_nodes, variables)
+        for i in range(weights.shape[0]):
+            yield pd.DataFrame({variable: interpolated[variable][i] for variable in variables})
@@ -0,0 +1,137 @@
+import datetime as dt
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+# Global variable for project root path
+project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROCESSED = 'processed'
+FAILED = 'failed'
+
+# DERBMDATA, and B1610 by date, are downloaded for every BMU at once, their rows use this as the BMU
+ALL_BMUS = '*'
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def _parse_dates(concatenated):
+    # a group_concat of fixed width '%Y-%m-%d' dates, parsed as one array rather than a python object per date
+    digits = np.frombuffer((concatenated + ',').encode(), dtype=np.uint8).reshape(-1, 11).astype(np.int32) - ord('0')
+    years = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    months = digits[:, 5] * 10 + digits[:, 6]
+    days = digits[:, 8] * 10 + digits[:, 9]
+    dates = (years - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (months - 1).astype('timedelta64[M]')
+    return dates.astype('datetime64[D]') + (days - 1).astype('timedelta64[D]')
+
+
+def get_ledger(path=None):
+    """
+    Returns the Ledger for `path` (data/ingest_ledger.sqlite by default), one per path and process.
+    """
+    if path is None:
+        path = os.path.join(project_root_path, 'data', 'ingest_ledger.sqlite')
+    with _ledgers_lock:
+        if path not in _ledgers:
+            _ledgers[path] = Ledger(path)
+        return _ledgers[path]
+
+
+class Ledger:
+    """
+    Records every download attempt in SQLite, one row per (source, bmu, date), with its status,
+    the number of attempts, the bytes downloaded and when it was first and last attempted.
+
+    Rows are written one at a time as downloads finish. The database uses WAL mode, so several
+    ingest processes can update it while others read it.
+
+    Args:
+    path (str): The SQLite database file.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS ingest (
+                source TEXT NOT NULL,
+                bmu TEXT NOT NULL,
+                date TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                bytes INTEGER,
+                first_attempted TEXT NOT NULL,
+                last_attempted TEXT NOT NULL,
+                PRIMARY KEY (source, bmu, date)
+            ) WITHOUT ROWID''')
+
+    def record(self, source, bmu, date, processed, n_bytes=None):
+        """
+        Records one attempt to download `date` (a '%Y-%m-%d' string) of `source` for `bmu`.
+        """
+        now = dt.datetime.utcnow().isoformat(timespec='seconds')
+        status = PROCESSED if processed else FAILED
+        with self._lock:
+            self.connection.execute('''
+                INSERT INTO ingest (source, bmu, date, status, attempts, bytes, first_attempted, last_attempted)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT (source, bmu, date) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = ingest.attempts + 1,
+                    bytes = COALESCE(excluded.bytes, ingest.bytes),
+                    last_attempted = excluded.last_attempted''',
+                (source, bmu, date, status, n_bytes, now, now))
+
+    def import_dates(self, source, bmu, processed_dates, attempted_dates=()):
+        """
+        Bulk loads dates from before the ledger (metadata.json files, or the files on disk), in one transaction.
+        Existing rows are left alone.
+        """
+        now = dt.datetime.utcnow().isoformat(timespec='seconds')
+        processed_dates = set(processed_dates)
+        rows = [(source, bmu, date, PROCESSED, now, now) for date in processed_dates]
+        rows.extend((source, bmu, date, FAILED, now, now) for date in set(attempted_dates) - processed_dates)
+        with self._lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('''
+                INSERT OR IGNORE INTO ingest (source, bmu, date, status, first_attempted, last_attempted)
+                VALUES (?, ?, ?, ?, ?, ?)''', rows)
+            self.connection.execute('COMMIT')
+
+    def dates(self, source, bmu=ALL_BMUS, status=None):
+        """
+        Returns the sorted dates attempted for `source` and `bmu`, only those with `status` if given.
+        """
+        query = 'SELECT date FROM ingest WHERE source = ? AND bmu = ?'
+        params = [source, bmu]
+        if status is not None:
+            query += ' AND status = ?'
+            params.append(status)
+        with self._lock:
+            rows = self.connection.execute(query + ' ORDER BY date', params).fetchall()
+        return [row[0] for row in rows]
+
+    def done_dates(self, source, failed_before=None):
+        """
+        Returns {bmu: datetime64[D] array} of the dates of `source` which are done: processed, or
+        failed before `failed_before` (a '%Y-%m-%d' string) if it is given. One query for every BMU.
+        """
+        query = 'SELECT bmu, group_concat(date) FROM ingest WHERE source = ? AND (status = ?'
+        params = [source, PROCESSED]
+        if failed_before is not None:
+            query += ' OR date < ?'
+            params.append(failed_before)
+        with self._lock:
+            rows = self.connection.execute(query + ') GROUP BY bmu', params).fetchall()
+        return {bmu: _parse_dates(dates) for bmu, dates in rows}
+
+    def has_rows(self, source, bmu=ALL_BMUS):
+        with self._lock:
+            row = self.connection.execute('SELECT 1 FROM ingest WHERE source = ? AND bmu = ? LIMIT 1', (source, bmu)).fetchone()
+        return row is not None
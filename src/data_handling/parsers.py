@@ -0,0 +1,134 @@
+import io
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+B1610_BMU_COLUMN = 'NGC BM Unit ID'
+B1610_COLUMNS = ['Settlement Date', 'SP', 'Quantity (MW)', B1610_BMU_COLUMN]
+B1610_TYPES = {
+    'Settlement Date': pa.timestamp('ns'),
+    'SP': pa.int8(),
+    'Quantity (MW)': pa.float64(),
+    B1610_BMU_COLUMN: pa.string(),
+}
+
+# DERBMDATA has no header row, each record is: record type, BMU id, settlement period,
+# the volumes of the 15 bid-offer pairs and the total volume
+DERBMDATA_PAIR_COLUMNS = [f'Pair {i}' for i in range(1, 16)]
+DERBMDATA_COLUMN_NAMES = ['HDR', 'BMU_id', 'Settlement Period'] + DERBMDATA_PAIR_COLUMNS + ['Total']
+DERBMDATA_COLUMNS = ['HDR', 'BMU_id', 'Settlement Period', 'Total']
+DERBMDATA_TYPES = {
+    'HDR': pa.dictionary(pa.int32(), pa.string()),
+    'BMU_id': pa.dictionary(pa.int32(), pa.string()),
+    'Settlement Period': pa.int8(),
+    'Total': pa.float32(),
+}
+DERBMDATA_TYPES.update({col: pa.float32() for col in DERBMDATA_PAIR_COLUMNS})
+
+BLOCK_SIZE = 1 << 20
+
+
+def _skip_invalid_row(row):
+    # HDR and FTR lines have a different number of fields to the data
+    return 'skip'
+
+
+class _LineFilter(io.RawIOBase):
+    """
+    A read only stream which passes on only the lines of `stream` starting with one of `prefixes`,
+    so other record types never reach the typed csv reader.
+    """
+    def __init__(self, stream, prefixes, chunk_size=BLOCK_SIZE):
+        self.stream = stream
+        self.prefixes = tuple(prefixes)
+        self.chunk_size = chunk_size
+        self._buffer = b''
+        self._remainder = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._eof:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                self._eof = True
+                lines = [self._remainder]
+            else:
+                lines = (self._remainder + chunk).split(b'\n')
+                self._remainder = lines.pop()
+            self._buffer = b''.join(line + b'\n' for line in lines if line.startswith(self.prefixes))
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def _open(source):
+    if isinstance(source, (str, bytes)) or hasattr(source, '__fspath__'):
+        return open(source, 'rb')
+    return source
+
+
+def _read_batches(stream, schema, read_options, parse_options, convert_options):
+    try:
+        reader = pa_csv.open_csv(stream, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+    except pa.ArrowInvalid:
+        # nothing to parse, e.g. a response with only a header
+        return schema.empty_table()
+    return pa.Table.from_batches(list(reader), schema=reader.schema)
+
+
+def parse_b1610(source):
+    """
+    Parses a B1610 csv response into a typed arrow Table, only the B1610_COLUMNS are converted.
+
+    Args:
+    source: A file path or a binary file-like object, e.g. a streamed response body.
+
+    Returns:
+    pyarrow.Table: 'Settlement Date', 'SP', 'Quantity (MW)' and the BMU id column.
+    """
+    schema = pa.schema([(col, B1610_TYPES[col]) for col in B1610_COLUMNS])
+    read_options = pa_csv.ReadOptions(skip_rows=1, block_size=BLOCK_SIZE)
+    parse_options = pa_csv.ParseOptions(invalid_row_handler=_skip_invalid_row)
+    convert_options = pa_csv.ConvertOptions(column_types=B1610_TYPES, include_columns=B1610_COLUMNS, include_missing_columns=True)
+    stream = _open(source)
+    try:
+        return _read_batches(stream, schema, read_options, parse_options, convert_options)
+    finally:
+        if stream is not source:
+            stream.close()
+
+
+def parse_derbmdata(source, record_types=('BAV', 'OAV'), columns=DERBMDATA_COLUMNS):
+    """
+    Parses a DERBMDATA csv response into a typed arrow Table. Only the lines of `record_types`
+    are parsed, and only `columns` are converted.
+
+    Args:
+    source: A file path or a binary file-like object, e.g. a streamed response body.
+    record_types (tuple): The record types (the HDR field) to keep.
+    columns (list): The columns to keep, from DERBMDATA_COLUMN_NAMES.
+
+    Returns:
+    pyarrow.Table
+    """
+    schema = pa.schema([(col, DERBMDATA_TYPES[col]) for col in columns])
+    prefixes = [f'{record_type},'.encode() for record_type in record_types]
+    read_options = pa_csv.ReadOptions(column_names=DERBMDATA_COLUMN_NAMES, block_size=BLOCK_SIZE)
+    parse_options = pa_csv.ParseOptions(invalid_row_handler=_skip_invalid_row)
+    convert_options = pa_csv.ConvertOptions(column_types=DERBMDATA_TYPES, include_columns=list(columns))
+    stream = _open(source)
+    try:
+        filtered = io.BufferedReader(_LineFilter(stream, prefixes), buffer_size=BLOCK_SIZE)
+        return _read_batches(filtered, schema, read_options, parse_options, convert_options)
+    finally:
+        if stream is not source:
+            stream.close()
+
+
+def filter_record_type(table, record_type):
+    return table.filter(pc.equal(table['HDR'].cast(pa.string()), record_type))
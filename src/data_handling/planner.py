@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+import data_handling.ledger as ledger
+
+FIRST_DATE = pd.Timestamp('2017-01-01')
+
+PLAN_COLUMNS = ['source', 'bmu', 'start', 'end', 'n_days']
+
+
+def _find_gaps(done):
+    """
+    Finds the runs of False in each row of the 2-D boolean array `done`.
+
+    Returns:
+    tuple: (row, start, end) arrays, `end` is inclusive.
+    """
+    padded = np.zeros((done.shape[0], done.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = ~done
+    edges = np.diff(padded, axis=1)
+    # np.nonzero works row by row, so the starts and ends of each row line up
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends - 1
+
+
+def plan_updates(source, bmus, start_date=None, end_date=None, retry_after_days=None, redo=False, ledger_=None):
+    """
+    Works out which dates are still to be downloaded for every BMU of a source at once, from one
+    read of the ledger, and returns them as contiguous ranges.
+
+    A date is done if it has been processed. If `retry_after_days` is given, failed dates which are
+    older than that are also done, so only recent failures (where the data may not have been available yet) are retried.
+
+    Args:
+    source (str): The ledger source, e.g. 'B1610'.
+    bmus (list): The BMUs to plan for (ledger.ALL_BMUS for DERBMDATA).
+    start_date, end_date: Optional date range, defaults to 2017-01-01 until yesterday.
+    retry_after_days (int): Optional, see above.
+    redo (bool): If True, every date in the range is planned.
+    ledger_ (Ledger): Optional, defaults to ledger.get_ledger().
+
+    Returns:
+    DataFrame: one row per range with PLAN_COLUMNS, in priority order: the most recent ranges first,
+        then the longest, so a daily refresh is done before a backfill.
+    """
+    today = pd.to_datetime('today').floor('D')
+    start_date = FIRST_DATE if start_date is None else pd.to_datetime(start_date)
+    end_date = today - pd.Timedelta(days=1) if end_date is None else pd.to_datetime(end_date)
+    bmus = list(dict.fromkeys(bmus))
+    n_days = (end_date - start_date).days + 1
+    if n_days <= 0 or not bmus:
+        return pd.DataFrame(columns=PLAN_COLUMNS)
+
+    done = np.zeros((len(bmus), n_days), dtype=bool)
+    if not redo:
+        if ledger_ is None:
+            ledger_ = ledger.get_ledger()
+        failed_before = None
+        if retry_after_days is not None:
+            failed_before = (today - pd.Timedelta(days=retry_after_days)).strftime('%Y-%m-%d')
+        done_dates = ledger_.done_dates(source, failed_before)
+        start_day = np.datetime64(start_date.date(), 'D')
+        for row, bmu in enumerate(bmus):
+            if bmu not in done_dates:
+                continue
+            days = (done_dates[bmu] - start_day).astype(np.int64)
+            done[row, days[(days >= 0) & (days < n_days)]] = True
+
+    rows, starts, ends = _find_gaps(done)
+    plan = pd.DataFrame({
+        'source': source,
+        'bmu': np.asarray(bmus, dtype=object)[rows],
+        'start': start_date + pd.to_timedelta(starts, unit='D'),
+        'end': start_date + pd.to_timedelta(ends, unit='D'),
+        'n_days': ends - starts + 1,
+    }, columns=PLAN_COLUMNS)
+    return plan.sort_values(['end', 'n_days'], ascending=False, kind='stable').reset_index(drop=True)
+
+
+def iter_dates(plan):
+    """
+    Yields (bmu, date_string) for every date in the plan, in priority order, latest date first within a range.
+    """
+    for bmu, start, end in zip(plan['bmu'], plan['start'], plan['end']):
+        for date in pd.date_range(start, end, freq='1D')[::-1]:
+            yield bmu, date.strftime('%Y-%m-%d')
+
+
+def summary(plan):
+    return f"{len(plan)} ranges, {int(plan['n_days'].sum())} days for {plan['bmu'].nunique()} BMUs"
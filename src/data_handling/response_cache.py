@@ -0,0 +1,187 @@
+import datetime as dt
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import utils.http_client as http_client
+
+# Global variable for project root path
+project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Raw BMRS responses, stored by the sha256 of their body:
+#
+#     data/response_cache/objects/<ab>/<sha256>    one file per distinct body
+#     data/response_cache/index.sqlite             request (the url without the API key) -> body, ETag, fetch date
+#
+# A settlement date can still be revised for a while afterwards (see bmrs.GEN_DATA_RETRY_AFTER_DAYS), so only
+# responses fetched at least SETTLED_AFTER_DAYS after their SettlementDate are reused without a request.
+# Newer ones are revalidated with If-None-Match, and a body which has not changed is stored once.
+
+SETTLED_AFTER_DAYS = 50
+
+CachedResponse = namedtuple('CachedResponse', ['digest', 'path', 'etag', 'settled'])
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(path=None):
+    """
+    Returns the ResponseCache for the folder `path` (data/response_cache by default), one per path and process.
+    """
+    if path is None:
+        path = os.path.join(project_root_path, 'data', 'response_cache')
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(path)
+        return _caches[path]
+
+
+def _link_or_copy(src, dst):
+    tmp_dst = f'{dst}.{uuid.uuid4().hex}.part'
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def _file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _days_between(date_string, fetched):
+    try:
+        return (dt.date.fromisoformat(fetched[:10]) - dt.date.fromisoformat(date_string[:10])).days
+    except ValueError:
+        return None
+
+
+class ResponseCache:
+    """
+    A content addressed cache of raw BMRS responses, see above.
+
+    Args:
+    path (str): The cache folder.
+    settled_after_days (int): How long after its SettlementDate a response is final.
+    """
+    def __init__(self, path, settled_after_days=SETTLED_AFTER_DAYS):
+        self.path = path
+        self.objects_path = os.path.join(path, 'objects')
+        self.settled_after_days = settled_after_days
+        os.makedirs(self.objects_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                request TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                etag TEXT,
+                fetched TEXT NOT NULL
+            ) WITHOUT ROWID''')
+
+    @staticmethod
+    def request_key(url):
+        # the API key is not part of the request, so it can change without emptying the cache
+        parts = urlsplit(url)
+        query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key.lower() != 'apikey']
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query, safe='*'), ''))
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def _is_settled(self, request, fetched):
+        query = dict(parse_qsl(urlsplit(request).query))
+        if 'SettlementDate' not in query:
+            return False
+        age = _days_between(query['SettlementDate'], fetched)
+        return age is not None and age >= self.settled_after_days
+
+    def lookup(self, url):
+        """
+        Returns the CachedResponse for `url`, or None.
+        """
+        request = self.request_key(url)
+        with self._lock:
+            row = self.connection.execute('SELECT digest, etag, fetched FROM responses WHERE request = ?', (request,)).fetchone()
+        if row is None:
+            return None
+        digest, etag, fetched = row
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            return None
+        return CachedResponse(digest, path, etag, self._is_settled(request, fetched))
+
+    def store(self, url, file_path, etag=None):
+        """
+        Adds the response body in `file_path` as the response for `url`, the file is left in place.
+
+        Returns:
+        CachedResponse
+        """
+        digest = _file_digest(file_path)
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _link_or_copy(file_path, path)
+        self.touch(url, digest, etag)
+        request = self.request_key(url)
+        return CachedResponse(digest, path, etag, self._is_settled(request, dt.date.today().isoformat()))
+
+    def touch(self, url, digest, etag=None):
+        """
+        Records that the response for `url` was (re)fetched today with body `digest`.
+        """
+        with self._lock:
+            self.connection.execute('''
+                INSERT INTO responses (request, digest, etag, fetched) VALUES (?, ?, ?, ?)
+                ON CONFLICT (request) DO UPDATE SET
+                    digest = excluded.digest,
+                    etag = COALESCE(excluded.etag, responses.etag),
+                    fetched = excluded.fetched''',
+                (self.request_key(url), digest, etag, dt.date.today().isoformat()))
+
+    def validators(self, cached):
+        """
+        Returns the headers for a conditional request which revalidates `cached` (a CachedResponse or None).
+        """
+        if cached is None or not cached.etag:
+            return {}
+        return {'If-None-Match': cached.etag}
+
+    def copy_to(self, cached, path):
+        _link_or_copy(cached.path, path)
+
+    def fetch(self, url, session=None, chunk_size=64 * 1024):
+        """
+        Returns the CachedResponse for `url`, from the cache if it is settled or has not changed, otherwise it is downloaded.
+        """
+        cached = self.lookup(url)
+        if cached is not None and cached.settled:
+            return cached
+        session = session if session is not None else http_client.get_client()
+        tmp_path = os.path.join(self.objects_path, f'download-{uuid.uuid4().hex}.part')
+        try:
+            with session.get(url, headers=self.validators(cached), stream=True) as response:
+                if response.status_code == 304 and cached is not None:
+                    self.touch(url, cached.digest)
+                    return cached
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+            return self.store(url, tmp_path, response.headers.get('ETag'))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
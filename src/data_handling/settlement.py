@@ -0,0 +1,101 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+# Settlement period 1 starts at midnight UK time on the settlement date, so a day has 46 periods when the
+# clocks go forward, 50 when they go back and 48 otherwise, and in BST period 1 starts at 23:00 UTC the day
+# before. The start of each settlement date, in half hours since 1970-01-01 UTC, and its number of periods
+# are precomputed once, and a whole column of (date, period) is turned into UTC with one gather.
+
+FIRST_DATE = pd.Timestamp('2017-01-01')
+LAST_DATE = pd.Timestamp('2050-12-31')
+TIMEZONE = 'Europe/London'
+
+PERIOD_NS = 30 * 60 * 10**9
+FIRST_DAY = int(FIRST_DATE.value // (24 * 60 * 60 * 10**9))
+
+# saved with the files holding utc_time derived from settlement periods, so the ones
+# written before clock changes were handled (a naive date + (SP - 1) * 30 minutes) are rebuilt
+UTC_TIME_VERSION = 2
+
+
+@functools.lru_cache(maxsize=None)
+def get_lookup_table():
+    """
+    Returns:
+    tuple: (start, n_periods) arrays indexed by days since FIRST_DATE, the first half hour of each
+        settlement date since 1970-01-01 UTC (int64), and its number of settlement periods (int8).
+    """
+    days = pd.date_range(FIRST_DATE, LAST_DATE + pd.Timedelta(days=1), freq='1D')
+    midnights = days.tz_localize(TIMEZONE).tz_convert('UTC')
+    slots = midnights.asi8 // PERIOD_NS
+    return slots[:-1], np.diff(slots).astype(np.int8)
+
+
+def _day_index(dates):
+    dates = np.asarray(dates)
+    if np.issubdtype(dates.dtype, np.integer):
+        # day numbers since 1970-01-01, as in volume_store
+        days = dates.astype(np.int64)
+    else:
+        days = pd.DatetimeIndex(dates).values.astype('datetime64[D]').astype(np.int64)
+    index = days - FIRST_DAY
+    start, _ = get_lookup_table()
+    if len(index) and (index.min() < 0 or index.max() >= len(start)):
+        raise ValueError(f"Settlement dates must be between {FIRST_DATE.date()} and {LAST_DATE.date()}")
+    return index
+
+
+def to_slots(dates, periods):
+    """
+    Converts settlement dates and periods to half hours since 1970-01-01 UTC.
+
+    Args:
+    dates: Settlement dates, datetime-like, or int day numbers since 1970-01-01.
+    periods: Settlement periods, from 1.
+
+    Returns:
+    ndarray: int64, -1 where the period does not exist on its date.
+    """
+    index = _day_index(dates)
+    periods = np.asarray(periods, dtype=np.int64)
+    start, n_periods = get_lookup_table()
+    valid = (periods >= 1) & (periods <= n_periods[index])
+    return np.where(valid, start[index] + periods - 1, -1)
+
+
+def to_utc(dates, periods):
+    """
+    Converts settlement dates and periods to UTC times, the start of each period.
+
+    Args:
+    dates: Settlement dates, datetime-like, or int day numbers since 1970-01-01.
+    periods: Settlement periods, from 1.
+
+    Returns:
+    DatetimeIndex: naive UTC times, NaT where the period does not exist on its date.
+    """
+    slots = to_slots(dates, periods)
+    values = np.where(slots >= 0, slots * PERIOD_NS, np.iinfo(np.int64).min)
+    return pd.DatetimeIndex(values.view('datetime64[ns]'))
+
+
+def slots_to_utc(slots):
+    return pd.DatetimeIndex((np.asarray(slots, dtype=np.int64) * PERIOD_NS).view('datetime64[ns]'))
+
+
+def get_first_slot(date):
+    """
+    Returns the first half hour of settlement date `date`, since 1970-01-01 UTC.
+    """
+    start, _ = get_lookup_table()
+    return int(start[_day_index([pd.Timestamp(date)])[0]])
+
+
+def get_settlement_periods(date):
+    """
+    Returns the number of settlement periods on `date`: 46, 48 or 50.
+    """
+    _, n_periods = get_lookup_table()
+    return int(n_periods[_day_index([pd.Timestamp(date)])[0]])
@@ -0,0 +1,191 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import data_handling.settlement as settlement
+import data_handling.volume_store as volume_store
+import utils.atomic_files as atomic_files
+
+# Global variable for project root path
+project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Accepted bid (BAV) and offer (OAV) volumes of every BMU, as a (time x BMU x {BAV, OAV}) float32 array
+# on the UTC half hour grid, memory mapped from one file per settlement year:
+#
+#     data/preprocessed_data/volume_cube/<year>.f32    (BMU, half hour of the year, kind)
+#     data/preprocessed_data/volume_cube/index.json    the BMU of each row, and the settlement dates loaded
+#
+# Each year is stored BMU-major, so the history of one BMU is one contiguous read per year, and a BMU
+# seen for the first time is appended to the end of the files. Zero means no accepted volume.
+
+KINDS = ['BAV', 'OAV']
+BMU_CHUNK = 256
+
+
+def get_cube_path():
+    return os.path.join(project_root_path, 'data', 'preprocessed_data', 'volume_cube')
+
+
+class VolumeCube:
+    """
+    See above. BMUs can be looked up by their Elexon id ('T_ABRBO-1') or their NGC id ('ABRBO-1').
+
+    Args:
+    path (str): Optional, the cube folder, defaults to get_cube_path().
+    """
+    def __init__(self, path=None):
+        self.path = path if path is not None else get_cube_path()
+        self.index_path = os.path.join(self.path, 'index.json')
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'bmus': [], 'capacity': 0, 'dates': []}
+        self.codes = {}
+        self.aliases = {}
+        for code, bmu_id in enumerate(self.index['bmus']):
+            self._add_code(bmu_id, code)
+        self._arrays = {}
+
+    def _add_code(self, bmu_id, code):
+        self.codes[bmu_id] = code
+        self.aliases.setdefault(volume_store.get_ngc_bmu_id(bmu_id), []).append(code)
+
+    def __contains__(self, bmu_id):
+        return bmu_id in self.codes or bmu_id in self.aliases
+
+    @property
+    def bmu_ids(self):
+        return list(self.index['bmus'])
+
+    def dates(self):
+        return set(self.index['dates'])
+
+    def years(self):
+        return sorted({int(date[:4]) for date in self.index['dates']})
+
+    def _year_path(self, year):
+        return os.path.join(self.path, f'{year}.f32')
+
+    @staticmethod
+    def _year_slots(year):
+        first_slot = settlement.get_first_slot(f'{year}-01-01')
+        return first_slot, settlement.get_first_slot(f'{year + 1}-01-01') - first_slot
+
+    def _open(self, year, mode='r'):
+        key = (year, mode)
+        if key not in self._arrays:
+            _, n_slots = self._year_slots(year)
+            path = self._year_path(year)
+            size = self.index['capacity'] * n_slots * len(KINDS) * 4
+            if mode != 'r' and (not os.path.exists(path) or os.path.getsize(path) < size):
+                # new space in the file reads as zeros
+                with open(path, 'ab') as f:
+                    f.truncate(size)
+            self._arrays[key] = np.memmap(path, dtype=np.float32, mode=mode, shape=(self.index['capacity'], n_slots, len(KINDS)))
+        return self._arrays[key]
+
+    def _close(self):
+        for array in self._arrays.values():
+            if array.mode != 'r':
+                array.flush()
+        self._arrays = {}
+
+    def _get_codes(self, bmu_ids):
+        # adds the BMUs seen for the first time, growing the files by BMU_CHUNK rows when needed
+        categories = pd.Categorical(bmu_ids)
+        category_codes = []
+        for bmu_id in categories.categories:
+            if bmu_id not in self.codes:
+                self._add_code(bmu_id, len(self.index['bmus']))
+                self.index['bmus'].append(bmu_id)
+            category_codes.append(self.codes[bmu_id])
+        if len(self.index['bmus']) > self.index['capacity']:
+            self._close()
+            self.index['capacity'] = (len(self.index['bmus']) // BMU_CHUNK + 1) * BMU_CHUNK
+        return np.asarray(category_codes, dtype=np.int64)[categories.codes]
+
+    def update(self, folder_path, dates):
+        """
+        Loads the daily accepted volumes files (<date>_BAV.parquet and <date>_OAV.parquet in `folder_path`)
+        of the `dates` which are not in the cube yet, in one pass.
+
+        Returns:
+        list: The dates loaded.
+        """
+        new_dates = sorted(set(dates) - self.dates())
+        loaded = []
+        try:
+            for date_string in new_dates:
+                year = int(date_string[:4])
+                first_slot, _ = self._year_slots(year)
+                for k, kind in enumerate(KINDS):
+                    filename = os.path.join(folder_path, f'{date_string}_{kind}.parquet')
+                    if not os.path.exists(filename):
+                        continue
+                    df = volume_store.compact_accepted_volumes(pd.read_parquet(filename)).dropna(subset=['BMU_id'])
+                    codes = self._get_codes(df['BMU_id'].astype(str).to_numpy())
+                    slots = settlement.to_slots(df['day'].to_numpy(), df['Settlement Period'].to_numpy())
+                    valid = slots >= 0
+                    array = self._open(year, 'r+')
+                    array[codes[valid], slots[valid] - first_slot, k] = df['Total'].to_numpy()[valid]
+                # only once all its slots are written, so a day which failed is loaded again next time
+                loaded.append(date_string)
+        finally:
+            self.index['dates'] = sorted(self.dates() | set(loaded))
+            if self.index['capacity']:
+                # every year file sized for the BMUs added since it was written
+                for year in self.years():
+                    self._open(year, 'r+')
+            self._close()
+            atomic_files.write_json_atomic(self.index, self.index_path)
+        return loaded
+
+    def _lookup(self, bmu_id):
+        if bmu_id in self.codes:
+            return [self.codes[bmu_id]]
+        return self.aliases.get(bmu_id, [])
+
+    def get(self, bmu_id):
+        """
+        Returns the accepted volumes of `bmu_id` on the half hour UTC grid from the first to the last date loaded,
+        as a DataFrame with a 'BAV' and an 'OAV' column. Zero if the BMU has none, NaN on the dates not loaded,
+        an NGC id sums its Elexon BMUs.
+        """
+        codes = self._lookup(bmu_id)
+        if not self.index['dates']:
+            return pd.DataFrame(columns=KINDS, index=pd.DatetimeIndex([], name='utc_time'), dtype=np.float32)
+        blocks = []
+        slots = []
+        for year in self.years():
+            first_slot, n_slots = self._year_slots(year)
+            if codes:
+                blocks.append(self._open(year)[codes].sum(axis=0))
+            else:
+                blocks.append(np.zeros((n_slots, len(KINDS)), dtype=np.float32))
+            slots.append(first_slot + np.arange(n_slots))
+        slots = np.concatenate(slots)
+        # only the dates loaded
+        start = settlement.get_first_slot(self.index['dates'][0])
+        end = settlement.get_first_slot(pd.Timestamp(self.index['dates'][-1]) + pd.Timedelta(days=1))
+        keep = (slots >= start) & (slots < end)
+        values = np.concatenate(blocks)[keep]
+        # the dates in between which were never loaded are missing, not zero
+        dates = pd.to_datetime(self.index['dates'])
+        first_periods = np.ones(len(dates), dtype=np.int64)
+        loaded = np.zeros(end - start + 1, dtype=np.int64)
+        np.add.at(loaded, settlement.to_slots(dates, first_periods) - start, 1)
+        np.add.at(loaded, settlement.to_slots(dates + pd.Timedelta(days=1), first_periods) - start, -1)
+        values[np.cumsum(loaded)[slots[keep] - start] == 0] = np.nan
+        df = pd.DataFrame(values, columns=KINDS, index=settlement.slots_to_utc(slots[keep]))
+        df.index.name = 'utc_time'
+        return df
+
+    def volumes(self, year):
+        """
+        Returns the (time x BMU x kind) array of `year`, memory mapped, the BMUs are in the order of bmu_ids.
+        """
+        return self._open(year)[:len(self.index['bmus'])].transpose(1, 0, 2)
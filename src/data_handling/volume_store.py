@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# accepted volumes are held as: BMU_id dictionary encoded, int8 settlement period,
+# float32 volumes and the settlement date as an int16 number of days since EPOCH
+EPOCH = pd.Timestamp('1970-01-01')
+COMPACT_DTYPES = {'BMU_id': 'category', 'Settlement Period': 'int8', 'Total': 'float32', 'day': 'int16'}
+
+
+def to_day_number(dates):
+    return ((pd.to_datetime(dates) - EPOCH) // pd.Timedelta(days=1)).astype('int16')
+
+
+def from_day_number(days):
+    return EPOCH + pd.to_timedelta(days, unit='D')
+
+
+def compact_accepted_volumes(df):
+    """
+    Converts accepted volumes, as written before the compact schema ('date' as datetime, string
+    BMU_id, Settlement Period and Total, a HDR column), to COMPACT_DTYPES. Extra columns are kept.
+    """
+    if 'date' in df.columns:
+        df = df.assign(day=to_day_number(df['date'])).drop(columns=['date'])
+    if 'HDR' in df.columns:
+        # the same for every row of a BAV or OAV table
+        df = df.drop(columns=['HDR'])
+    return df.astype(COMPACT_DTYPES)
+
+
+def concat_accepted_volumes(dfs):
+    """
+    Concatenates compact accepted volumes, keeping BMU_id dictionary encoded.
+    """
+    dfs = [compact_accepted_volumes(df) for df in dfs]
+    bmu_ids = union_categoricals([df['BMU_id'] for df in dfs])
+    df = pd.concat([df.drop(columns=['BMU_id']) for df in dfs], ignore_index=True)
+    df.insert(0, 'BMU_id', bmu_ids)
+    return df
+
+
+# the volumes of the bid-offer pairs are mostly zero, so only the non-zero ones are kept, one row each
+# (coordinate format), with the pair number (1 to 15) and the record type ('BAV' or 'OAV')
+PAIR_DTYPES = {'BMU_id': 'category', 'kind': 'category', 'Settlement Period': 'int8', 'pair': 'int8', 'volume': 'float32', 'day': 'int16'}
+
+
+def to_pair_volumes(df, pair_columns, day):
+    """
+    Converts parsed DERBMDATA records, with a 'HDR', 'BMU_id', 'Settlement Period' and a volume column per
+    pair (`pair_columns`, in pair order), to the non-zero pair volumes of settlement date number `day`.
+    """
+    volumes = df[pair_columns].to_numpy()
+    rows, pairs = np.nonzero(np.nan_to_num(volumes))
+    pair_df = pd.DataFrame({
+        'BMU_id': df['BMU_id'].to_numpy()[rows],
+        'kind': df['HDR'].to_numpy()[rows],
+        'Settlement Period': df['Settlement Period'].to_numpy()[rows],
+        'pair': pairs + 1,
+        'volume': volumes[rows, pairs],
+        'day': day,
+    })
+    return pair_df.astype(PAIR_DTYPES)
+
+
+def concat_pair_volumes(dfs):
+    """
+    Concatenates pair volumes, keeping BMU_id and kind dictionary encoded.
+    """
+    dfs = [df.astype(PAIR_DTYPES) for df in dfs]
+    categoricals = {col: union_categoricals([df[col] for df in dfs], sort_categories=True) for col in ['BMU_id', 'kind']}
+    df = pd.concat([df.drop(columns=list(categoricals)) for df in dfs], ignore_index=True)
+    for i, (col, values) in enumerate(categoricals.items()):
+        df.insert(i, col, values)
+    return df
+
+
+def sort_pair_volumes(df):
+    # by BMU then time, so the rows of a BMU are together in the file and a filter on it skips most of the row groups
+    return df.sort_values(['BMU_id', 'day', 'Settlement Period', 'kind', 'pair'], ignore_index=True)
+
+
+def summarise_pair_volumes(df, by=('kind', 'pair'), freq=None):
+    """
+    Sums pair volumes over the fleet, or per BMU with by=('BMU_id', 'kind', 'pair').
+
+    Args:
+    df (DataFrame): Pair volumes.
+    by (tuple): The columns to group by.
+    freq (str): Optional, also group by settlement date at this frequency, e.g. '1MS'.
+
+    Returns:
+    DataFrame: The summed 'volume' (MWh) and the number of settlement periods ('count').
+    """
+    frame = df[list(by)].assign(volume=df['volume'].astype('float64'))
+    keys = list(by)
+    if freq is not None:
+        frame['date'] = from_day_number(df['day']).to_numpy()
+        keys.insert(0, pd.Grouper(key='date', freq=freq))
+    summary = frame.groupby(keys, observed=True)['volume'].agg(['sum', 'size'])
+    return summary.rename(columns={'sum': 'volume', 'size': 'count'})
+
+
+def memory_report(df):
+    usage = df.memory_usage(deep=True, index=False)
+    columns = ', '.join(f"{col} {usage[col] / 1e6:.1f}" for col in df.columns)
+    return f"{len(df)} rows, {usage.sum() / 1e6:.1f} MB ({columns})"
+
+
+def get_ngc_bmu_id(bmu_id):
+    """
+    Strips the Elexon prefix from a BMU id, e.g. 'T_ABRBO-1' -> 'ABRBO-1', which is the NGC BMU id used by B1610 and the windfarm csv.
+    """
+    if len(bmu_id) > 2 and bmu_id[1] == '_':
+        return bmu_id[2:]
+    return bmu_id
+
+
+class VolumeStore:
+    """
+    Accepted volumes (BAV or OAV) sorted by BMU, date and settlement period, with a categorical
+    BMU key and an offset index, so the rows of one BMU are a slice rather than a scan of the whole table.
+    BMUs can be looked up by their Elexon id ('T_ABRBO-1') or their NGC id ('ABRBO-1').
+
+    Args:
+    df (DataFrame): Compact accepted volumes, with 'BMU_id', 'day' and 'Settlement Period' columns.
+    """
+    def __init__(self, df):
+        df = df.dropna(subset=['BMU_id'])
+        bmu_ids = df['BMU_id'].astype('category')
+        codes = bmu_ids.cat.codes.to_numpy()
+        order = np.lexsort((df['Settlement Period'].to_numpy(), df['day'].to_numpy(), codes))
+        self.df = df.iloc[order].reset_index(drop=True)
+        self.df['BMU_id'] = pd.Categorical.from_codes(codes[order], categories=bmu_ids.cat.categories)
+
+        counts = np.bincount(codes, minlength=len(bmu_ids.cat.categories))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.index = {bmu_id: code for code, bmu_id in enumerate(bmu_ids.cat.categories)}
+        self.aliases = {}
+        for bmu_id, code in self.index.items():
+            self.aliases.setdefault(get_ngc_bmu_id(bmu_id), []).append(code)
+
+    def __len__(self):
+        return len(self.df)
+
+    def __contains__(self, bmu_id):
+        return bmu_id in self.index or bmu_id in self.aliases
+
+    @property
+    def bmu_ids(self):
+        return list(self.index)
+
+    def get(self, bmu_id):
+        """
+        Returns the rows for exactly `bmu_id`, empty if the BMU has no accepted volumes.
+        """
+        if bmu_id in self.index:
+            codes = [self.index[bmu_id]]
+        else:
+            codes = self.aliases.get(bmu_id, [])
+        if not codes:
+            return self.df.iloc[0:0]
+        if len(codes) == 1:
+            return self._slice(codes[0])
+        return pd.concat([self._slice(code) for code in codes])
+
+    def _slice(self, code):
+        return self.df.iloc[self.offsets[code]:self.offsets[code + 1]]
+
+    def items(self):
+        """
+        Yields (bmu_id, rows) for every BMU, in one pass over the sorted table.
+        """
+        for bmu_id, code in self.index.items():
+            yield bmu_id, self._slice(code)
@@ -1,8 +1,11 @@
-import boto3
-import botocore
-import datetime as dt
 import glob
+import hashlib
+import itertools
+import json
 import os
+import shutil
+import zipfile
+import numpy as np
 import xarray as xr
 import pandas as pd
 import concurrent.futures
@@ -12,105 +15,319 @@ import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import utils.helpers as helpers
+import data_handling.weather_store as weather_store
+import data_handling.ledger as ledger
 # Global variable for project root path
 project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-era5_bucket = 'era5-pds'
-client = boto3.client('s3', config=botocore.client.Config(signature_version=botocore.UNSIGNED))
+# ERA5 comes from the Copernicus Climate Data Store (CDS). download_era5() merges the variables and
+# the months of a year into as few requests as CDS allows (MAX_FIELDS_PER_REQUEST), runs at most
+# MAX_CONCURRENT_REQUESTS at once, and records each month in the ingest ledger as it is written, so
+# an interrupted backfill only requests the months not done. A finished download is kept in
+# data/weather_data/downloads until all of its months are written.
+ERA5_SOURCE = 'ERA5'
+ERA5_DATASET = 'reanalysis-era5-single-levels'
+# north, west, south, east
+ERA5_AREA = [62, -6, 48, 5]
+ERA5_LATENCY_DAYS = 5
+MAX_FIELDS_PER_REQUEST = 120000
+MAX_CONCURRENT_REQUESTS = 2
 
-def get_era5_data(date, variable, locs):
-    folder = os.path.join(project_root_path, 'data', 'weather_data')
-    os.makedirs(folder, exist_ok=True)
+# the variables are named as in the AWS ERA5 files, which the monthly files have always used
+VARIABLES = ['eastward_wind_at_100_metres', 'northward_wind_at_100_metres']
+CDS_VARIABLES = {
+    'eastward_wind_at_100_metres': '100m_u_component_of_wind',
+    'northward_wind_at_100_metres': '100m_v_component_of_wind',
+}
+CDS_SHORT_NAMES = {
+    'eastward_wind_at_100_metres': 'u100',
+    'northward_wind_at_100_metres': 'v100',
+}
 
+# the names of the coordinates in the S3 and CDS files
+LAT_NAMES = ('lat', 'latitude')
+LON_NAMES = ('lon', 'longitude')
+TIME_NAMES = ('time0', 'time', 'valid_time')
 
 
-    dataset = "reanalysis-era5-single-levels"
-    request = {
+def _get_coord_name(ds, names):
+    for name in names:
+        if name in ds.coords:
+            return name
+    raise KeyError(f"None of {names} in {list(ds.coords)}")
+
+
+def get_grid_indices(ds, lats, lons):
+    """
+    Returns the indices of the grid nodes nearest to each location, along the latitude and the longitude
+    of `ds`. The longitudes can be in either convention (0 to 360 or -180 to 180), whatever the grid uses.
+
+    Returns:
+    tuple: (lat indices, lon indices), int arrays with one value per location.
+    """
+    lat_name = _get_coord_name(ds, LAT_NAMES)
+    lon_name = _get_coord_name(ds, LON_NAMES)
+    lat_indices = ds.indexes[lat_name].get_indexer(np.asarray(lats, dtype=float), method='nearest')
+    # the distance around the globe, so 359.9 is nearest to 0 on a global grid, in either convention
+    grid_lons = ds[lon_name].values
+    lons = np.asarray(lons, dtype=float)
+    distance = np.abs((grid_lons[np.newaxis, :] - lons[:, np.newaxis] + 180) % 360 - 180)
+    lon_indices = distance.argmin(axis=1)
+    return lat_indices, lon_indices
+
+
+def _get_neighbour_indices(grid, indices, values, wrap=False):
+    # the index of the grid point on the other side of each value from its nearest one
+    step = np.sign(values - grid[indices]) * np.sign(grid[-1] - grid[0])
+    neighbours = indices + step.astype(np.int64)
+    if wrap:
+        return neighbours % len(grid)
+    return np.clip(neighbours, 0, len(grid) - 1)
+
+
+def extract_nodes(ds, variable, lats, lons, surrounding=False):
+    """
+    Extracts the time series of `variable` at the grid nodes nearest to the locations, in one pointwise
+    indexing operation. Locations sharing a node share its column.
+
+    Args:
+    ds (xarray.Dataset): An ERA5 month.
+    variable (str): The variable to extract.
+    lats, lons: The locations, in degrees.
+    surrounding (bool): Also extract the four nodes around each location, for data_handling/interpolation.py.
+
+    Returns:
+    xarray.DataArray: float32 (time x node), with the lat and lon of each node as coordinates, and
+        'location_node', the nearest node of each location, in attrs.
+    """
+    lat_name = _get_coord_name(ds, LAT_NAMES)
+    lon_name = _get_coord_name(ds, LON_NAMES)
+    lat_indices, lon_indices = get_grid_indices(ds, lats, lons)
+    n_lons = ds.sizes[lon_name]
+    location_nodes = lat_indices.astype(np.int64) * n_lons + lon_indices
+    all_nodes = [location_nodes]
+    if surrounding:
+        grid_lats, grid_lons = ds[lat_name].values, ds[lon_name].values
+        lons = np.asarray(lons, dtype=float)
+        # the offset to the location around the globe, as in get_grid_indices()
+        lon_offsets = (lons - grid_lons[lon_indices] + 180) % 360 - 180
+        lat_neighbours = _get_neighbour_indices(grid_lats, lat_indices, np.asarray(lats, dtype=float))
+        lon_neighbours = _get_neighbour_indices(grid_lons, lon_indices, grid_lons[lon_indices] + lon_offsets,
+                                                wrap=grid_lons[-1] - grid_lons[0] > 359)
+        for corner_lat_indices in [lat_indices, lat_neighbours]:
+            for corner_lon_indices in [lon_indices, lon_neighbours]:
+                all_nodes.append(corner_lat_indices.astype(np.int64) * n_lons + corner_lon_indices)
+    # each grid node once, however many locations use it
+    nodes, inverse = np.unique(np.concatenate(all_nodes), return_inverse=True)
+    location_node = inverse[:len(location_nodes)]
+    node_lat_indices, node_lon_indices = nodes // n_lons, nodes % n_lons
+    # netCDF reads a contiguous block much faster than a list of indices, so the block around
+    # the nodes is read once and the nodes are picked from it in memory
+    lat_start, lon_start = node_lat_indices.min(), node_lon_indices.min()
+    block = ds[variable].isel({
+        lat_name: slice(lat_start, node_lat_indices.max() + 1),
+        lon_name: slice(lon_start, node_lon_indices.max() + 1),
+    }).load()
+    node_data = block.isel({
+        lat_name: xr.DataArray(node_lat_indices - lat_start, dims='node'),
+        lon_name: xr.DataArray(node_lon_indices - lon_start, dims='node'),
+    }).astype(np.float32)
+    node_data = node_data.transpose(..., 'node').rename({lat_name: 'lat', lon_name: 'lon'})
+    node_data.attrs['location_node'] = location_node
+    return node_data
+
+
+def nodes_to_frame(node_data):
+    """
+    Converts a (time x node) DataArray to the long layout of the monthly weather files: a row per time and
+    node, with 'lat', 'lon' and the variable as columns.
+    """
+    time_name = node_data.dims[0]
+    n_times, n_nodes = node_data.shape
+    df = pd.DataFrame({
+        'lat': np.tile(node_data['lat'].values, n_times),
+        'lon': np.tile(node_data['lon'].values, n_times),
+        node_data.name: node_data.values.ravel(),
+    }, index=pd.DatetimeIndex(np.repeat(node_data[time_name].values, n_nodes), name=time_name))
+    return df
+
+
+def get_weather_data_path():
+    return os.path.join(project_root_path, 'data', 'weather_data')
+
+
+def get_month_file_path(month, variable):
+    return os.path.join(get_weather_data_path(), f"{month.year}_{str(month.month).zfill(2)}_{variable}.parquet")
+
+
+def get_complete_months(start_date, end_date=None):
+    """
+    Returns the months (Timestamps of their first day) from `start_date` whose ERA5 data is complete,
+    i.e. which ended ERA5_LATENCY_DAYS ago.
+    """
+    last_day = pd.Timestamp('today').floor('D') - pd.Timedelta(days=ERA5_LATENCY_DAYS)
+    if end_date is not None:
+        last_day = min(last_day, pd.Timestamp(end_date))
+    last_month = (last_day + pd.Timedelta(days=1)).to_period('M').to_timestamp() - pd.DateOffset(months=1)
+    return list(pd.date_range(pd.Timestamp(start_date).to_period('M').to_timestamp(), last_month, freq='1MS'))
+
+
+def _import_month_files(ledger_):
+    # one off, the months downloaded before the ledger recorded them
+    months = [
+        date_string for date_string, files in weather_store.get_month_files().items()
+        if set(VARIABLES) <= set(files)
+    ]
+    ledger_.import_dates(ERA5_SOURCE, ledger.ALL_BMUS, [f'{month}-01' for month in months])
+
+
+def plan_batches(months, variables=VARIABLES, max_fields=MAX_FIELDS_PER_REQUEST):
+    """
+    Groups months into CDS requests. A request is the product of its years, months, days and hours,
+    so the months of a batch are in the same year, and a batch has at most `max_fields` fields
+    (variables x hours).
+
+    Returns:
+    list: Lists of months.
+    """
+    months_per_batch = max(1, max_fields // (len(variables) * 31 * 24))
+    batches = []
+    for _, year_months in itertools.groupby(sorted(months), key=lambda month: month.year):
+        year_months = list(year_months)
+        batches.extend(year_months[i:i + months_per_batch] for i in range(0, len(year_months), months_per_batch))
+    return batches
+
+
+def _build_request(months, variables):
+    return {
         "product_type": ["reanalysis"],
-        "variable": [
-            "10m_u_component_of_wind",
-            "10m_v_component_of_wind"
-        ],
-        "year": [f"{date.year}"],
-        "month": [f"{date.month}"],
-        "day": [ "01", "02", "03",
-        "04", "05", "06",
-        "07", "08", "09",
-        "10", "11", "12",
-        "13", "14", "15",
-        "16", "17", "18",
-        "19", "20", "21",
-        "22", "23", "24",
-        "25", "26", "27",
-        "28", "29", "30",
-        "31"],
-        "time": [
-            "00:00", "01:00", "02:00",
-            "03:00", "04:00", "05:00",
-            "06:00", "07:00", "08:00",
-            "09:00", "10:00", "11:00",
-            "12:00", "13:00", "14:00",
-            "15:00", "16:00", "17:00",
-            "18:00", "19:00", "20:00",
-            "21:00", "22:00", "23:00"
-        ],
+        "variable": [CDS_VARIABLES[variable] for variable in variables],
+        "year": [f"{months[0].year}"],
+        "month": [str(month.month).zfill(2) for month in months],
+        # days which do not exist in a month are ignored
+        "day": [str(day).zfill(2) for day in range(1, 32)],
+        "time": [f"{hour:02d}:00" for hour in range(24)],
         "data_format": "netcdf",
-        "download_format": "zip",
-        "area": [62, -6, 48, 5]
+        "download_format": "unarchived",
+        "area": ERA5_AREA,
     }
 
-    client = cdsapi.Client()
-    client.retrieve(dataset, request).download(target=f"{date.year}{str(date.month).zfill(2)}_{variable}.zip")
-    
 
-    
-    drive_filename = os.path.join(folder, f"{date.year}_{str(date.month).zfill(2)}_{variable}.parquet")
+def _get_batch_file_path(months, variables):
+    key = hashlib.sha1(json.dumps(_build_request(months, variables), sort_keys=True).encode()).hexdigest()[:12]
+    return os.path.join(get_weather_data_path(), 'downloads', f"{months[0].strftime('%Y_%m')}-{months[-1].strftime('%m')}_{key}.nc")
+
+
+def _open_download(file_path):
+    # a multi variable netcdf can come back zipped, one file per variable
+    if not zipfile.is_zipfile(file_path):
+        return xr.open_dataset(file_path)
+    folder = file_path + '.unzipped'
+    with zipfile.ZipFile(file_path) as zf:
+        zf.extractall(folder)
+    return xr.open_mfdataset(sorted(glob.glob(os.path.join(folder, '*.nc'))), combine='by_coords')
 
-    if os.path.isfile(drive_filename):
-        print('File already exists:', drive_filename)
-        return
 
-    s3_data_key = f"{date.year}/{str(date.month).zfill(2)}/data/{variable}.nc"
-    data_file = f"{date.year}{str(date.month).zfill(2)}_{variable}.nc"
+def _get_processed_months(ledger_):
+    return set(ledger_.dates(ERA5_SOURCE, status=ledger.PROCESSED))
 
-    local_file_path = os.path.join(folder, data_file)
-    if not os.path.isfile(local_file_path):
-        print("Downloading from S3:", s3_data_key)
+
+def _process_download(file_path, variables, locs, ledger_):
+    # splits a download into the monthly files, each month is recorded as soon as it is written
+    lats = [location['lat'] for location in locs]
+    lons = [location['lon'] for location in locs]
+    processed_months = _get_processed_months(ledger_)
+    with _open_download(file_path) as ds:
+        ds = ds.rename({name: variable for variable, name in CDS_SHORT_NAMES.items() if name in ds})
+        time_name = _get_coord_name(ds, TIME_NAMES)
+        months = pd.DatetimeIndex(ds[time_name].values).to_period('M').unique().to_timestamp()
+        for month in months:
+            if month.strftime('%Y-%m-%d') in processed_months:
+                continue
+            month_ds = ds.sel({time_name: month.strftime('%Y-%m')})
+            for variable in variables:
+                node_data = extract_nodes(month_ds, variable, lats, lons, surrounding=True)
+                month_file_path = get_month_file_path(month, variable)
+                nodes_to_frame(node_data).to_parquet(month_file_path + '.tmp')
+                os.replace(month_file_path + '.tmp', month_file_path)
+            ledger_.record(ERA5_SOURCE, ledger.ALL_BMUS, month.strftime('%Y-%m-%d'), True, os.path.getsize(file_path))
+            print(f"Weather data written for {month.strftime('%Y-%m')}")
+    # every month is written, the download is not needed any more
+    os.remove(file_path)
+    shutil.rmtree(file_path + '.unzipped', ignore_errors=True)
+
+
+def _run_batch(months, variables, locs, ledger_, client):
+    file_path = _get_batch_file_path(months, variables)
+    try:
+        # a download interrupted before it finished is requested again, only its .part file is left
+        print(f"Requesting ERA5 {months[0].strftime('%Y-%m')} to {months[-1].strftime('%Y-%m')}: {len(variables)} variables")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        client.retrieve(ERA5_DATASET, _build_request(months, variables)).download(target=file_path + '.part')
+        os.replace(file_path + '.part', file_path)
+        _process_download(file_path, variables, locs, ledger_)
+        return True
+    except Exception as e:
+        print(f"ERA5 download failed for {months[0].strftime('%Y-%m')} to {months[-1].strftime('%Y-%m')}: {e}")
+        processed_months = _get_processed_months(ledger_)
+        for month in months:
+            if month.strftime('%Y-%m-%d') not in processed_months:
+                ledger_.record(ERA5_SOURCE, ledger.ALL_BMUS, month.strftime('%Y-%m-%d'), False)
+        return False
+
+
+def _resume_downloads(variables, locs, ledger_):
+    # the downloads finished by a run which stopped before writing all of their months
+    for file_path in sorted(glob.glob(os.path.join(get_weather_data_path(), 'downloads', '*.nc'))):
+        print(f"Resuming {os.path.basename(file_path)}")
         try:
-            client.download_file(era5_bucket, s3_data_key, local_file_path)
-        except botocore.exceptions.ClientError as e:
-            raise e
+            _process_download(file_path, variables, locs, ledger_)
+        except Exception as e:
+            print(f"Resuming {file_path} failed: {e}")
 
-    print("Reading and processing:", local_file_path)
-    ds = xr.open_dataset(local_file_path)
-    all_df = pd.DataFrame()
 
-    for location in locs:
-        print(f"Processing {location['lon']}, {location['lat']}")
-        df = ds.sel(lon=location['adj_lon'], lat=location['lat'], method='nearest').to_dataframe()
-        all_df = pd.concat([all_df, df])
+def download_era5(locs, start_date, end_date=None, variables=VARIABLES, max_concurrent_requests=MAX_CONCURRENT_REQUESTS):
+    """
+    Downloads the complete ERA5 months from `start_date` which have not been processed yet, merged
+    into as few CDS requests as it allows, and writes the monthly weather files. Progress is recorded
+    per month in the ingest ledger, so an interrupted run carries on where it stopped.
 
-    all_df.to_parquet(drive_filename)
-    open(local_file_path, 'w').close()
-    os.remove(local_file_path)
-    print('File downloaded:', drive_filename)
+    Args:
+    locs (list): [{'lat': lat, 'lon': lon}], the locations to keep the nodes of.
+    start_date, end_date: The months to download.
+    max_concurrent_requests (int): The CDS requests queued at once.
 
-def fetch_all_weather_data():
-    preprocessed_folder = os.path.join(project_root_path, 'data', 'preprocessed_data')
-    os.makedirs(preprocessed_folder, exist_ok=True)
+    Returns:
+    list: The months downloaded.
+    """
+    ledger_ = ledger.get_ledger()
+    if not ledger_.has_rows(ERA5_SOURCE):
+        _import_month_files(ledger_)
+    _resume_downloads(variables, locs, ledger_)
+    done = _get_processed_months(ledger_)
+    months = [month for month in get_complete_months(start_date, end_date) if month.strftime('%Y-%m-%d') not in done]
+    if not months:
+        print("ERA5 data is up to date")
+        return []
+    batches = plan_batches(months, variables)
+    print(f"Downloading {len(months)} months of ERA5 data in {len(batches)} requests")
+    client = cdsapi.Client()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        results = list(executor.map(lambda batch: _run_batch(batch, variables, locs, ledger_, client), batches))
+    return [month for batch, ok in zip(batches, results) if ok for month in batch]
 
-    filename = os.path.join(preprocessed_folder, 'weather_data.parquet')
 
-    if os.path.exists(filename):
-        print('File exists:', filename)
-        return pd.read_parquet(filename)
+def fetch_all_weather_data():
+    """
+    Loads the monthly weather files which are new, or have changed, into the weather store, by grid node.
 
-    file_list = glob.glob(os.path.join(project_root_path, 'data', 'weather_data', '*.parquet'))
-    with concurrent.futures.ProcessPoolExecutor(max_workers=3) as executor:
-        dfs = executor.map(pd.read_parquet, file_list)
-    df = pd.concat(dfs)
-    df.to_parquet(filename)
-    return df
+    Returns:
+    WeatherStore: Read the series of one node with get_data(lat, lon).
+    """
+    store = weather_store.WeatherStore()
+    if not store.update(weather_store.get_month_files()):
+        print('Weather store is up to date:', store.path)
+    return store
 
 
 if __name__ == "__main__":
@@ -122,16 +339,4 @@ if __name__ == "__main__":
     windfarm_details['lon'] = windfarm_details['lon'].round(2)
     windfarm_details = windfarm_details.loc[~windfarm_details[['lon','lat']].duplicated()]
     locs = windfarm_details[['lon','lat']].to_dict('records')
-    for l in locs:
-        if l['lon'] < 0:
-            l['adj_lon'] = 360 + l['lon']
-        else:
-            l['adj_lon'] = l['lon']
-    variables = ['eastward_wind_at_100_metres','northward_wind_at_100_metres']
-    arg_list = []
-    today = dt.datetime.utcnow().strftime('%Y-%m-%d')
-    month_range = pd.date_range('2024-08-01',today,freq='1MS')
-    var_month = [(v,m) for v in variables for m in month_range]
-    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-      for variable, month in var_month:
-          executor.submit(get_era5_data, date=month, variable=variable,locs=locs)
\ No newline at end of file
+    download_era5(locs, '2024-08-01')
@@ -0,0 +1,379 @@
+import glob
+import json
+import os
+import re
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+import data_handling.delta_store as delta_store
+import utils.atomic_files as atomic_files
+
+# Global variable for project root path
+project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The ERA5 data laid out by grid node rather than by month, so one wind farm reads only its own node:
+#
+#     data/preprocessed_data/weather_store/nodes.parquet           the node index: node, lat, lon
+#     data/preprocessed_data/weather_store/nodes/<node>.parquet    the hourly series of one node, a column per variable
+#     data/preprocessed_data/weather_store/manifest.json           the months loaded: the size and mtime of their
+#                                                                  files, and the number of nodes when loaded
+#
+# Each node file is a DeltaStore, so months added later are appended as deltas rather than rewriting
+# the file. The monthly files (data/weather_data/<year>_<month>_<variable>.parquet, a row per time and
+# node) are read a chunk of months at a time, so the whole cube is never in memory. update() compares
+# the files with the manifest and loads only:
+#
+#     new months
+#     the nodes added since a month was loaded, if its files have changed (downloaded again for more locations)
+#     all of a month whose files have changed within PRELIMINARY_MONTHS, as the preliminary ERA5T data is replaced
+#
+# The nodes are keyed on their latitude and their longitude from 0 to 360, the convention of the first
+# monthly files, whichever convention a file uses (the CDS downloads are -180 to 180), so a grid point is
+# one node. A store with a node per convention is merged once by update(), see _merge_nodes().
+#
+# The wind speed and direction are derived from the 100m U and V components as the months are written,
+# and stored next to them in the node files, so readers take them as they are.
+
+MONTH_FILE_PATTERN = re.compile(r'(\d{4})_(\d{2})_(.+)\.parquet$')
+MONTHS_PER_CHUNK = 12
+PRELIMINARY_MONTHS = 3
+WIND_COMPONENTS = ('eastward_wind_at_100_metres', 'northward_wind_at_100_metres')
+WIND_VARIABLES = ['wind_speed', 'wind_direction_degrees']
+# saved in the manifest, node files written with another version get their wind columns derived again
+WIND_VERSION = 1
+# saved in the manifest, a node index written with another version has its longitudes normalised
+NODES_VERSION = 2
+
+
+def get_store_path():
+    return os.path.join(project_root_path, 'data', 'preprocessed_data', 'weather_store')
+
+
+def get_month_files(folder_path=None):
+    """
+    Returns {'%Y-%m': {variable: file}} of the monthly weather files.
+    """
+    if folder_path is None:
+        folder_path = os.path.join(project_root_path, 'data', 'weather_data')
+    month_files = {}
+    for file in glob.glob(os.path.join(folder_path, '*.parquet')):
+        match = MONTH_FILE_PATTERN.search(os.path.basename(file))
+        if match:
+            year, month, variable = match.groups()
+            month_files.setdefault(f'{year}-{month}', {})[variable] = file
+    return dict(sorted(month_files.items()))
+
+
+def normalise_points(lats, lons):
+    """
+    Returns the latitudes and longitudes as node keys: rounded, with the longitude from 0 to 360.
+    """
+    lats = np.round(np.asarray(lats, dtype=float), 6)
+    lons = np.round(np.asarray(lons, dtype=float) % 360, 6) % 360
+    return lats, lons
+
+
+def _get_signature(files):
+    return {variable: [os.path.getsize(file), os.stat(file).st_mtime_ns] for variable, file in sorted(files.items())}
+
+
+def get_wind_speed_and_direction(u, v):
+    """
+    Returns the wind speed and the direction the wind blows from, in degrees clockwise from north,
+    of the U (eastward) and V (northward) components, as float32 arrays.
+    """
+    u = np.asarray(u, dtype=np.float32)
+    v = np.asarray(v, dtype=np.float32)
+    speed = np.hypot(u, v)
+    direction = np.degrees(np.arctan2(-u, -v)).astype(np.float32, copy=False)
+    np.mod(direction, np.float32(360), out=direction)
+    return speed, direction
+
+
+def _add_wind(df):
+    # the wind columns of a DataFrame with both wind components, in place
+    u_variable, v_variable = WIND_COMPONENTS
+    if u_variable in df.columns and v_variable in df.columns:
+        df[WIND_VARIABLES[0]], df[WIND_VARIABLES[1]] = get_wind_speed_and_direction(df[u_variable], df[v_variable])
+    return df
+
+
+def _concat_node_data(dfs):
+    df = pd.concat(dfs)
+    # a month loaded again replaces the old rows
+    return df[~df.index.duplicated(keep='last')].sort_index()
+
+
+class WeatherStore:
+    """
+    Per node weather files with a node index, see above.
+
+    Args:
+    path (str): Optional, the store folder, defaults to get_store_path().
+    """
+    def __init__(self, path=None):
+        self.path = path if path is not None else get_store_path()
+        self.nodes_folder_path = os.path.join(self.path, 'nodes')
+        self.index_path = os.path.join(self.path, 'nodes.parquet')
+        self.manifest_path = os.path.join(self.path, 'manifest.json')
+        self._lock = threading.Lock()
+        self._manifest = None
+        if os.path.exists(self.index_path):
+            self.nodes = pd.read_parquet(self.index_path)
+        else:
+            self.nodes = pd.DataFrame({'node': pd.Series(dtype='int32'), 'lat': pd.Series(dtype='float64'), 'lon': pd.Series(dtype='float64')})
+        self._build_index()
+
+    def _build_index(self):
+        lats, lons = normalise_points(self.nodes['lat'], self.nodes['lon'])
+        self._index = {}
+        for point, node in zip(zip(lats.tolist(), lons.tolist()), self.nodes['node'].tolist()):
+            # a store not merged yet has a node per longitude convention, the first one is kept
+            self._index.setdefault(point, node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _node_store(self, node):
+        return delta_store.DeltaStore(os.path.join(self.nodes_folder_path, f'{node}.parquet'), concat=_concat_node_data)
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r') as f:
+                    self._manifest = json.load(f)
+            else:
+                self._manifest = {'months': {}}
+        return self._manifest
+
+    def _write_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        atomic_files.write_json_atomic(self.manifest, self.manifest_path)
+
+    def months(self):
+        """
+        Returns the set of months ('%Y-%m') loaded.
+        """
+        return set(self.manifest['months'])
+
+    def get_node(self, lat, lon):
+        """
+        Returns the node at exactly (lat, lon), a grid point of the monthly files, or None.
+        """
+        lats, lons = normalise_points([lat], [lon])
+        return self._index.get((lats[0], lons[0]))
+
+    def _get_nodes(self, lats, lons):
+        # the node of each row, adding the grid points seen for the first time to the index
+        lats, lons = normalise_points(lats, lons)
+        points, inverse = np.unique(lats + 1j * lons, return_inverse=True)
+        points = [(point.real, point.imag) for point in points]
+        new_points = [point for point in points if point not in self._index]
+        if new_points:
+            first_node = len(self.nodes)
+            new_nodes = pd.DataFrame(new_points, columns=['lat', 'lon'])
+            new_nodes.insert(0, 'node', np.arange(first_node, first_node + len(new_points), dtype='int32'))
+            self.nodes = pd.concat([self.nodes, new_nodes], ignore_index=True)
+            self._index.update({point: first_node + i for i, point in enumerate(new_points)})
+            os.makedirs(self.path, exist_ok=True)
+            atomic_files.write_parquet_atomic(self.nodes, self.index_path)
+        return np.array([self._index[point] for point in points], dtype=np.int32)[inverse]
+
+    def _read_months(self, month_files):
+        # one month chunk of every variable, as a (node, utc_time) indexed DataFrame with a column per variable
+        columns = []
+        for variable in sorted({variable for files in month_files.values() for variable in files}):
+            dfs = [pd.read_parquet(files[variable]) for files in month_files.values() if variable in files]
+            df = pd.concat(dfs)
+            times = df.index.values
+            nodes = self._get_nodes(df['lat'].to_numpy(), df['lon'].to_numpy())
+            index = pd.MultiIndex.from_arrays([nodes, times], names=['node', 'utc_time'])
+            column = pd.Series(df[variable].to_numpy(dtype=np.float32), index=index, name=variable)
+            columns.append(column[~index.duplicated(keep='last')])
+        return _add_wind(pd.concat(columns, axis=1).sort_index())
+
+    def add_months(self, month_files, months_per_chunk=MONTHS_PER_CHUNK, first_node=0):
+        """
+        Writes the months in `month_files` ({'%Y-%m': {variable: file}}, see get_month_files()) to the node files,
+        `months_per_chunk` at a time, and records them in the manifest.
+
+        Args:
+        first_node (int): Only write the nodes from this one, those added to the index since.
+
+        Returns:
+        list: The months written.
+        """
+        months = sorted(month_files)
+        os.makedirs(self.nodes_folder_path, exist_ok=True)
+        with self._lock:
+            for i in range(0, len(months), months_per_chunk):
+                chunk = months[i:i + months_per_chunk]
+                print(f"Writing weather data for {chunk[0]} to {chunk[-1]} by node")
+                df = self._read_months({month: month_files[month] for month in chunk})
+                node_codes = df.index.get_level_values('node').to_numpy()
+                offsets = np.searchsorted(node_codes, np.arange(len(self.nodes) + 1))
+                for node in range(first_node, len(self.nodes)):
+                    if offsets[node] == offsets[node + 1]:
+                        continue
+                    node_df = df.iloc[offsets[node]:offsets[node + 1]].droplevel('node')
+                    store = self._node_store(node)
+                    if store.exists():
+                        store.append(node_df, chunk)
+                    else:
+                        store.write(node_df, chunk)
+                # only once the node files have the months, so an interrupted update loads them again
+                for month in chunk:
+                    self.manifest['months'][month] = {'files': _get_signature(month_files[month]), 'n_nodes': len(self.nodes)}
+                self._write_manifest()
+        return months
+
+    def _adopt(self, month_files):
+        # a store written before the manifest, where each chunk of months was written to all its nodes
+        months = set()
+        for node in self.nodes['node']:
+            months |= self._node_store(node).dates()
+        for month in months:
+            if month in month_files:
+                self.manifest['months'][month] = {'files': _get_signature(month_files[month]), 'n_nodes': len(self.nodes)}
+        self._write_manifest()
+
+    def _derive_wind(self):
+        # node files written before the wind columns were, rewritten once with them
+        nodes = self.nodes['node'].to_numpy()
+        print(f"Weather store: deriving the wind speed and direction of {len(nodes)} nodes")
+        with self._lock:
+            for node in nodes:
+                store = self._node_store(node)
+                if store.exists():
+                    store.write(_add_wind(store.read()), store.dates())
+            self.manifest['wind_version'] = WIND_VERSION
+            self._write_manifest()
+
+    def _finish_merge(self):
+        # the steps after the merged node files are written, each one safe to run again
+        merging_path = self.nodes_folder_path + '.merging'
+        old_path = self.nodes_folder_path + '.old'
+        if os.path.exists(os.path.join(merging_path, 'nodes.parquet')):
+            if os.path.exists(self.nodes_folder_path) and not os.path.exists(old_path):
+                os.replace(self.nodes_folder_path, old_path)
+            os.replace(merging_path, self.nodes_folder_path)
+        elif os.path.exists(merging_path):
+            # interrupted before it was complete
+            shutil.rmtree(merging_path)
+        merged_index_path = os.path.join(self.nodes_folder_path, 'nodes.parquet')
+        if os.path.exists(merged_index_path):
+            os.replace(merged_index_path, self.index_path)
+            self.nodes = pd.read_parquet(self.index_path)
+            self._build_index()
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+    def _merge_nodes(self):
+        # the nodes of a grid point written once per longitude convention merged into one, and the longitudes of
+        # the node index normalised. The monthly files are left as they are, their rows are normalised as they are read
+        lats, lons = normalise_points(self.nodes['lat'], self.nodes['lon'])
+        new_nodes = {}
+        node_map = np.array([new_nodes.setdefault(point, len(new_nodes)) for point in zip(lats.tolist(), lons.tolist())], dtype=np.int32)
+        nodes = pd.DataFrame({'node': np.arange(len(new_nodes), dtype=np.int32)})
+        nodes['lat'] = [lat for lat, _ in new_nodes]
+        nodes['lon'] = [lon for _, lon in new_nodes]
+
+        with self._lock:
+            if len(nodes) < len(self.nodes):
+                print(f"Weather store: merging {len(self.nodes)} nodes into {len(nodes)} grid points")
+                merging_path = self.nodes_folder_path + '.merging'
+                os.makedirs(merging_path, exist_ok=True)
+                for new_node in range(len(nodes)):
+                    stores = [self._node_store(node) for node in np.flatnonzero(node_map == new_node)]
+                    stores = [store for store in stores if store.exists()]
+                    if not stores:
+                        continue
+                    df = _concat_node_data([store.read() for store in stores])
+                    dates = set().union(*(store.dates() for store in stores))
+                    delta_store.DeltaStore(os.path.join(merging_path, f'{new_node}.parquet'), concat=_concat_node_data).write(df, dates)
+                # written last, it marks the merged node files as complete
+                atomic_files.write_parquet_atomic(nodes, os.path.join(merging_path, 'nodes.parquet'))
+                self._finish_merge()
+            else:
+                self.nodes = nodes
+                self._build_index()
+                atomic_files.write_parquet_atomic(nodes, self.index_path)
+            # the nearest node index is built again from the new node index
+            grid_index_path = os.path.join(self.path, 'grid_index.pkl')
+            if os.path.exists(grid_index_path):
+                os.remove(grid_index_path)
+
+            if len(nodes) < len(node_map):
+                # the data of the months loaded is in the merged nodes
+                for loaded in self.manifest['months'].values():
+                    loaded['n_nodes'] = len(nodes)
+            self.manifest['nodes_version'] = NODES_VERSION
+            self._write_manifest()
+
+    def update(self, month_files, today=None):
+        """
+        Loads the months of `month_files` ({'%Y-%m': {variable: file}}, see get_month_files()) which are new
+        or have changed since they were loaded, see above.
+
+        Returns:
+        list: The months loaded, in full or for new nodes.
+        """
+        if not os.path.exists(self.manifest_path) and len(self.nodes):
+            self._adopt(month_files)
+        self._finish_merge()
+        if self.manifest.get('nodes_version') != NODES_VERSION:
+            if len(self.nodes):
+                self._merge_nodes()
+            else:
+                self.manifest['nodes_version'] = NODES_VERSION
+        if self.manifest.get('wind_version') != WIND_VERSION:
+            if self.manifest['months']:
+                self._derive_wind()
+            else:
+                self.manifest['wind_version'] = WIND_VERSION
+        today = pd.Timestamp('today') if today is None else pd.Timestamp(today)
+        first_final_month = (today.to_period('M') - PRELIMINARY_MONTHS).strftime('%Y-%m')
+
+        new_months, preliminary_months, new_node_months = [], [], {}
+        for month, files in month_files.items():
+            loaded = self.manifest['months'].get(month)
+            if loaded is None:
+                new_months.append(month)
+            elif loaded['files'] != _get_signature(files):
+                if month >= first_final_month:
+                    preliminary_months.append(month)
+                else:
+                    new_node_months.setdefault(loaded['n_nodes'], []).append(month)
+
+        if new_months or preliminary_months:
+            months = sorted(new_months + preliminary_months)
+            print(f"Weather store: {len(new_months)} new months, {len(preliminary_months)} preliminary months changed")
+            self.add_months({month: month_files[month] for month in months})
+        for first_node, months in sorted(new_node_months.items()):
+            print(f"Weather store: new nodes from {first_node} in {len(months)} months")
+            self.add_months({month: month_files[month] for month in months}, first_node=first_node)
+        return sorted(new_months + preliminary_months + [month for months in new_node_months.values() for month in months])
+
+    def get_node_data(self, node, columns=None):
+        """
+        Returns the hourly series of a node, indexed by utc_time, with a column per variable. Only that node's file is read.
+        """
+        store = self._node_store(node)
+        if not store.exists():
+            return None
+        df = store.read(columns=columns)
+        df.index.name = 'utc_time'
+        return df
+
+    def get_data(self, lat, lon, columns=None):
+        """
+        Returns the hourly series of the node at (lat, lon), see get_node().
+        """
+        node = self.get_node(lat, lon)
+        if node is None:
+            raise KeyError(f"No weather data for {lat}, {lon}")
+        return self.get_node_data(node, columns)
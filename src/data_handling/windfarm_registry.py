@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import utils.atomic_files as atomic_files
+
+# Global variable for project root path
+project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The wind farms of windfarms_details_jt.csv, parsed once into typed tables and kept as parquet:
+#
+#     data/preprocessed_data/windfarm_registry/farms.parquet    a row per farm (farm_id is the csv row),
+#                                                             the list columns as lists
+#     data/preprocessed_data/windfarm_registry/bmus.parquet     the BMU list exploded, a row per (bmu_id, farm_id)
+#     data/preprocessed_data/windfarm_registry/manifest.json    the size and mtime of the csv they were built from
+#
+# They are rebuilt when the csv changes. The registry keeps dict indexes of the farms by BMU and by name,
+# and by ERA5 grid node once assign_nodes() has been called, so a lookup is a dict get rather than a scan.
+# A BMU listed by several rows (the csv has a few duplicated farms) belongs to the first of them.
+
+REGISTRY_VERSION = 1
+LIST_COLUMNS = {'bmrs_id': str, 'repd_id': int, 'turbine_capacity': float, 'turbine_count': float}
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_csv_path():
+    return os.path.join(project_root_path, 'windfarms_details_jt.csv')
+
+
+def get_registry_path():
+    return os.path.join(project_root_path, 'data', 'preprocessed_data', 'windfarm_registry')
+
+
+def _get_signature(csv_path):
+    return {'csv': [os.path.getsize(csv_path), os.stat(csv_path).st_mtime_ns], 'version': REGISTRY_VERSION}
+
+
+def _parse_list_column(column, dtype):
+    # "['ABRBO-1', 'ABRBO-2']" or "[8.4]", as (row, value) arrays, for the whole column at once
+    values = column.fillna('[]').str.strip('[] ').str.split(',').explode()
+    values = values.str.strip(' \'"')
+    values = values[values != '']
+    return values.index.to_numpy(), values.astype(dtype).to_numpy()
+
+
+def _to_lists(rows, values, n_rows):
+    # (row, value) arrays back to a list per row
+    offsets = np.searchsorted(rows, np.arange(n_rows + 1))
+    return [values[offsets[i]:offsets[i + 1]].tolist() for i in range(n_rows)]
+
+
+def build(csv_path):
+    """
+    Parses the wind farm csv.
+
+    Returns:
+    tuple: (farms, bmus) DataFrames, see above.
+    """
+    df = pd.read_csv(csv_path).reset_index(drop=True)
+    farms = pd.DataFrame({
+        'farm_id': np.arange(len(df), dtype=np.int32),
+        'name': df['name'].astype(str),
+        'capacity': df['capacity'].astype(np.float64),
+        'lat': df['lat'].astype(np.float64),
+        'lon': df['lon'].astype(np.float64),
+        'gen_type': df['gen_type'].astype('category'),
+    })
+    bmus = None
+    for column, dtype in LIST_COLUMNS.items():
+        rows, values = _parse_list_column(df[column], dtype)
+        farms[column] = _to_lists(rows, values, len(df))
+        if column == 'bmrs_id':
+            bmus = pd.DataFrame({'bmu_id': values, 'farm_id': rows.astype(np.int32)})
+    # the rows which repeat the name and BMUs of an earlier one
+    keys = farms['name'] + '|' + farms['bmrs_id'].map(','.join)
+    farms['duplicate'] = keys.duplicated(keep='first')
+    return farms, bmus
+
+
+def _read_farms(path):
+    farms = pd.read_parquet(path)
+    # pyarrow reads list columns back as arrays
+    for column in LIST_COLUMNS:
+        farms[column] = farms[column].map(list)
+    return farms
+
+
+class WindfarmRegistry:
+    """
+    The wind farms and their BMUs, see above.
+
+    Args:
+    farms (DataFrame), bmus (DataFrame): As returned by build().
+    """
+    def __init__(self, farms, bmus, signature=None):
+        self.farms = farms
+        self.bmus = bmus
+        self.signature = signature
+        first_farms = bmus.drop_duplicates(subset='bmu_id', keep='first')
+        self._farm_by_bmu = dict(zip(first_farms['bmu_id'], first_farms['farm_id'].tolist()))
+        self._farms_by_name = {}
+        for farm_id, name in zip(farms['farm_id'].tolist(), farms['name']):
+            self._farms_by_name.setdefault(name, []).append(farm_id)
+        self._farms_by_node = {}
+
+    def __len__(self):
+        return len(self.farms)
+
+    def __contains__(self, bmu_id):
+        return bmu_id in self._farm_by_bmu
+
+    def get_farm_id(self, bmu_id):
+        """
+        Returns the farm_id of `bmu_id`, a KeyError if it is not in the registry.
+        """
+        return self._farm_by_bmu[bmu_id]
+
+    def get_farm(self, bmu_id):
+        return self.farms.loc[self.get_farm_id(bmu_id)]
+
+    def get_farm_ids(self, name):
+        """
+        Returns the farm_ids with the name `name`.
+        """
+        return list(self._farms_by_name.get(name, []))
+
+    def get_bmu_ids(self, farm_id=None, min_capacity=None):
+        """
+        Returns the BMUs of `farm_id`, or the sorted BMUs of every farm with a capacity above `min_capacity` (MW).
+        """
+        if farm_id is not None:
+            return list(self.farms.at[farm_id, 'bmrs_id'])
+        bmus = self.bmus
+        if min_capacity is not None:
+            bmus = bmus[self.farms['capacity'].to_numpy()[bmus['farm_id'].to_numpy()] > min_capacity]
+        return sorted(bmus['bmu_id'].unique())
+
+    def get_lat_lon(self, bmu_id):
+        farm_id = self.get_farm_id(bmu_id)
+        return self.farms.at[farm_id, 'lat'], self.farms.at[farm_id, 'lon']
+
+    def get_capacity(self, bmu_id):
+        return self.farms.at[self.get_farm_id(bmu_id), 'capacity']
+
+    def get_name(self, bmu_id):
+        return self.farms.at[self.get_farm_id(bmu_id), 'name']
+
+    def get_type(self, bmu_id):
+        return self.farms.at[self.get_farm_id(bmu_id), 'gen_type']
+
+    def get_farms(self, min_capacity=None, with_bmus=False, drop_duplicates=False):
+        """
+        Returns the farms with a capacity above `min_capacity` (MW), and with BMUs if `with_bmus`,
+        leaving out the repeated rows if `drop_duplicates`.
+        """
+        filt = np.ones(len(self.farms), dtype=bool)
+        if min_capacity is not None:
+            filt &= (self.farms['capacity'] > min_capacity).to_numpy()
+        if with_bmus:
+            filt &= (self.farms['bmrs_id'].map(len) > 0).to_numpy()
+        if drop_duplicates:
+            filt &= ~self.farms['duplicate'].to_numpy()
+        return self.farms[filt].copy()
+
+    def assign_nodes(self, grid_index_):
+        """
+        Adds the nearest ERA5 node of every farm with a location ('node', 'era5_lat' and 'era5_lon'), from a
+        grid_index.GridIndex, in one query.
+        """
+        located = self.farms['lat'].notnull() & self.farms['lon'].notnull()
+        nearest = grid_index_.query(self.farms.loc[located, 'lat'], self.farms.loc[located, 'lon'])
+        self.farms['node'] = pd.Series(nearest['node'].to_numpy(), index=self.farms.index[located]).reindex(self.farms.index).astype('Int32')
+        self.farms['era5_lat'] = pd.Series(nearest['lat'].to_numpy(), index=self.farms.index[located]).reindex(self.farms.index)
+        self.farms['era5_lon'] = pd.Series(nearest['lon'].to_numpy(), index=self.farms.index[located]).reindex(self.farms.index)
+        self._farms_by_node = {}
+        for farm_id, node in zip(self.farms.index[located].tolist(), nearest['node'].tolist()):
+            self._farms_by_node.setdefault(node, []).append(farm_id)
+
+    def get_farm_ids_at_node(self, node):
+        """
+        Returns the farm_ids whose nearest ERA5 node is `node`, see assign_nodes().
+        """
+        return list(self._farms_by_node.get(node, []))
+
+
+def _load(csv_path, path):
+    signature = _get_signature(csv_path)
+    farms_path = os.path.join(path, 'farms.parquet')
+    bmus_path = os.path.join(path, 'bmus.parquet')
+    manifest_path = os.path.join(path, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest == signature:
+            return WindfarmRegistry(_read_farms(farms_path), pd.read_parquet(bmus_path), signature)
+    print(f"Building the wind farm registry from {csv_path}")
+    farms, bmus = build(csv_path)
+    os.makedirs(path, exist_ok=True)
+    atomic_files.write_parquet_atomic(farms, farms_path)
+    atomic_files.write_parquet_atomic(bmus, bmus_path)
+    # only once the tables are written
+    atomic_files.write_json_atomic(signature, manifest_path)
+    return WindfarmRegistry(farms, bmus, signature)
+
+
+def get_registry(csv_path=None, path=None):
+    """
+    Returns the WindfarmRegistry of the csv `csv_path` (windfarms_details_jt.csv by default), loaded once per process,
+    and again if the csv has changed.
+    """
+    csv_path = csv_path if csv_path is not None else get_csv_path()
+    path = path if path is not None else get_registry_path()
+    with _registries_lock:
+        registry = _registries.get((csv_path, path))
+        if registry is None or registry.signature != _get_signature(csv_path):
+            registry = _load(csv_path, path)
+            _registries[(csv_path, path)] = registry
+        return registry
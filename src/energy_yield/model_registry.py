@@ -0,0 +1,190 @@
+import collections
+import glob
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KNeighborsRegressor
+
+from energy_yield.power_curve import BinnedPowerCurve
+
+# Global variable for project root path
+project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The fitted power curve models, one file per (BMU, model type, training data, code version):
+#
+#     models/<model type>/<bmu>-<hash of the training data>-v<version>.npz
+#
+# so whether a model is up to date is a file name check, without loading it, and a BMU whose training
+# data has not changed is not fitted again. Bump the version of a model type in MODEL_VERSIONS when the
+# way it is fitted changes. The files are .npz of plain arrays, loaded with allow_pickle=False; a KNN
+# model is fitted on float32 points and keeps them, as it predicts from every one of them, and is rebuilt
+# from them, which only builds its tree.
+# Models are loaded when first asked for, and the last MAX_LOADED_MODELS are kept in memory.
+
+MODEL_VERSIONS = {'knn': 2, 'binned': 1}
+MODEL_TYPES = tuple(MODEL_VERSIONS)
+MAX_LOADED_MODELS = 32
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_models_path():
+    return os.path.join(project_root_path, 'models')
+
+
+def get_model_registry(path=None):
+    """
+    Returns the ModelRegistry of the folder `path` (models/ by default), one per path and process.
+    """
+    if path is None:
+        path = get_models_path()
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = ModelRegistry(path)
+        return _registries[path]
+
+
+def hash_training_data(X, y):
+    """
+    Returns the sha1 of the training inputs, their columns, shape and values.
+    """
+    digest = hashlib.sha1()
+    if isinstance(X, pd.DataFrame):
+        digest.update(','.join(map(str, X.columns)).encode())
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    digest.update(repr((X.shape, y.shape)).encode())
+    digest.update(X.tobytes())
+    digest.update(y.tobytes())
+    return digest.hexdigest()
+
+
+def _to_float32(X, y):
+    # the points a KNN model is saved with, so the model fitted and the one loaded later are the same
+    if isinstance(X, pd.DataFrame):
+        X = X.astype(np.float32)
+    else:
+        X = np.asarray(X, dtype=np.float32)
+    return X, np.asarray(y, dtype=np.float32)
+
+
+def _fit_knn(X, y):
+    return KNeighborsRegressor(weights='distance').fit(*_to_float32(X, y))
+
+
+def _save_knn(model, path):
+    X = model._fit_X.astype(np.float32)
+    columns = np.array(getattr(model, 'feature_names_in_', []), dtype=str)
+    np.savez_compressed(path, X=X, y=np.asarray(model._y, dtype=np.float32), columns=columns,
+                        n_neighbors=np.array(model.n_neighbors), weights=np.array(model.weights))
+
+
+def _load_knn(path):
+    with np.load(path, allow_pickle=False) as data:
+        X = data['X']
+        if len(data['columns']):
+            X = pd.DataFrame(X, columns=data['columns'].tolist())
+        model = KNeighborsRegressor(n_neighbors=int(data['n_neighbors']), weights=str(data['weights']))
+        return model.fit(X, data['y'])
+
+
+def _fit_binned(X, y):
+    return BinnedPowerCurve().fit(X, y)
+
+
+def _save_binned(model, path):
+    model.save(path)
+
+
+# {model type: (fit, save, load)}
+MODEL_FUNCTIONS = {
+    'knn': (_fit_knn, _save_knn, _load_knn),
+    'binned': (_fit_binned, _save_binned, BinnedPowerCurve.load),
+}
+
+
+class ModelRegistry:
+    """
+    Fitted models by BMU, model type, training data and code version, see above.
+
+    Args:
+    path (str): The models folder.
+    max_loaded_models (int): The number of models kept in memory.
+    """
+    def __init__(self, path, max_loaded_models=MAX_LOADED_MODELS):
+        self.path = path
+        self.max_loaded_models = max_loaded_models
+        self._loaded = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_model_type(self, model_type):
+        if model_type not in MODEL_VERSIONS:
+            raise ValueError(f"model_type must be one of {MODEL_TYPES}, not {model_type}")
+
+    def get_model_path(self, bmu, model_type, data_hash):
+        self._check_model_type(model_type)
+        return os.path.join(self.path, model_type, f'{bmu}-{data_hash[:16]}-v{MODEL_VERSIONS[model_type]}.npz')
+
+    def is_current(self, bmu, model_type, data_hash):
+        """
+        Whether a model of `bmu` fitted on the data with `data_hash` by the current code is saved, without loading it.
+        """
+        return os.path.exists(self.get_model_path(bmu, model_type, data_hash))
+
+    def load(self, bmu, model_type, data_hash):
+        """
+        Returns the saved model, from memory if it was loaded recently, or None if there is no current one.
+        """
+        path = self.get_model_path(bmu, model_type, data_hash)
+        with self._lock:
+            if path in self._loaded:
+                self._loaded.move_to_end(path)
+                return self._loaded[path]
+        if not os.path.exists(path):
+            return None
+        _, _, load = MODEL_FUNCTIONS[model_type]
+        try:
+            model = load(path)
+        except Exception as e:
+            print(f"Model {path} could not be loaded, it will be fitted again: {e}")
+            return None
+        self._remember(path, model)
+        return model
+
+    def _remember(self, path, model):
+        with self._lock:
+            self._loaded[path] = model
+            self._loaded.move_to_end(path)
+            while len(self._loaded) > self.max_loaded_models:
+                self._loaded.popitem(last=False)
+
+    def save(self, bmu, model_type, data_hash, model):
+        """
+        Saves a fitted model, replacing the older models of the BMU and model type.
+        """
+        path = self.get_model_path(bmu, model_type, data_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _, save, _ = MODEL_FUNCTIONS[model_type]
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        save(model, tmp_path)
+        os.replace(tmp_path, path)
+        for old_path in glob.glob(os.path.join(self.path, model_type, f'{glob.escape(bmu)}-*-v*.npz')):
+            if old_path != path and not old_path.endswith('.tmp.npz'):
+                os.remove(old_path)
+        self._remember(path, model)
+
+    def get_or_fit(self, bmu, model_type, X_train, y_train):
+        """
+        Returns the model of `bmu` fitted on (X_train, y_train), loading it if it is current, otherwise fitting and saving it.
+        """
+        data_hash = hash_training_data(X_train, y_train)
+        model = self.load(bmu, model_type, data_hash)
+        if model is None:
+            fit, _, _ = MODEL_FUNCTIONS[model_type]
+            model = fit(X_train, y_train)
+            self.save(bmu, model_type, data_hash, model)
+        return model
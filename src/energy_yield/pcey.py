@@ -5,17 +5,17 @@ from statistics import linear_regression, correlation
 # random forest regressor
 # from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
 
-# KNN regressor
-from sklearn.neighbors import KNeighborsRegressor
 # test train split
 from sklearn.model_selection import train_test_split
-import pickle
 
+import energy_yield.model_registry as model_registry
 
+
+import hashlib
 import os
+import re
 
 import matplotlib.pyplot as plt
-from utils.helpers import get_nearest_lat_lon
 
 
 ### plotting stuff
@@ -31,28 +31,22 @@ COLOURS = ['#3F7D20', '#A0DDE6', '#542e71','#3F7CAC','#698F3F']
 global project_root_path
 project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def load_model(bmu, X_train, y_train):
-	os.makedirs(os.path.join(project_root_path, 'models'), exist_ok=True)
-	try:
-		# make a folder for the plots
-		model_folder = os.path.join(project_root_path, 'models')
-		if not os.path.exists(model_folder):
-			os.mkdir(model_folder)
-		filename = f'{bmu}_model.pkl'
-		model_path = os.path.join(model_folder, filename)
-		with open(model_path, 'rb') as f:
-			model = pickle.load(f)
-		return model
-	except Exception as e:
-		model = KNeighborsRegressor(weights='distance')
-		model.fit(X_train, y_train)
-		with open(model_path, 'wb') as f:
-			pickle.dump(model, f)
-		return model
+# the models get_ml_prediction() can fit, selected per run
+MODEL_TYPES = model_registry.MODEL_TYPES
+# the prediction, unseen and monthly files are keyed by a hash of the data they were made from, this
+# version and the model version, bump it when the way they are made changes
+PREDICTION_VERSION = 1
+
+
+def load_model(bmu, X_train, y_train, model_type='knn'):
+	# fitted only if there is no saved model of this training data, see model_registry
+	return model_registry.get_model_registry().get_or_fit(bmu, model_type, X_train, y_train)
 
 
 class PCEY:
-	def __init__(self, data_obj, bmu, lat, lon, capacity, name, gen_type):
+	def __init__(self, data_obj, bmu, lat, lon, capacity, name, gen_type, model_type='knn'):
+		if model_type not in MODEL_TYPES:
+			raise ValueError(f"model_type must be one of {MODEL_TYPES}, not {model_type}")
 		self.weather_stats_df = data_obj['weather_stats_df']
 		self.ws_df = data_obj['ws_df']
 		self.gen_df = data_obj['gen_df']
@@ -70,6 +64,7 @@ class PCEY:
 		self.COL_PREDICTED_IDEAL_YIELD = 'predicted_ideal_yield_GWh'
 		self.COL_NET_YIELD = 'net_yield_GWh'
 		self.COL_CURTAILMENT_LOSSES = 'curtailment_losses_GWh'
+		self.COL_ACCEPTED_OFFERS = 'accepted_offers_GWh'
 		self.COL_QCd_YIELD = 'combined_yield_GWh'
 
 		self.COL_DAILY_PREDICTED = 'average_daily_predicted_yield_GWh'
@@ -83,30 +78,54 @@ class PCEY:
 		self.capacity = capacity
 		self.name = name
 		self.gen_type = gen_type
-		self.nearest_lat, self.nearest_lon = get_nearest_lat_lon(self.lat, self.lon)
+		self.model_type = model_type
+		# the files of the predictions of other models than KNN are kept apart
+		self.file_id = bmu if model_type == 'knn' else f'{bmu}_{model_type}'
+		self.data_key = None
+		# the ERA5 node of the weather data
+		self.nearest_lat, self.nearest_lon = data_obj['nearest_lat_lon']
+
+	def _get_data_key(self):
+		# the hash of the merged input data and of the code which predicts from it, see PREDICTION_VERSION
+		if self.data_key is None:
+			if self.preprocessed_df is None:
+				self._preprocess_data()
+			digest = hashlib.sha1(f'{PREDICTION_VERSION}|{self.model_type}|{model_registry.MODEL_VERSIONS[self.model_type]}'.encode())
+			digest.update(','.join(self.preprocessed_df.columns).encode())
+			digest.update(pd.util.hash_pandas_object(self.preprocessed_df).to_numpy().tobytes())
+			self.data_key = digest.hexdigest()[:16]
+		return self.data_key
+
+	def _get_file_path(self, folder, suffix=''):
+		return os.path.join(project_root_path, 'data', folder, f'{self.file_id}{suffix}-{self._get_data_key()}.parquet')
+
+	def _save(self, df, file_path):
+		# replaces the file of older data, or of an older version
+		folder_path, filename = os.path.split(file_path)
+		os.makedirs(folder_path, exist_ok=True)
+		df.to_parquet(file_path)
+		prefix = filename[:-len(f'-{self.data_key}.parquet')]
+		pattern = re.compile(re.escape(prefix) + r'(-[0-9a-f]{16})?\.parquet')
+		for old_filename in os.listdir(folder_path):
+			if old_filename != filename and pattern.fullmatch(old_filename):
+				os.remove(os.path.join(folder_path, old_filename))
 
 	def get_ml_prediction(self):
-		prediction_file_path = os.path.join(project_root_path, 'data', 'predictions', f'{self.bmu}.parquet')
-		os.makedirs(os.path.dirname(prediction_file_path), exist_ok=True)
-		# unseen data
-		unseen_file_path = os.path.join(project_root_path, 'data', 'unseen_data', f'{self.bmu}.parquet')
-		os.makedirs(os.path.dirname(unseen_file_path), exist_ok=True)
-
-
-		if os.path.exists(prediction_file_path):
-			self.preprocessed_df = pd.read_parquet(prediction_file_path)
-			self.unseen_df = pd.read_parquet(unseen_file_path)
-			self.prediction_ok = True
-			return 
 		try:
-			if self.preprocessed_df is None:
-				self._preprocess_data()
+			prediction_file_path = self._get_file_path('predictions')
+			# unseen data
+			unseen_file_path = self._get_file_path('unseen_data')
+			if os.path.exists(prediction_file_path) and os.path.exists(unseen_file_path):
+				self.preprocessed_df = pd.read_parquet(prediction_file_path)
+				self.unseen_df = pd.read_parquet(unseen_file_path)
+				self.prediction_ok = True
+				return
 			# test train split
 			ml_df = self.preprocessed_df[['wind_speed', 'wind_direction_degrees', self.COL_IDEAL_YIELD]].dropna().copy()
 			# round the wind direction to the nearest 5
-			ml_df['wind_direction_degrees'] = ml_df['wind_direction_degrees'].apply(lambda x: round(x/5)*5)
+			ml_df['wind_direction_degrees'] = (ml_df['wind_direction_degrees'] / 5).round() * 5
 			# round the wind speed to the nearest 0.5
-			ml_df['wind_speed'] = ml_df['wind_speed'].apply(lambda x: round(x*2)/2)
+			ml_df['wind_speed'] = (ml_df['wind_speed'] * 2).round() / 2
 			# drop any duplicates
 			filt = ml_df.duplicated(subset=['wind_speed', 'wind_direction_degrees', self.COL_IDEAL_YIELD], keep='first')
 
@@ -125,9 +144,10 @@ class PCEY:
 			unseen_df = ml_df[['wind_speed', 'wind_direction_degrees', self.COL_IDEAL_YIELD]][-336:].copy()
 
 			
-			X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3)
+			# a fixed split, so the same data gives the same training set and the saved model is reused
+			X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=0)
 			# fit the model
-			model = load_model(self.bmu, X_train, y_train)
+			model = load_model(self.bmu, X_train, y_train, self.model_type)
 			# get the predictions
 			y_pred = model.predict(X_test)
 			self.preprocessed_df[self.COL_PREDICTED_IDEAL_YIELD] = np.nan
@@ -136,11 +156,11 @@ class PCEY:
 			self.preprocessed_df.loc[filt, self.COL_PREDICTED_IDEAL_YIELD] = model.predict(self.preprocessed_df.loc[filt, ['wind_speed', 'wind_direction_degrees']])# 
 			self.prediction_ok = True
 			# save the file to the data folder
-			self.preprocessed_df.to_parquet(prediction_file_path)
+			self._save(self.preprocessed_df, prediction_file_path)
 
 			unseen_df[self.COL_PREDICTED_IDEAL_YIELD] = model.predict(unseen_df[['wind_speed', 'wind_direction_degrees']])
 			unseen_df = unseen_df.resample('30T').last()
-			unseen_df.to_parquet(unseen_file_path)
+			self._save(unseen_df, unseen_file_path)
 			self.unseen_df = unseen_df.copy()
 
 
@@ -165,14 +185,18 @@ class PCEY:
 		
 		
 
-		merged_df['Total'] = self.bav_df[['Total']].resample('30T').last().fillna(0).copy()
+		# accepted bids (negative, i.e. curtailment) and offers
+		volumes_df = self.bav_df[['BAV', 'OAV']].resample('30T').last().fillna(0)
+		merged_df['BAV'] = volumes_df['BAV']
+		merged_df['OAV'] = volumes_df['OAV']
 		# interpolate the ws_df
 		for col in ['wind_speed', 'wind_direction_degrees']:
 			merged_df[col].interpolate(method='linear', inplace=True, limit=2)
 		merged_df[self.COL_NET_YIELD] = merged_df['Quantity (MW)'] / 2000.
-		merged_df[self.COL_CURTAILMENT_LOSSES] = -merged_df['Total'] / 1000.
-		# drop the total column and the quantity column
-		merged_df.drop(columns=['Total', 'Quantity (MW)'], inplace=True)
+		merged_df[self.COL_CURTAILMENT_LOSSES] = -merged_df['BAV'] / 1000.
+		merged_df[self.COL_ACCEPTED_OFFERS] = merged_df['OAV'] / 1000.
+		# drop the volume columns and the quantity column
+		merged_df.drop(columns=['BAV', 'OAV', 'Quantity (MW)'], inplace=True)
 		# fill the na values with 0
 		# for col in [self.COL_NET_YIELD, self.COL_CURTAILMENT_LOSSES]:
 		# 	merged_df[col].fillna(0., inplace=True, limit_direction='forward')
@@ -219,7 +243,7 @@ class PCEY:
 			self.get_ml_prediction()
 		_df = self.preprocessed_df.copy()
 		# Group by month
-		month_df = _df[[self.COL_NET_YIELD, self.COL_IDEAL_YIELD, self.COL_CURTAILMENT_LOSSES, self.COL_PREDICTED_IDEAL_YIELD]].resample('1MS').sum()
+		month_df = _df[[self.COL_NET_YIELD, self.COL_IDEAL_YIELD, self.COL_CURTAILMENT_LOSSES, self.COL_ACCEPTED_OFFERS, self.COL_PREDICTED_IDEAL_YIELD]].resample('1MS').sum()
 
 		# Calculate the availability for each month
 		month_df['data_coverage_%'] = _df[self.COL_NET_YIELD].resample('1MS').count() / (month_df.index.days_in_month * 48) * 100.
@@ -234,10 +258,9 @@ class PCEY:
 
 
 	def load_month_df(self):
-		file_path = os.path.join(project_root_path, 'data', 'pcey_data', f'{self.bmu}_monthly.parquet')
-		os.makedirs(os.path.dirname(file_path), exist_ok=True)
-		unseen_file_path = os.path.join(project_root_path, 'data', 'unseen_data', f'{self.bmu}.parquet')
-		if os.path.exists(file_path):
+		file_path = self._get_file_path('pcey_data', '_monthly')
+		unseen_file_path = self._get_file_path('unseen_data')
+		if os.path.exists(file_path) and os.path.exists(unseen_file_path):
 			self.month_df = pd.read_parquet(file_path)
 			self.unseen_df = pd.read_parquet(unseen_file_path)
 		else:
@@ -246,7 +269,7 @@ class PCEY:
         	# Step 2: Apply auto quality control
 			self.auto_qc(monthly_df)
 			# save the file
-			self.month_df.to_parquet(file_path)
+			self._save(self.month_df, file_path)
 
 
 	def _load_fit_dict(self, df):
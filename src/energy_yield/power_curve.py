@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+
+# A power curve learnt as a table of the mean output in each (wind speed bin x direction sector) cell,
+# as an alternative to KNeighborsRegressor: fitting is two bincounts and predicting is one gather from
+# the table, which is a few kilobytes.
+#
+# Cells seen fewer than MIN_COUNT times are not trusted on their own:
+#
+#     each sector is smoothed along the wind speed by a count weighted moving average (SMOOTHING_BINS either side)
+#     a cell with still too few points takes the all sector curve of its speed bin
+#     a speed bin with no points at all is interpolated from its neighbours, and held flat beyond the
+#         fastest one (a turbine at rated power), and zero below the slowest
+#
+# The table is saved as an .npz of plain arrays, so loading it runs no code.
+
+SPEED_BIN = 0.5
+MAX_SPEED = 40
+N_SECTORS = 12
+MIN_COUNT = 5
+SMOOTHING_BINS = 1
+
+
+def _smooth(values, bins):
+    # a moving sum along the first axis, `bins` either side
+    if bins == 0:
+        return values
+    padded = np.pad(values, [(bins, bins)] + [(0, 0)] * (values.ndim - 1))
+    cumulative = np.cumsum(padded, axis=0)
+    cumulative = np.concatenate([np.zeros_like(cumulative[:1]), cumulative])
+    return cumulative[2 * bins + 1:] - cumulative[:-(2 * bins + 1)]
+
+
+class BinnedPowerCurve:
+    """
+    Predicts from (wind_speed, wind_direction_degrees) like a scikit-learn regressor, see above.
+
+    Args:
+    speed_bin (float): The width of the wind speed bins, in m/s.
+    max_speed (float): Faster winds are in the last bin.
+    n_sectors (int): The number of direction sectors, the first centred on north.
+    min_count (int): The number of points a cell needs to be used on its own.
+    smoothing_bins (int): The speed bins either side averaged into each one.
+    """
+    def __init__(self, speed_bin=SPEED_BIN, max_speed=MAX_SPEED, n_sectors=N_SECTORS, min_count=MIN_COUNT, smoothing_bins=SMOOTHING_BINS):
+        self.speed_bin = speed_bin
+        self.max_speed = max_speed
+        self.n_sectors = n_sectors
+        self.min_count = min_count
+        self.smoothing_bins = smoothing_bins
+        self.table = None
+        self.counts = None
+
+    @property
+    def n_speed_bins(self):
+        return int(np.ceil(self.max_speed / self.speed_bin))
+
+    def _cells(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        speeds, directions = X[:, 0], X[:, 1]
+        valid = np.isfinite(speeds) & np.isfinite(directions)
+        speed_bins = np.clip(np.floor(np.where(valid, speeds, 0) / self.speed_bin), 0, self.n_speed_bins - 1).astype(np.int64)
+        sector_width = 360 / self.n_sectors
+        sectors = np.floor((np.where(valid, directions, 0) + sector_width / 2) % 360 / sector_width).astype(np.int64) % self.n_sectors
+        return speed_bins * self.n_sectors + sectors, valid
+
+    def fit(self, X, y):
+        """
+        Args:
+        X: (n, 2) wind speed and direction, e.g. a DataFrame of 'wind_speed' and 'wind_direction_degrees'.
+        y: The output at each point.
+        """
+        y = np.asarray(y, dtype=np.float64)
+        cells, valid = self._cells(X)
+        valid &= np.isfinite(y)
+        shape = (self.n_speed_bins, self.n_sectors)
+        sums = np.bincount(cells[valid], weights=y[valid], minlength=shape[0] * shape[1]).reshape(shape)
+        counts = np.bincount(cells[valid], minlength=shape[0] * shape[1]).reshape(shape).astype(np.float64)
+
+        smoothed_sums = _smooth(sums, self.smoothing_bins)
+        smoothed_counts = _smooth(counts, self.smoothing_bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table = np.where(smoothed_counts >= self.min_count, smoothed_sums / smoothed_counts, np.nan)
+            # the all sector curve, for the cells with too few points
+            all_sector_counts = smoothed_counts.sum(axis=1)
+            all_sector_curve = np.where(all_sector_counts > 0, smoothed_sums.sum(axis=1) / all_sector_counts, np.nan)
+        table = np.where(np.isnan(table), all_sector_curve[:, np.newaxis], table)
+
+        # the speed bins with no points at all
+        speeds = (np.arange(shape[0]) + 0.5) * self.speed_bin
+        seen = ~np.isnan(all_sector_curve)
+        if seen.any():
+            curve = np.interp(speeds, speeds[seen], all_sector_curve[seen], left=0, right=all_sector_curve[seen][-1])
+        else:
+            curve = np.zeros(shape[0])
+        table = np.where(np.isnan(table), curve[:, np.newaxis], table)
+
+        self.table = table.astype(np.float32)
+        self.counts = counts.astype(np.int32)
+        return self
+
+    def predict(self, X):
+        """
+        Returns the output of each (wind speed, direction), NaN where either is missing.
+        """
+        if self.table is None:
+            raise ValueError('BinnedPowerCurve is not fitted')
+        cells, valid = self._cells(X)
+        return np.where(valid, self.table.ravel()[cells], np.nan)
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, table=self.table, counts=self.counts,
+                            params=np.array([self.speed_bin, self.max_speed, self.n_sectors, self.min_count, self.smoothing_bins], dtype=np.float64))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            speed_bin, max_speed, n_sectors, min_count, smoothing_bins = data['params'].tolist()
+            model = cls(speed_bin, max_speed, int(n_sectors), int(min_count), int(smoothing_bins))
+            model.table = data['table']
+            model.counts = data['counts']
+        return model
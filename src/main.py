@@ -1,109 +1,75 @@
-import ast
 import pandas as pd
 import sys
 
 
 # Custom modules
-from energy_yield.pcey import PCEY
-import utils.helpers as helpers
+from energy_yield.pcey import PCEY, MODEL_TYPES
 import data_handling.weather as weather
+import data_handling.grid_index as grid_index
+import data_handling.interpolation as interpolation
+import data_handling.weather_store as weather_store
+import data_handling.windfarm_registry as windfarm_registry
 
 
-from data_handling.bmrs import BMRS, BMU
+from data_handling.bmrs import BMRS, BMU, update_gen_data_by_date
 from energy_yield import matplotlib_plotting as pcey_plotting
 
 # curvefit
 
 
-def get_lat_lon(bmu, windfarm_details):
-	lat, lon = windfarm_details.loc[windfarm_details['bmrs_id'] == bmu, ['lat', 'lon']].values[0]
-	if lon < 0:
-		lon = lon + 360
-	return lat, lon
-
-
-
-
-def get_capacity(bmu, windfarm_details):
-	return windfarm_details.loc[windfarm_details['bmrs_id'] == bmu, 'capacity'].values[0]
-
-
-def get_name(bmu, windfarm_details):
-	return windfarm_details.loc[windfarm_details['bmrs_id'] == bmu, 'name'].values[0]
-
-
-def get_type(bmu, windfarm_details):
-	return windfarm_details.loc[windfarm_details['bmrs_id'] == bmu, 'type'].values[0]
-
-
-
-
-
-def calculate_wind_speed_and_direction(df):
-	v_df = df[['northward_wind_at_100_metres']].loc[df['northward_wind_at_100_metres'].notnull()]
-	# rename the variable column to 'V'
-	v_df = v_df.rename(columns={'northward_wind_at_100_metres': 'V'})
-	u_df = df[['eastward_wind_at_100_metres']].loc[df['eastward_wind_at_100_metres'].notnull()]
-	u_df = u_df.rename(columns={'eastward_wind_at_100_metres': 'U'})
-	# rename the variable column to 'V wind component'
-	# merge the two dfs
-	ws_df = pd.merge(v_df, u_df, on='utc_time')
-	# calculate the wind speed
-	ws_df['wind_speed'] = (ws_df['V']**2 + ws_df['U']**2)**0.5
-	ws_df['wind_direction_degrees'] = (270 - (180/3.14159)*ws_df['V']/ws_df['U'])%360
-
-	return ws_df[['wind_speed', 'wind_direction_degrees']]
-
-
-
 def get_weather_stats_df(weather_df):
 	weather_stats_df = weather_df[['wind_speed']].resample('1D').mean()
 	weather_stats_df = weather_stats_df[['wind_speed']].resample('1MS').mean()
 	return weather_stats_df
 
 
-def enforce_list(_string_list):
-	try:
-		assert isinstance(_string_list, list)
-		return _string_list
-	except Exception as e:
-		print(e)
-		string_list = ast.literal_eval(_string_list)
-		return string_list
-
 if __name__ == "__main__":
+	# the power curve model, 'knn' or 'binned': python src/main.py binned
+	model_type = sys.argv[1] if len(sys.argv) > 1 else 'knn'
+	if model_type not in MODEL_TYPES:
+		raise ValueError(f"model_type must be one of {MODEL_TYPES}, not {model_type}")
 	bmrs_obj = BMRS()
 
-	windfarm_details = helpers.read_custom_windfarm_csv()
-	filt = windfarm_details['capacity'] > 1
-	windfarm_details = windfarm_details[filt]
-	weather_df = weather.fetch_all_weather_data()
+	registry = windfarm_registry.get_registry()
+	store = weather.fetch_all_weather_data()
 	curtailment_df = bmrs_obj.get_all_accepted_volumes_data(id='BAV', update=True)
+	# the BAV and OAV of every BMU, read per BMU below
+	bmrs_obj.get_volume_cube()
 	common_data_obj = {}
-	common_data_obj['weather_df'] = weather_df
+	common_data_obj['weather_store'] = store
 	common_data_obj['curtailment_df'] = curtailment_df
 
-	windfarm_details.dropna(subset=['bmrs_id'], inplace=True)
-	filt = windfarm_details.duplicated(subset=['bmrs_id', 'name'], keep='first')
-	windfarm_details = windfarm_details[~filt]
+	# the nearest ERA5 node of every wind farm, in one query
+	registry.assign_nodes(grid_index.get_grid_index(store))
+	windfarm_details = registry.get_farms(min_capacity=1, with_bmus=True, drop_duplicates=True)
+	# the farms without coordinates have no weather
+	windfarm_details = windfarm_details.dropna(subset=['lat', 'lon'])
+	# the generation data of every BMU, downloaded once for all of them through one engine, and only read below
+	bmu_ids = list(dict.fromkeys(bmu for bmus in windfarm_details['bmrs_id'] for bmu in bmus))
+	try:
+		update_gen_data_by_date([BMU(bmu) for bmu in bmu_ids])
+	except Exception as e:
+		print(f"update_gen_data_by_date() failed: {e}")
+	# the weather of every wind farm blended from the nodes around it, a batch of farms at a time
+	farm_weather = interpolation.iter_interpolated(store, windfarm_details['lat'], windfarm_details['lon'], weather_store.WIND_VARIABLES)
 	rows = []
 
-	for index, row in windfarm_details.iterrows():
+	for (index, row), farm_weather_df in zip(windfarm_details.iterrows(), farm_weather):
 		lat, lon = row['lat'], row['lon']
 		cap = row['capacity']
-		bmus = enforce_list(row['bmrs_id'])
+		bmus = row['bmrs_id']
 		name = row['name']
 		gen_type = row['gen_type']
+		nearest_lat, nearest_lon = row['era5_lat'], row['era5_lon']
+		# the wind speed and direction of the farm, shared by its BMUs
+		ws_df = farm_weather_df.dropna()
+		weather_stats_df = get_weather_stats_df(ws_df)
 
 		for bmu in bmus:
 			try:
-				nearest_lat, nearest_lon = helpers.get_nearest_lat_lon(lat, lon)
-				weather_df = helpers.get_nearest_weather_data(common_data_obj['weather_df'], nearest_lat, nearest_lon)
-				bmu_obj = BMU(bmu, update=True)
+				bmu_obj = BMU(bmu)
 				gen_df = bmu_obj.get_all_gen_data()
-				bav_df = bmrs_obj.get_bav_data_for_bmu(bmu)
-				ws_df = calculate_wind_speed_and_direction(weather_df)
-				weather_stats_df = get_weather_stats_df(ws_df)
+				bav_df = bmrs_obj.get_accepted_volumes_for_bmu(bmu)
 
 				assert len(gen_df) > 0
 
@@ -112,8 +78,9 @@ if __name__ == "__main__":
 				data_obj['ws_df'] = ws_df
 				data_obj['gen_df'] = gen_df
 				data_obj['bav_df'] = bav_df
+				data_obj['nearest_lat_lon'] = (nearest_lat, nearest_lon)
 
-				wf_pcey = PCEY(data_obj, bmu, lat, lon, cap, name, gen_type)
+				wf_pcey = PCEY(data_obj, bmu, lat, lon, cap, name, gen_type, model_type)
 				wf_pcey.load_month_df()
 				wf_pcey.calculate_energy_yield()
 				pcey_plotting.plot_generation(wf_pcey)
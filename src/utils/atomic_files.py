@@ -0,0 +1,18 @@
+import json
+import os
+
+# Files written next to themselves and moved into place, so a reader, or a run interrupted half way through,
+# never sees a partly written file.
+
+
+def write_json_atomic(data, filename):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_filename, filename)
+
+
+def write_parquet_atomic(df, filename):
+    tmp_filename = filename + '.tmp'
+    df.to_parquet(tmp_filename)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,69 @@
+import abc
+import asyncio
+import socket
+import threading
+
+from aiohttp import web
+
+# The lifecycle shared by the local stand-ins for the APIs (data_handling/fake_bmrs.py, utils/fake_wikidata.py):
+# an aiohttp app on its own event loop in a daemon thread, so the code under test can make real requests
+# to it from the main thread. Subclasses add their routes in _add_routes(), and cannot be created without it.
+
+
+class BackgroundServer(abc.ABC):
+    """
+    Serves the routes of a subclass in a background thread, between start() and stop(), or in a with block.
+
+    Args:
+    host (str): The interface to listen on.
+    port (int): 0 picks a free port, which is set on `port` once started.
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @abc.abstractmethod
+    def _add_routes(self, router):
+        """
+        Adds the routes of the server to the aiohttp `router`.
+        """
+
+    async def _start(self, sock):
+        app = web.Application()
+        self._add_routes(app.router)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.SockSite(self._runner, sock).start()
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        self.port = sock.getsockname()[1]
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start(sock))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,108 @@
+import os
+import re
+import sys
+import tempfile
+import zlib
+
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.fake_server as fake_server
+import utils.helpers as helpers
+import utils.wikidata as wikidata
+
+# A local stand-in for query.wikidata.org/sparql, answering the VALUES queries of utils/wikidata.py with
+# SPARQL JSON results, so the resolver can be run without the real endpoint. To point the code at it, set
+#
+#     [wikidata]
+#     endpoint = http://127.0.0.1:<port>/sparql
+#
+# in config.ini, or run this file to resolve the wind farms of windfarms.geojson against it.
+
+VALUES_PATTERN = re.compile(r'VALUES\s+\?item\s*\{([^}]*)\}')
+
+WIND_FARM_TYPES = [('Q194356', 'wind farm'), ('Q1124155', 'offshore wind farm'), ('Q19595382', 'onshore wind farm')]
+
+
+def get_synthetic_item(qid):
+    """
+    Returns the label and types of a synthetic item, the same for the same id.
+    """
+    n = zlib.crc32(qid.encode())
+    return {'label': f'Wind farm {qid}', 'types': [WIND_FARM_TYPES[n % len(WIND_FARM_TYPES)]]}
+
+
+class FakeWikidataServer(fake_server.BackgroundServer):
+    """
+    Serves /sparql in a background thread. The items requested are looked up in `items`, {qid: {'label', 'types'}}
+    with types a list of (qid, label), or made up with get_synthetic_item() if `items` is None.
+    Items in `missing` are not returned, as for ids Wikidata does not have.
+
+    Args:
+    host (str): The interface to listen on.
+    port (int): 0 picks a free port, see `url`.
+    """
+    def __init__(self, host='127.0.0.1', port=0, items=None, missing=()):
+        super().__init__(host, port)
+        self.items = items
+        self.missing = set(missing)
+        self.stats = {'requests': 0, 'items': 0}
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/sparql'
+
+    def _get_item(self, qid):
+        if qid in self.missing:
+            return None
+        if self.items is None:
+            return get_synthetic_item(qid)
+        return self.items.get(qid)
+
+    def _bindings(self, qid, item):
+        entity = f'http://www.wikidata.org/entity/{qid}'
+        binding = {'item': {'type': 'uri', 'value': entity}, 'itemLabel': {'type': 'literal', 'value': item['label']}}
+        if not item['types']:
+            return [binding]
+        return [
+            dict(binding, type={'type': 'uri', 'value': f'http://www.wikidata.org/entity/{type_qid}'},
+                 typeLabel={'type': 'literal', 'value': type_label})
+            for type_qid, type_label in item['types']
+        ]
+
+    async def _handle_sparql(self, request):
+        self.stats['requests'] += 1
+        match = VALUES_PATTERN.search(request.query.get('query', ''))
+        if match is None:
+            return web.Response(status=400, text='Only VALUES ?item queries are supported')
+        qids = re.findall(r'wd:(Q\d+)', match.group(1))
+        self.stats['items'] += len(qids)
+        bindings = []
+        for qid in qids:
+            item = self._get_item(qid)
+            if item is not None:
+                bindings.extend(self._bindings(qid, item))
+        data = {'head': {'vars': ['item', 'itemLabel', 'type', 'typeLabel']}, 'results': {'bindings': bindings}}
+        return web.json_response(data, content_type='application/sparql-results+json')
+
+    def _add_routes(self, router):
+        router.add_get('/sparql', self._handle_sparql)
+
+
+def demo():
+    """
+    Resolves the Wikidata wind farms of windfarms.geojson against a FakeWikidataServer twice, through a fresh
+    cache, and prints the number of requests each run made. The second run should be served from the cache.
+    """
+    features = helpers._load_raw_windfarms_geojson()['features']
+    values = [feature['id'] for feature in features if 'wiki' in feature['id']]
+    with FakeWikidataServer() as server, tempfile.TemporaryDirectory() as tmp_folder:
+        resolver = wikidata.WikidataResolver(os.path.join(tmp_folder, 'wikidata_cache.sqlite'), endpoint=server.url)
+        for run in ['cold', 'cached']:
+            requests_before = server.stats['requests']
+            items = resolver.resolve(values)
+            print(f"{run}: {len(items)} items resolved in {server.stats['requests'] - requests_before} requests")
+
+
+if __name__ == "__main__":
+    demo()
@@ -1,13 +1,12 @@
-import ast
 import glob
 import json
-import requests
+import utils.http_client as http_client
+import utils.wikidata as wikidata
+import data_handling.windfarm_registry as windfarm_registry
 import numpy as np
 import pandas as pd
 import configparser
-from bs4 import BeautifulSoup
 import os
-import time
 import concurrent.futures
 # from tqdm import tqdm
 
@@ -22,6 +21,17 @@ def get_credentials():
     return api_key
 
 
+def get_bmrs_config():
+    """
+    Returns the [bmrs] section of config.ini. Besides api_key it can have:
+    base_url, to use another server (e.g. data_handling/fake_bmrs.py) instead of api.bmreports.com
+    response_cache, true to keep the raw responses in data/response_cache
+    """
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    return config['bmrs']
+
+
 
 
 
@@ -60,7 +70,8 @@ def get_windfarm_details():
         }
         SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE]". }
         }"""
-        r = requests.get(url, params = {'format': 'json', 'query': query})
+        r = http_client.get_client().get(url, params = {'format': 'json', 'query': query})
+        r.raise_for_status()
         data = r.json()
         row_list = []
         for wf in data['results']['bindings']:
@@ -77,8 +88,10 @@ def get_windfarm_details():
                 windfarm_details_[col] = windfarm_details_[col].astype('float')
             except:
                 pass
-        windfarm_details_['name'] = windfarm_details_.apply(lambda x: _get_windfarm_name(x['itemLabel']), axis=1)
-        windfarm_details_['type'] = windfarm_details_.apply(lambda x: _get_windfarm_name(x['typeLabel']), axis=1)
+        # the labels the label service left as ids, resolved in one batch
+        resolver = wikidata.get_resolver()
+        windfarm_details_['name'] = resolver.get_labels(windfarm_details_['itemLabel'].tolist())
+        windfarm_details_['type'] = resolver.get_labels(windfarm_details_['typeLabel'].fillna('').tolist())
         filt = windfarm_details_['type'] == 'wind farm'
         windfarm_details_.loc[filt, 'type'] = 'onshore wind farm'
 
@@ -107,7 +120,8 @@ def get_uk_windfarms():
     ?windFarm wdt:P17 ?country.    # Country property
     SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
     }"""
-    r = requests.get(url, params = {'format': 'json', 'query': query})
+    r = http_client.get_client().get(url, params = {'format': 'json', 'query': query})
+    r.raise_for_status()
     data = r.json()
     row_list = []
     for wf in data['results']['bindings']:
@@ -120,61 +134,19 @@ def get_uk_windfarms():
 
 
         
-def _get_windfarm_name(id):
-    try:
-        # Make a GET request to the web page
-        url = "https://www.wikidata.org/wiki/" + id
-        response = requests.get(url)
-
-        # Parse the HTML content with BeautifulSoup
-        soup = BeautifulSoup(response.content, 'html.parser')
-        # Find the title element and extract the text
-        title_element = soup.find('title')
-        title = title_element.text
-        # Remove the Wikidata prefix and suffix
-        title = title.replace(' - Wikidata', '')
-        if title == 'wind farm':
-            title = 'onshore wind farm'
-        return title
-    except:
-        return ''
-        
-def get_windfarm_type(url):
-    try:
-        item_id = url.split('/')[-1]
-        endpoint_url = 'https://query.wikidata.org/sparql'
-        
-        query = f"""
-        SELECT ?property ?propertyLabel ?value ?valueLabel
-        WHERE {{
-        wd:{item_id} wdt:P31 ?value .
-        SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }}
-        }}
-        """
-        success = False
-        while not success:
-            r = requests.get(endpoint_url, params={'format': 'json', 'query': query})
-            if r.status_code == 200:
-                success = True
-                data = r.json()
-                for wf in data['results']['bindings']:
-                    return wf['valueLabel']['value']
-            else:
-                print(f"Retry due to HTTP status: {r.status_code}, {item_id}")
-                time.sleep(10)
-    except Exception as e:
-        print(f"Error: {e}")
-        return ''
-
 def load_windfarms_geojson(get_type=True):
     # read in the .geojson file
     data = _load_raw_windfarms_geojson()
+    if get_type:
+        # the types of all the Wikidata wind farms, in one batch
+        items = wikidata.get_resolver().resolve([feature['id'] for feature in data['features'] if 'wiki' in feature['id']])
     rows = []
     for feature in data['features']:
 
         bmu_dict = {}
         if ('wiki' in feature['id']) & get_type:
-            bmu_dict['gen_type'] = get_windfarm_type(feature['id'])
+            item = items.get(wikidata.get_qid(feature['id']))
+            bmu_dict['gen_type'] = item['type_label'] if item is not None and item['type_label'] else ''
         for key in feature['properties'].keys():
             bmu_dict[key] = feature['properties'][key]
         try:
@@ -197,54 +169,11 @@ def _load_raw_windfarms_geojson():
     return data
 
 def read_custom_windfarm_csv():
-    data = pd.read_csv("windfarms_details_jt.csv")
-    return data
+    """
+    Returns the wind farms of windfarms_details_jt.csv, from the wind farm registry, with the list columns as lists.
+    """
+    return windfarm_registry.get_registry().farms.copy()
 
 def get_list_of_bmu_ids_from_custom_windfarm_csv():
-    windfarm_details = pd.read_csv("windfarms_details_jt.csv")
-    filt = windfarm_details['capacity'] > 1
-    windfarm_details = windfarm_details[filt]
-    # drop where bmrs_id is null
-    windfarm_details.dropna(subset=['bmrs_id'], inplace=True)
-    bmu_list = []
-    for index, row in windfarm_details.iterrows():
-        bmu_ids = ast.literal_eval(row['bmrs_id'])
-        bmu_list.extend(bmu_ids)
-    bmu_list = list(set(bmu_list))
-    # sort
-    bmu_list.sort()
-    return bmu_list
-
-
-
-
-def get_nearest_weather_data(weather_data,lat,lon):
-    _df = weather_data.loc[(weather_data['lat'] == lat) & (weather_data['lon'] == lon)]
-    # drop lat and lon columns
-    _df = _df.drop(columns=['lat', 'lon'])
-    # rename the index to utc_time
-    _df.index.name = 'utc_time'
-    _df = _df.resample('1H').last()
-    return _df
-
-# a function which takes a lat, lon and returns the nearest values from a list of lat, lon values
-def get_nearest_lat_lon(lat, lon):
-    data_file = os.path.join(project_root_path,'data', 'weather_data', '2023_01_northward_wind_at_100_metres.parquet')
-    df = pd.read_parquet(data_file)
-
-    lat_lon_list = df[['lat', 'lon']].drop_duplicates().to_numpy()
-
-    lat_rad, lon_rad = np.radians(lat), np.radians(lon)
-    lat_lon_list_rad = np.radians(lat_lon_list)
-
-    dlon = lon_rad - lat_lon_list_rad[:, 1]
-    dlat = lat_rad - lat_lon_list_rad[:, 0]
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat_rad) * np.cos(lat_lon_list_rad[:, 0]) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arcsin(np.sqrt(a))
-    dist = 6371 * c
-
-    idx = np.argmin(dist)
-
-    return lat_lon_list[idx]
-
-
+    # the BMUs of the farms over 1 MW, sorted
+    return windfarm_registry.get_registry().get_bmu_ids(min_capacity=1)
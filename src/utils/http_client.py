@@ -0,0 +1,268 @@
+import asyncio
+import contextlib
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+
+# One HTTP layer for the BMRS and Wikidata clients. Every host gets:
+#
+#     an adaptive token bucket: the rate is halved on a 429 (at most once a second, as the requests in flight
+#         are throttled together) and grows by 1% with every success, so a backfill settles at the highest
+#         rate the API sustains
+#     jittered exponential backoff on 429 and 5xx responses and connection errors, honouring Retry-After
+#     a circuit breaker: after `failure_threshold` server errors in a row the host is not called for
+#         `reset_timeout` seconds, then one request is let through to test it
+#
+# and counters of the requests, retries, throttling and time spent waiting, see HttpClient.report().
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# requests per second, `rate` to start with, adapting between `min_rate` and `max_rate`
+HOST_LIMITS = {
+    'query.wikidata.org': {'rate': 1, 'min_rate': 0.1, 'max_rate': 5, 'burst': 1},
+    'www.wikidata.org': {'rate': 2, 'min_rate': 0.1, 'max_rate': 10, 'burst': 2},
+}
+DEFAULT_LIMITS = {'rate': 20, 'min_rate': 0.5, 'max_rate': 200, 'burst': 32}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket whose rate adapts to throttling, see above.
+    Callers reserve a token and sleep for the returned time, so it works for threads and coroutines.
+    """
+    def __init__(self, rate, min_rate, max_rate, burst, increase=0.01, decrease=0.5, decrease_interval=1.0):
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.decrease_interval = decrease_interval
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns how long to wait, in seconds, before using it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate * (1 + self.increase))
+
+    def on_throttled(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._last_decrease is not None and now - self._last_decrease < self.decrease_interval:
+                return
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def check(self, host):
+        """
+        Raises CircuitOpenError if the host should not be called yet.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{host} is failing, not retrying for {self.reset_timeout}s")
+            # half open: let requests through, one more failure opens it again
+            self._failures = self.failure_threshold - 1
+            self._opened_at = None
+
+    def on_success(self):
+        with self._lock:
+            self._failures = 0
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class HostState:
+    def __init__(self, limits, failure_threshold, reset_timeout):
+        self.limiter = TokenBucket(**limits)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.counters = {'requests': 0, 'retries': 0, 'throttled': 0, 'server_errors': 0, 'connection_errors': 0, 'wait_seconds': 0.0}
+
+
+class HttpClient:
+    """
+    Rate limited, retrying GET requests, with requests (get()) or aiohttp (get_async()), see above.
+
+    Args:
+    max_retries (int): Retries of a request before its last response (or error) is returned to the caller.
+    backoff_base (float): The first backoff, in seconds, doubled on each retry.
+    backoff_cap (float): The longest backoff, in seconds.
+    failure_threshold (int), reset_timeout (float): The circuit breaker settings.
+    host_limits (dict): Optional, {host: token bucket settings}, defaults to HOST_LIMITS.
+    """
+    def __init__(self, max_retries=6, backoff_base=1.0, backoff_cap=60.0, failure_threshold=5, reset_timeout=30, host_limits=None):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.host_limits = HOST_LIMITS if host_limits is None else host_limits
+        self.session = requests.Session()
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                limits = self.host_limits.get(host, DEFAULT_LIMITS)
+                self._hosts[host] = HostState(limits, self.failure_threshold, self.reset_timeout)
+            return host, self._hosts[host]
+
+    def _before_request(self, host, state):
+        state.breaker.check(host)
+        wait = state.limiter.reserve()
+        state.counters['requests'] += 1
+        state.counters['wait_seconds'] += wait
+        return wait
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                # jittered too, so the throttled requests do not all come back at once
+                return min(self.backoff_cap, float(retry_after) * random.uniform(1, 1.5))
+            except ValueError:
+                pass
+        delay = min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _on_status(self, state, status):
+        # returns True if the request should be retried
+        if status == 429:
+            state.counters['throttled'] += 1
+            state.limiter.on_throttled()
+            return True
+        if status >= 500:
+            state.counters['server_errors'] += 1
+            state.breaker.on_failure()
+            return status in RETRY_STATUSES
+        state.limiter.on_success()
+        state.breaker.on_success()
+        return False
+
+    def _on_connection_error(self, state):
+        state.counters['connection_errors'] += 1
+        state.breaker.on_failure()
+
+    def _retry(self, state, attempt, retry_after=None):
+        state.counters['retries'] += 1
+        delay = self._backoff(attempt, retry_after)
+        state.counters['wait_seconds'] += delay
+        return delay
+
+    def get(self, url, **kwargs):
+        """
+        requests.get() through the limiter, with retries. Returns the last response, check it with raise_for_status().
+        """
+        host, state = self._host(url)
+        attempt = 0
+        while True:
+            time.sleep(self._before_request(host, state))
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._on_connection_error(state)
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self._retry(state, attempt))
+                attempt += 1
+                continue
+            if not self._on_status(state, response.status_code) or attempt >= self.max_retries:
+                return response
+            response.close()
+            time.sleep(self._retry(state, attempt, response.headers.get('Retry-After')))
+            attempt += 1
+
+    @contextlib.asynccontextmanager
+    async def get_async(self, session, url, **kwargs):
+        """
+        `async with client.get_async(session, url) as response:`, session.get() through the limiter, with retries.
+        """
+        host, state = self._host(url)
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._before_request(host, state))
+            try:
+                response = await session.get(url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self._on_connection_error(state)
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry(state, attempt))
+                attempt += 1
+                continue
+            if not self._on_status(state, response.status) or attempt >= self.max_retries:
+                break
+            response.release()
+            await asyncio.sleep(self._retry(state, attempt, response.headers.get('Retry-After')))
+            attempt += 1
+        try:
+            yield response
+        finally:
+            response.release()
+
+    def counters(self):
+        """
+        Returns {host: counters}, with the current rate of each host.
+        """
+        with self._lock:
+            return {host: dict(state.counters, rate=round(state.limiter.rate, 2)) for host, state in self._hosts.items()}
+
+    def report(self):
+        return '; '.join(
+            f"{host}: {c['requests']} requests, {c['retries']} retries, {c['throttled']} throttled, "
+            f"{c['server_errors']} server errors, {c['connection_errors']} connection errors, "
+            f"{c['wait_seconds']:.1f}s waiting, {c['rate']} req/s"
+            for host, c in self.counters().items())
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the HttpClient shared by the whole process, so every caller of a host shares its limiter and breaker.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
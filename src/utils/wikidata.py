@@ -0,0 +1,188 @@
+import configparser
+import datetime as dt
+import os
+import re
+import sqlite3
+import threading
+
+import utils.http_client as http_client
+
+# Global variable for project root path
+project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Labels and types (P31, instance of) of Wikidata items, resolved BATCH_SIZE items per SPARQL request
+# with a VALUES clause, rather than one request per item:
+#
+#     SELECT ?item ?itemLabel ?type ?typeLabel WHERE {
+#         VALUES ?item { wd:Q1 wd:Q2 ... }
+#         OPTIONAL { ?item wdt:P31 ?type. }
+#         SERVICE wikibase:label { ... }
+#     }
+#
+# and kept in data/wikidata_cache.sqlite. An item is requested again once it is TTL_DAYS old, or
+# MISSING_TTL_DAYS for those Wikidata did not return, which may just not have been created yet.
+# The endpoint can be set in config.ini, e.g. to utils/fake_wikidata.py:
+#
+#     [wikidata]
+#     endpoint = http://127.0.0.1:<port>/sparql
+
+SPARQL_URL = 'https://query.wikidata.org/sparql'
+BATCH_SIZE = 200
+TTL_DAYS = 30
+MISSING_TTL_DAYS = 1
+
+QID_PATTERN = re.compile(r'^(?:https?://www\.wikidata\.org/(?:entity|wiki)/)?(Q\d+)$')
+
+QUERY_TEMPLATE = """SELECT ?item ?itemLabel ?type ?typeLabel WHERE {{
+    VALUES ?item {{ {values} }}
+    OPTIONAL {{ ?item wdt:P31 ?type. }}
+    SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }}
+}}"""
+
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+
+
+def get_qid(value):
+    """
+    Returns the item id of a Wikidata id or url ('Q123', 'http://www.wikidata.org/entity/Q123'), or None.
+    """
+    if not isinstance(value, str):
+        return None
+    match = QID_PATTERN.match(value.strip())
+    return match.group(1) if match else None
+
+
+def get_endpoint():
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    return config.get('wikidata', 'endpoint', fallback=SPARQL_URL)
+
+
+def get_resolver(path=None):
+    """
+    Returns the WikidataResolver with the cache `path` (data/wikidata_cache.sqlite by default), one per path and process.
+    """
+    if path is None:
+        path = os.path.join(project_root_path, 'data', 'wikidata_cache.sqlite')
+    with _resolvers_lock:
+        if path not in _resolvers:
+            _resolvers[path] = WikidataResolver(path)
+        return _resolvers[path]
+
+
+def _pick_type(types):
+    # an item can be an instance of several classes, prefer the wind farm one so the choice does not depend on the response order
+    for qid, label in types:
+        if 'wind farm' in label:
+            return qid, label
+    return min(types) if types else (None, None)
+
+
+class WikidataResolver:
+    """
+    Batched, cached Wikidata labels and types, see above.
+
+    Args:
+    path (str): The SQLite cache file.
+    endpoint (str): Optional, the SPARQL endpoint, defaults to get_endpoint().
+    batch_size (int): The number of items per request.
+    ttl_days (int), missing_ttl_days (int): How long items, and items Wikidata did not return, are cached.
+    """
+    def __init__(self, path, endpoint=None, batch_size=BATCH_SIZE, ttl_days=TTL_DAYS, missing_ttl_days=MISSING_TTL_DAYS):
+        self.path = path
+        self.endpoint = endpoint if endpoint is not None else get_endpoint()
+        self.batch_size = batch_size
+        self.ttl_days = ttl_days
+        self.missing_ttl_days = missing_ttl_days
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS items (
+                qid TEXT PRIMARY KEY,
+                label TEXT,
+                type TEXT,
+                type_label TEXT,
+                found INTEGER NOT NULL,
+                fetched TEXT NOT NULL
+            ) WITHOUT ROWID''')
+
+    def _lookup(self, qids, now):
+        # the cached items which have not expired
+        items = {}
+        with self._lock:
+            for start in range(0, len(qids), 500):
+                chunk = qids[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT qid, label, type, type_label, found, fetched FROM items WHERE qid IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                for qid, label, type_, type_label, found, fetched in rows:
+                    ttl_days = self.ttl_days if found else self.missing_ttl_days
+                    if now - dt.datetime.fromisoformat(fetched) < dt.timedelta(days=ttl_days):
+                        items[qid] = {'label': label, 'type': type_, 'type_label': type_label} if found else None
+        return items
+
+    def _query(self, qids):
+        query = QUERY_TEMPLATE.format(values=' '.join(f'wd:{qid}' for qid in qids))
+        r = http_client.get_client().get(self.endpoint, params={'format': 'json', 'query': query})
+        r.raise_for_status()
+        labels, types = {}, {}
+        for binding in r.json()['results']['bindings']:
+            qid = get_qid(binding['item']['value'])
+            labels[qid] = binding.get('itemLabel', {}).get('value', qid)
+            if 'type' in binding:
+                type_qid = get_qid(binding['type']['value'])
+                types.setdefault(qid, set()).add((type_qid, binding.get('typeLabel', {}).get('value', type_qid)))
+        items = {}
+        for qid, label in labels.items():
+            type_qid, type_label = _pick_type(types.get(qid, set()))
+            items[qid] = {'label': label, 'type': type_qid, 'type_label': type_label}
+        return items
+
+    def _store(self, qids, items, now):
+        fetched = now.isoformat(timespec='seconds')
+        rows = []
+        for qid in qids:
+            item = items.get(qid)
+            if item is None:
+                rows.append((qid, None, None, None, 0, fetched))
+            else:
+                rows.append((qid, item['label'], item['type'], item['type_label'], 1, fetched))
+        with self._lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.connection.execute('COMMIT')
+
+    def resolve(self, values):
+        """
+        Returns {qid: {'label', 'type', 'type_label'}} of the Wikidata ids or urls in `values`, None for the items
+        Wikidata does not have. Only the items not in the cache, or expired, are requested, BATCH_SIZE at a time.
+        """
+        qids = sorted({qid for qid in map(get_qid, values) if qid is not None})
+        now = dt.datetime.now()
+        items = self._lookup(qids, now)
+        missing = [qid for qid in qids if qid not in items]
+        if missing:
+            print(f"Resolving {len(missing)} Wikidata items in {-(-len(missing) // self.batch_size)} requests")
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            resolved = self._query(batch)
+            self._store(batch, resolved, now)
+            items.update({qid: resolved.get(qid) for qid in batch})
+        return items
+
+    def get_labels(self, values):
+        """
+        Returns the label of each of `values` which is a Wikidata id or url, the others are returned as they are.
+        """
+        items = self.resolve(values)
+        labels = []
+        for value in values:
+            qid = get_qid(value)
+            if qid is None:
+                labels.append(value)
+            else:
+                item = items.get(qid)
+                labels.append(item['label'] if item is not None else '')
+        return labels